@@ -1,20 +1,38 @@
 'roller-balance accounting.'
 import collections
-import json
+import concurrent.futures
 import logging
 import os
-
-import eth_utils
+import queue
+import threading
+import time
+import uuid
 
 import etherscan
 import db
+import metrics
 
 LOGGER = logging.getLogger('roller.accounting')
 WEI_DEPOSIT_FOR_ONE_ROLLER = 1*10**14  # 1/1000 ether, so a hundred will cost 0.01 eth.
 WEI_WITHDRAW_FOR_ONE_ROLLER = 7*10**13  # 7/10000 ether, so a hundred will withdraw 0.007 eth.
-REQUIRED_BLOCK_DEPTH = 10  # This is the required depth for accepting deposits and settling withdrawals.
+REQUIRED_BLOCK_DEPTH = etherscan.REQUIRED_BLOCK_DEPTH  # Required depth for accepting deposits and settling withdrawals.
 SAFE = os.environ.get('ROLLER_SAFE_ADDRESS')
 DEBUG = os.environ.get('ROLLER_DEBUG', 'false').lower() in ['true', 'yes', 'y', '1']
+SCAN_WINDOW = int(os.environ.get('ROLLER_SCAN_WINDOW', 10000))  # Maximal number of blocks fetched in one call.
+SCAN_WORKERS = int(os.environ.get('ROLLER_SCAN_WORKERS', 4))
+ARCHIVE_AGE_DAYS = int(os.environ.get('ROLLER_ARCHIVE_AGE_DAYS', 90))
+ARCHIVE_CHUNK_SIZE = 10000
+# Maximal number of transfers committed together by concurrent requests, 0 to commit each request on its own.
+TRANSFER_BATCH_SIZE = int(os.environ.get('ROLLER_TRANSFER_BATCH_SIZE', 0))
+TRANSFER_BATCH_WAIT_MS = float(os.environ.get('ROLLER_TRANSFER_BATCH_WAIT_MS', 5))
+# Seconds a request waits for its batch to commit, so requests never hang on a stuck batcher.
+TRANSFER_BATCH_TIMEOUT = float(os.environ.get('ROLLER_TRANSFER_BATCH_TIMEOUT', 60))
+# Times a batch is retried after losing a deadlock, before all of its requests fail.
+TRANSFER_BATCH_DEADLOCK_RETRIES = 3
+# Number of balances cached by each process, 0 to read every balance from the database.
+BALANCE_CACHE_SIZE = int(os.environ.get('ROLLER_BALANCE_CACHE_SIZE', 0))
+# Milliseconds a cached balance is served after it was read, the most it can lag behind writes of other processes.
+BALANCE_CACHE_TTL_MS = float(os.environ.get('ROLLER_BALANCE_CACHE_TTL_MS', 100))
 
 
 class InsufficientFunds(Exception):
@@ -29,81 +47,711 @@ class SettleError(Exception):
     'An error when settling payments.'
 
 
+LEDGER_WITH_ARCHIVE = """(
+    SELECT idx, source, target, amount FROM transactions_archive
+    UNION ALL
+    SELECT idx, source, target, amount FROM transactions)"""
+SETTLABLE_WITHDRAWALS_CONDITION = 'timestamp <= LAST_DAY(NOW()) - INTERVAL 5 DAY'
+
+
+class BalanceCache:
+    'An LRU cache of balances, each served for a limited time after it was read, and dropped on local writes.'
+
+    def __init__(self, max_size, ttl_ms):
+        self.max_size = max_size
+        self.ttl = ttl_ms / 1000
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # Balances with the time they expire, least recently used first.
+        self.entries = collections.OrderedDict()
+        # Bumped on every invalidation, so balances read before it are not cached after it.
+        self.generation = 0
+        self.stats = collections.Counter(hits=0, misses=0, expirations=0, evictions=0, invalidations=0, clears=0)
+
+    def get(self, addresses):
+        'Get the cached balances of addresses, and the version to put the missing ones with once they are read.'
+        # Taken before the missing balances are read, so they expire a TTL after any write they may have missed.
+        now = time.monotonic()
+        with self.lock:
+            balances = {}
+            for address in addresses:
+                entry = self.entries.get(address)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self.entries[address]
+                    self.stats['expirations'] += 1
+                    metrics.record_balance_cache_drop('expiration')
+                    continue
+                self.entries.move_to_end(address)
+                balances[address] = entry[0]
+            self.stats.update(hits=len(balances), misses=len(addresses) - len(balances))
+            version = (self.generation, now)
+        metrics.record_balance_cache_lookups(len(balances), len(addresses) - len(balances))
+        return balances, version
+
+    def put(self, balances, version):
+        'Cache balances read from the database, unless they were invalidated since the read started.'
+        generation, read_time = version
+        with self.lock:
+            if generation != self.generation:
+                return
+            for address, balance in balances.items():
+                self.entries[address] = (balance, read_time + self.ttl)
+                self.entries.move_to_end(address)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+                metrics.record_balance_cache_drop('eviction')
+
+    def invalidate(self, addresses):
+        'Drop addresses from the cache.'
+        with self.lock:
+            self.generation += 1
+            for address in addresses:
+                if self.entries.pop(address, None) is not None:
+                    self.stats['invalidations'] += 1
+                    metrics.record_balance_cache_drop('invalidation')
+
+    def clear(self):
+        'Drop all cached balances.'
+        with self.lock:
+            self.generation += 1
+            metrics.record_balance_cache_drop('clear', len(self.entries))
+            self.entries.clear()
+            self.stats['clears'] += 1
+
+    def get_stats(self):
+        'Get the cache statistics.'
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), max_size=self.max_size, ttl_ms=self.ttl * 1000)
+
+
+BALANCE_CACHE = None
+BALANCE_CACHE_LOCK = threading.Lock()
+
+
+def get_balance_cache():
+    'Get the balance cache of this process, creating it if needed, or None if caching is turned off.'
+    global BALANCE_CACHE  # pylint: disable=global-statement
+    if BALANCE_CACHE_SIZE <= 0:
+        return None
+    with BALANCE_CACHE_LOCK:
+        # A forked process starts with a fresh cache, it can not share locks with its parent.
+        if BALANCE_CACHE is None or BALANCE_CACHE.pid != os.getpid():
+            BALANCE_CACHE = BalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL_MS)
+        return BALANCE_CACHE
+
+
+def clear_balance_cache():
+    'Drop all the balances cached by this process, for changes that bypass the ledger.'
+    cache = get_balance_cache()
+    if cache:
+        cache.clear()
+
+
+def invalidate_cached_balances(addresses):
+    'Drop addresses from the balance cache of this process, if caching is turned on.'
+    cache = get_balance_cache()
+    if cache:
+        cache.invalidate(addresses)
+
+
+def get_balance_cache_stats():
+    'Get the statistics of the balance cache of this process, or None if caching is turned off.'
+    cache = get_balance_cache()
+    return cache.get_stats() if cache else None
+
+
 def get_balance(address):
     'Get the roller balance of an address.'
+    return get_balances([address])[address]
+
+
+def get_balances(addresses):
+    'Get the roller balances of multiple addresses.'
+    addresses = set(addresses)
+    if not addresses:
+        return {}
+    cache = get_balance_cache()
+    balances, version = cache.get(addresses) if cache else ({}, None)
+    missing = [address for address in addresses if address not in balances]
+    if missing:
+        with db.sql_connection() as sql:
+            sql.execute(
+                f"SELECT address, balance FROM balances WHERE address IN ({', '.join(['%s' for address in missing])})",
+                missing)
+            fetched = {row['address']: int(row['balance']) for row in sql.fetchall()}
+        fetched = {address: fetched.get(address, 0) for address in missing}
+        if cache:
+            cache.put(fetched, version)
+        balances.update(fetched)
+    return balances
+
+
+# Filters are all optional keyword arguments, it's fine.
+# pylint: disable=too-many-arguments
+def get_history(address, *, cursor=None, direction='all', since=None, until=None, limit=100):
+    'Get a page of the transactions of an address, newest first, and the cursor of the next page.'
+    parameters = dict(address=address, safe=SAFE, cursor=cursor, since=since, until=until, limit=limit + 1)
+    conditions = [condition for condition, value in [
+        ('idx < %(cursor)s', cursor),
+        ('timestamp >= FROM_UNIXTIME(%(since)s)', since),
+        ('timestamp < FROM_UNIXTIME(%(until)s)', until)
+    ] if value is not None]
+    columns = dict(incoming=['target'], outgoing=['source'], all=['source', 'target'])[direction]
+    # Each branch is a short backwards range scan of an address index, so deep pages cost the same as the first.
+    branches = [f"""(
+        SELECT idx, timestamp, source, target, amount FROM {table}
+        WHERE {' AND '.join([f"{column} = %(address)s"] + conditions)}
+        ORDER BY idx DESC LIMIT %(limit)s
+    )""" for table in ['transactions', 'transactions_archive'] for column in columns]
     with db.sql_connection() as sql:
-        sql.execute("""
-            SELECT COALESCE(SUM(amount), 0) AS sum FROM transactions WHERE target = %(address)s
-            UNION ALL
-            SELECT COALESCE(SUM(amount), 0) AS sum FROM transactions WHERE source = %(address)s
-        """, dict(address=address))
-        credit, debit = (row['sum'] for row in sql.fetchall())
-        return int(credit - debit)
+        sql.execute(f"""
+            SELECT idx, UNIX_TIMESTAMP(timestamp) AS timestamp, source, target, amount, remote_transaction,
+                CASE WHEN source = %(safe)s THEN 'deposit' WHEN target = %(safe)s THEN 'withdrawal' ELSE 'transfer'
+                END AS kind
+            FROM ({' UNION '.join(branches)}) AS page
+            LEFT JOIN ether_transactions ON page.idx = ether_transactions.local_transaction
+            ORDER BY idx DESC LIMIT %(limit)s
+        """, parameters)
+        transactions = [dict(row, amount=int(row['amount'])) for row in sql.fetchall()]
+    next_cursor = transactions[limit - 1]['idx'] if len(transactions) > limit else None
+    return transactions[:limit], next_cursor
+# pylint: enable=too-many-arguments
+
+
+def get_balance_changes(transfers):
+    'Sum the signed balance changes made by transfers.'
+    changes = collections.Counter()
+    for item in transfers:
+        changes[item['source']] -= int(item['amount'])
+        changes[item['target']] += int(item['amount'])
+    return changes
+
+
+def get_balances_update(changes):
+    'Build the query adding signed amounts to the balances of addresses, with its parameters, or None if no change.'
+    # Sorted, so concurrent sessions lock balance rows in the same order.
+    changes = sorted((address, int(change)) for address, change in changes.items() if change != 0)
+    if not changes:
+        return None
+    return f"""
+        INSERT INTO balances(address, balance) VALUES {', '.join(['(%s, %s)' for change in changes])}
+        ON DUPLICATE KEY UPDATE balance = balance + VALUES(balance)
+    """, [value for change in changes for value in change]
+
+
+def log_transfers(transfers):
+    'Log transfers that were accepted.'
+    # Lazily formatted, it is logged for every transfer.
+    for item in transfers:
+        LOGGER.info('transfer %s from %s to %s', item['amount'], item['source'], item['target'])
+
+
+def get_transfers_insert(transfers):
+    'Build the single statement inserting transfers, with its parameters.'
+    return f"""
+        INSERT INTO transactions(source, target, amount) VALUES {', '.join(['(%s, %s, %s)' for item in transfers])}
+    """, [value for item in transfers for value in (item['source'], item['target'], int(item['amount']))]
+
+
+def get_pending_withdrawals_insert(transfers, first_local_transaction):
+    'Build the query recording the withdrawals among inserted transfers as pending, with its parameters, or None.'
+    if not any(item['target'] == SAFE for item in transfers):
+        return None
+    return """
+        INSERT INTO pending_withdrawals(idx, timestamp, address, amount)
+        SELECT idx, timestamp, source, amount FROM transactions
+        WHERE idx BETWEEN %s AND %s AND target = %s
+    """, (first_local_transaction, first_local_transaction + len(transfers) - 1, SAFE)
+
+
+def get_funds_check(debits):
+    'Build the locking read of the balances of debited addresses, with its parameters.'
+    # Locking read, so we see the latest balances and not the session's snapshot.
+    return f"""
+        SELECT address, balance FROM balances WHERE address IN ({', '.join(['%s' for address in debits])})
+        ORDER BY address FOR UPDATE
+    """, list(debits)
+
+
+def check_funds(rows, debits, received):
+    'Raise InsufficientFunds if any address could not cover the debits made from it, given its current balance rows.'
+    balances = {row['address']: int(row['balance']) for row in rows}
+    # Credits from the session must not pay for its debits, so the balance before the session,
+    # which is balance - received + debits, has to be at least debits.
+    overdrawn = [address for address in sorted(debits) if balances.get(address, 0) < received.get(address, 0)]
+    if overdrawn:
+        raise InsufficientFunds(', '.join([
+            f"address {address} has less than {debits[address]} rollers" for address in overdrawn]))
+
+
+def get_transfers_writes(transfers, first_local_transaction, changes):
+    'Build the statements applying inserted transfers, with their balance changes, to balances and pending withdrawals.'
+    return [statement for statement in (
+        get_balances_update(changes), get_pending_withdrawals_insert(transfers, first_local_transaction)) if statement]
+
+
+def update_balances_in_session(changes, sql):
+    'Add signed amounts to the balances of addresses within a running session - no validation!'
+    update = get_balances_update(changes)
+    if update:
+        sql.execute(*update)
+
+
+def insert_transfers_in_session(transfers, sql):
+    'Insert transfers of rollers with a single statement within a running session - no validation!'
+    sql.execute(*get_transfers_insert(transfers))
+    # A single multi row insert is allocated consecutive auto increment values, starting with lastrowid.
+    first_local_transaction = sql.lastrowid
+    changes = get_balance_changes(transfers)
+    for statement in get_transfers_writes(transfers, first_local_transaction, changes):
+        sql.execute(*statement)
+    # Dropped again by the caller once committed, as reads racing the commit may cache the old balances meanwhile.
+    invalidate_cached_balances(changes)
+    return list(range(first_local_transaction, first_local_transaction + len(transfers)))
 
 
 def transfer_in_session(source, target, amount, sql):
     'Transfer rollers from source to target within a running session - no validaiton!'
-    LOGGER.info(f"transfer {amount} from {source} to {target}")
-    sql.execute(
-        "INSERT INTO transactions(source, target, amount) VALUES(%(source)s, %(target)s, %(amount)s)",
-        dict(source=source, target=target, amount=int(amount)))
-    return sql.lastrowid
+    return insert_transfers_in_session([dict(source=source, target=target, amount=amount)], sql)[0]
+
+
+def check_funds_in_session(debits, received, sql):
+    'Raise InsufficientFunds if any address could not cover the debits made from it within a running session.'
+    sql.execute(*get_funds_check(debits))
+    check_funds(sql.fetchall(), debits, received)
+
+
+def get_debits_and_credits(transfers):
+    'Sum the amounts debited from and credited to each address by transfers.'
+    debits, received = collections.Counter(), collections.Counter()
+    for item in transfers:
+        debits[item['source']] += int(item['amount'])
+        received[item['target']] += int(item['amount'])
+    return debits, received
 
 
 def transfer(source, target, amount):
     'Transfer rollers from source to target.'
-    if amount > get_balance(source):
-        raise InsufficientFunds(f"address {source} has less than {amount} rollers")
+    if TRANSFER_BATCH_SIZE > 0:
+        return get_transfer_batcher().apply([dict(source=source, target=target, amount=amount)])[0]
     with db.sql_connection() as sql:
-        return transfer_in_session(source, target, amount, sql)
+        local_transaction = transfer_in_session(source, target, amount, sql)
+        # Checked after writing, under the balance row locks, so concurrent transfers can not overspend.
+        check_funds_in_session({source: amount}, {target: amount}, sql)
+    invalidate_cached_balances([source, target])
+    log_transfers([dict(source=source, target=target, amount=amount)])
+    return local_transaction
+
+
+def transfer_many(transfers):
+    'Transfer rollers between multiple sources and targets in a single transaction - all or nothing.'
+    if not transfers:
+        return []
+    if TRANSFER_BATCH_SIZE > 0:
+        local_transactions = get_transfer_batcher().apply(transfers)
+    else:
+        debits, received = get_debits_and_credits(transfers)
+        with db.sql_connection() as sql:
+            local_transactions = insert_transfers_in_session(transfers, sql)
+            # Writing first locks all balance rows in a consistent order, then funds are checked once per source.
+            check_funds_in_session(debits, received, sql)
+        invalidate_cached_balances(debits.keys() | received.keys())
+        log_transfers(transfers)
+    return [
+        dict(source=item['source'], target=item['target'], amount=int(item['amount']), idx=idx)
+        for item, idx in zip(transfers, local_transactions)]
+
+
+class TransferBatcher:
+    'Apply the transfers of concurrent requests in micro batches, each committed once, from a background thread.'
+
+    def __init__(self, max_size, max_wait_ms):
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.stats = collections.Counter(
+            batches=0, requests=0, transfers=0, insufficient_funds=0, deadlocks=0, failed_batches=0)
+        self.thread = threading.Thread(target=self.run, name='transfer-batcher', daemon=True)
+        self.thread.start()
+
+    def apply(self, transfers):
+        'Queue the transfers of a request, all or nothing, and return their idx list once their batch is committed.'
+        future = concurrent.futures.Future()
+        self.queue.put((transfers, future))
+        try:
+            return future.result(TRANSFER_BATCH_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # Only a request that was not picked up yet can be dropped, one that is being applied may still commit.
+            if future.cancel():
+                raise
+            return future.result()
+
+    def run(self):
+        'Collect requests into batches until the batch is full or the oldest request waited long enough.'
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+            # Requests that timed out before they were picked up are dropped, the rest can no longer be cancelled.
+            batch = [(transfers, future) for transfers, future in batch if future.set_running_or_notify_cancel()]
+            if batch:
+                self.apply_batch(batch, sum(len(transfers) for transfers, _ in batch))
+
+    def apply_batch(self, batch, size):
+        'Apply a batch of requests in a single transaction and release them, one by one if the batch fails.'
+        try:
+            results = self.apply_batch_with_retries(batch)
+        except Exception as exception:  # pylint: disable=broad-except
+            if len(batch) == 1:
+                self.fail_batch(batch, exception)
+                return
+            # Nothing was committed, so each request is applied alone, and a bad one fails alone.
+            LOGGER.warning(f"batch of {len(batch)} transfer requests failed, applying them one by one - {exception}")
+            self.record(failed_batches=1)
+            for transfers, future in batch:
+                self.apply_batch([(transfers, future)], len(transfers))
+            return
+        self.record(
+            batches=1, requests=len(batch), transfers=size,
+            insufficient_funds=len([exception for _, _, exception in results if exception]))
+        # Results are in the order of the batch, and only the requests that had the funds were committed.
+        for (transfers, _), (future, local_transactions, exception) in zip(batch, results):
+            if exception:
+                future.set_exception(exception)
+            else:
+                log_transfers(transfers)
+                future.set_result(local_transactions)
+
+    def apply_batch_with_retries(self, batch):
+        'Apply a batch of requests, retrying it if it deadlocks, and get their results.'
+        retries = 0
+        while True:
+            try:
+                return self.apply_batch_once(batch)
+            except db.pymysql.MySQLError as exception:
+                deadlocked = exception.args[0] == db.pymysql.constants.ER.LOCK_DEADLOCK
+                if not deadlocked or retries == TRANSFER_BATCH_DEADLOCK_RETRIES:
+                    raise
+                retries += 1
+                self.record(deadlocks=1)
+                LOGGER.warning(f"batch of {len(batch)} transfer requests deadlocked, retrying")
+
+    @staticmethod
+    def apply_batch_once(batch):
+        'Apply a batch of requests in a single transaction, each under its own savepoint, and get their results.'
+        results = []
+        with db.sql_connection() as sql:
+            # Each request locks its balance rows in order, but not in order with the other requests of the batch,
+            # so all the rows of the batch are locked first, in the order every other session locks them.
+            addresses = sorted({
+                address for transfers, _ in batch
+                for item in transfers for address in (item['source'], item['target'])})
+            sql.execute(
+                f"SELECT address FROM balances WHERE address IN ({', '.join(['%s'] * len(addresses))}) "
+                'ORDER BY address FOR UPDATE', addresses)
+            for transfers, future in batch:
+                sql.execute('SAVEPOINT request')
+                try:
+                    local_transactions = insert_transfers_in_session(transfers, sql)
+                    # Funds are checked in order, so each request sees the ones before it in the batch.
+                    check_funds_in_session(*get_debits_and_credits(transfers), sql)
+                except InsufficientFunds as exception:
+                    sql.execute('ROLLBACK TO SAVEPOINT request')
+                    results.append((future, None, exception))
+                else:
+                    results.append((future, local_transactions, None))
+        invalidate_cached_balances(addresses)
+        return results
+
+    def fail_batch(self, batch, exception):
+        'Fail all the requests of a batch that was not committed with the same error.'
+        LOGGER.error(f"failed applying a batch of {len(batch)} transfer requests - {exception}", exc_info=exception)
+        self.record(failed_batches=1, requests=len(batch))
+        for _, future in batch:
+            future.set_exception(exception)
+
+    def record(self, **counters):
+        'Add to the batcher statistics.'
+        with self.stats_lock:
+            self.stats.update(counters)
+
+    def get_stats(self):
+        'Get the batcher statistics.'
+        with self.stats_lock:
+            return dict(self.stats, max_size=self.max_size, max_wait_ms=self.max_wait * 1000, queued=self.queue.qsize())
+
+
+TRANSFER_BATCHER = None
+TRANSFER_BATCHER_LOCK = threading.Lock()
+
+
+def get_transfer_batcher():
+    'Get the transfer batcher of this process, starting it if needed.'
+    global TRANSFER_BATCHER  # pylint: disable=global-statement
+    with TRANSFER_BATCHER_LOCK:
+        # Threads do not survive a fork, so a forked process needs its own batcher, as does one whose thread died.
+        if TRANSFER_BATCHER is None or TRANSFER_BATCHER.pid != os.getpid() or not TRANSFER_BATCHER.thread.is_alive():
+            TRANSFER_BATCHER = TransferBatcher(TRANSFER_BATCH_SIZE, TRANSFER_BATCH_WAIT_MS)
+        return TRANSFER_BATCHER
+
+
+def get_balances_query(ledger='transactions', bounded=False):
+    'Build a query for all balances, from a checkpoint and the ledger transactions after it, optionally up to a limit.'
+    until = 'AND idx <= %(until)s' if bounded else ''
+    return f"""
+        SELECT address, SUM(credit) - SUM(debit) AS balance FROM (
+            SELECT address, balance AS credit, 0 AS debit FROM checkpoint_balances WHERE checkpoint = %(checkpoint)s
+            UNION ALL
+            SELECT target AS address, amount AS credit, 0 AS debit FROM {ledger} AS ledger
+            WHERE idx > %(since)s {until}
+            UNION ALL
+            SELECT source AS address, 0 AS credit, amount AS debit FROM {ledger} AS ledger
+            WHERE idx > %(since)s {until}
+        ) AS movements GROUP BY address
+    """
+
+
+def get_latest_checkpoint_in_session(sql):
+    'Get the latest checkpoint within a running session, or an empty one if there are none yet.'
+    sql.execute('SELECT idx, last_transaction FROM checkpoints ORDER BY idx DESC LIMIT 1')
+    return sql.fetchone() or dict(idx=0, last_transaction=0)
+
+
+def compare_balances(stored, computed):
+    'Get the mismatches between two dicts of balances.'
+    return {
+        address: dict(stored=stored.get(address, 0), computed=computed.get(address, 0))
+        for address in set(computed) | set(stored) if stored.get(address, 0) != computed.get(address, 0)}
+
+
+def verify_balances():
+    'Compare the balances table with balances computed from the latest checkpoint and return all mismatches.'
+    with db.sql_connection() as sql:
+        # All reads come from the same transaction snapshot, so concurrent transfers can not cause false alarms.
+        checkpoint = get_latest_checkpoint_in_session(sql)
+        sql.execute(get_balances_query(), dict(checkpoint=checkpoint['idx'], since=checkpoint['last_transaction']))
+        computed = {row['address']: int(row['balance']) for row in sql.fetchall()}
+        sql.execute('SELECT address, balance FROM balances')
+        stored = {row['address']: int(row['balance']) for row in sql.fetchall()}
+    return compare_balances(stored, computed)
+
+
+def rebuild_balances():
+    'Recompute the balances table from the latest checkpoint and return the mismatches that were fixed.'
+    mismatches = verify_balances()
+    if mismatches:
+        LOGGER.warning(f"rebuilding balances, {len(mismatches)} mismatches found: {mismatches}")
+        with db.sql_connection() as sql:
+            checkpoint = get_latest_checkpoint_in_session(sql)
+            sql.execute('DELETE FROM balances')
+            sql.execute(
+                f"INSERT INTO balances(address, balance) {get_balances_query()}",
+                dict(checkpoint=checkpoint['idx'], since=checkpoint['last_transaction']))
+        clear_balance_cache()
+    return mismatches
+
+
+def create_checkpoint():
+    'Store the balances of all addresses as of the last committed transaction, if there are new ones, and return it.'
+    with db.sql_connection() as sql:
+        # Without gap locks, so the locking read below does not hold back new transactions.
+        sql.execute('SET TRANSACTION ISOLATION LEVEL READ COMMITTED')
+        previous = get_latest_checkpoint_in_session(sql)
+        sql.execute('SELECT MAX(idx) AS last_transaction FROM transactions WHERE idx > %s', (
+            previous['last_transaction'],))
+        last_transaction = sql.fetchone()['last_transaction']
+        if last_transaction is None:
+            return None
+        # A transaction still in flight may hold a lower idx than the last committed one, so the range is read with
+        # shared locks, which wait for its rows to commit or roll back before they are counted.
+        sql.execute('SELECT COUNT(*) AS count FROM transactions WHERE idx > %s AND idx <= %s FOR SHARE', (
+            previous['last_transaction'], last_transaction))
+        sql.execute('INSERT INTO checkpoints(last_transaction) VALUES(%s)', (last_transaction,))
+        checkpoint = sql.lastrowid
+        sql.execute(f"""
+            INSERT INTO checkpoint_balances(checkpoint, address, balance)
+            SELECT %(new_checkpoint)s, address, balance FROM ({get_balances_query(bounded=True)}) AS computed
+            WHERE balance != 0
+        """, dict(
+            new_checkpoint=checkpoint, checkpoint=previous['idx'], since=previous['last_transaction'],
+            until=last_transaction))
+        addresses = sql.rowcount
+    LOGGER.info(f"checkpoint {checkpoint} of {addresses} balances up to transaction {last_transaction}")
+    return dict(idx=checkpoint, last_transaction=last_transaction, addresses=addresses)
+
+
+def archive_transactions(age_days=None):
+    'Move settled transactions older than age_days, which are covered by the latest checkpoint, to the archive.'
+    age_days = ARCHIVE_AGE_DAYS if age_days is None else age_days
+    with db.sql_connection() as sql:
+        last_transaction = get_latest_checkpoint_in_session(sql)['last_transaction']
+        sql.execute('SELECT MIN(idx) AS first_transaction FROM transactions')
+        first_transaction = sql.fetchone()['first_transaction']
+    archived = 0
+    if first_transaction is None:
+        return archived
+    # Chunked by idx, so each chunk is a short transaction.
+    for chunk_start in range(first_transaction, last_transaction + 1, ARCHIVE_CHUNK_SIZE):
+        chunk = dict(start=chunk_start, end=min(chunk_start + ARCHIVE_CHUNK_SIZE - 1, last_transaction), age=age_days)
+        with db.sql_connection() as sql:
+            sql.execute("""
+                INSERT INTO transactions_archive SELECT transactions.* FROM transactions
+                LEFT JOIN pending_withdrawals ON transactions.idx = pending_withdrawals.idx
+                WHERE transactions.idx BETWEEN %(start)s AND %(end)s AND pending_withdrawals.idx IS NULL
+                AND transactions.timestamp < NOW() - INTERVAL %(age)s DAY
+            """, chunk)
+            # Delete exactly what was copied, even if a pending withdrawal was settled in between.
+            sql.execute("""
+                DELETE transactions FROM transactions
+                JOIN transactions_archive ON transactions.idx = transactions_archive.idx
+                WHERE transactions.idx BETWEEN %(start)s AND %(end)s
+            """, chunk)
+            archived += sql.rowcount
+    LOGGER.info(f"archived {archived} transactions up to {last_transaction}")
+    return archived
+
+
+def verify_archive():
+    'Recompute each checkpoint from the one before it and the archived and live transactions, and return mismatches.'
+    with db.sql_connection() as sql:
+        sql.execute('SELECT idx, last_transaction FROM checkpoints ORDER BY idx')
+        checkpoints = sql.fetchall()
+    mismatches = {}
+    previous = dict(idx=0, last_transaction=0)
+    for checkpoint in checkpoints:
+        with db.sql_connection() as sql:
+            sql.execute(get_balances_query(LEDGER_WITH_ARCHIVE, bounded=True), dict(
+                checkpoint=previous['idx'], since=previous['last_transaction'],
+                until=checkpoint['last_transaction']))
+            computed = {row['address']: int(row['balance']) for row in sql.fetchall()}
+            sql.execute('SELECT address, balance FROM checkpoint_balances WHERE checkpoint = %s', (checkpoint['idx'],))
+            stored = {row['address']: int(row['balance']) for row in sql.fetchall()}
+        checkpoint_mismatches = compare_balances(stored, computed)
+        if checkpoint_mismatches:
+            mismatches[checkpoint['idx']] = checkpoint_mismatches
+        previous = checkpoint
+    return mismatches
+
+
+def deposit_many_in_session(deposits, sql):
+    'Fund addresses from the safe, with a single statement per table, within a running session - no validation!'
+    transfers = [dict(source=SAFE, target=deposit['address'], amount=deposit['amount']) for deposit in deposits]
+    local_transactions = insert_transfers_in_session(transfers, sql)
+    # Rejected by the unique deposit key if any of the remote transactions was already deposited.
+    sql.execute(f"""
+        INSERT INTO ether_transactions(remote_transaction, local_transaction, kind)
+        VALUES {', '.join(["(%s, %s, 'deposit')" for deposit in deposits])}
+    """, [
+        value for deposit, local_transaction in zip(deposits, local_transactions)
+        for value in (deposit['remote_transaction'], local_transaction)])
+    log_transfers(transfers)
+    return local_transactions
 
 
 def deposit_in_session(address, amount, remote_transaction, sql):
     'Fund an address from the safe within a running session - no validation!.'
-    local_transaction = transfer_in_session(SAFE, address, amount, sql)
-    sql.execute("""
-        INSERT INTO ether_transactions(remote_transaction, local_transaction)
-        VALUES(%(remote_transaction)s, %(local_transaction)s)
-    """, dict(remote_transaction=remote_transaction, local_transaction=local_transaction))
+    return deposit_many_in_session(
+        [dict(address=address, amount=amount, remote_transaction=remote_transaction)], sql)[0]
 
 
-def debug_deposit(address, amount, remote_transaction):
-    'Fund an address from the safe.'
+def debug_deposit(address, amount, remote_transaction=None):
+    'Fund an address from the safe, by a unique fake remote transaction if none is given.'
     with db.sql_connection() as sql:
-        return deposit_in_session(address, amount, remote_transaction, sql)
+        local_transaction = deposit_in_session(
+            address, amount, remote_transaction or f"debug-{uuid.uuid4().hex}", sql)
+    invalidate_cached_balances([SAFE, address])
+    return local_transaction
+
+
+def fetch_deposit_windows(start_block, end_block):
+    'Get deposits in a block window as a list of (start_block, end_block, deposits) windows, split as needed.'
+    try:
+        return [(start_block, end_block, etherscan.get_deposits(SAFE, start_block, end_block))]
+    except etherscan.TruncatedResult:
+        if start_block == end_block:
+            raise ScanError(f"too many transactions in block {start_block}") from None
+        middle_block = (start_block + end_block) // 2
+        return fetch_deposit_windows(start_block, middle_block) + fetch_deposit_windows(middle_block + 1, end_block)
+
+
+def record_deposits(start_block, end_block, deposits):
+    'Credit the deposits found in a block window and record the scan of the window.'
+    local_transactions = []
+    with db.sql_connection() as sql:
+        if deposits:
+            for deposit in deposits:
+                if deposit['amount'] % WEI_DEPOSIT_FOR_ONE_ROLLER != 0:
+                    LOGGER.error(f"non integer deposit - {deposit}")
+            try:
+                local_transactions = deposit_many_in_session([dict(
+                    address=deposit['source'], amount=deposit['amount'] // WEI_DEPOSIT_FOR_ONE_ROLLER,
+                    remote_transaction=deposit['transaction']
+                ) for deposit in deposits], sql)
+            except db.pymysql.IntegrityError as exception:
+                if exception.args[0] != db.pymysql.constants.ER.DUP_ENTRY:
+                    raise
+                LOGGER.error(f"duplicate deposits reported: {exception}")
+                raise ScanError('invalid deposits detected') from None
+
+        sql.execute("""
+            INSERT INTO deposit_scans(start_block, end_block, deposits, first_transaction, last_transaction)
+            VALUES(%s, %s, %s, %s, %s)
+        """, (start_block, end_block, len(deposits), *(
+            (local_transactions[0], local_transactions[-1]) if local_transactions else (None, None))))
+    if deposits:
+        invalidate_cached_balances([SAFE] + [deposit['source'] for deposit in deposits])
+
+
+def get_last_scanned_block():
+    'Get the last block scanned for deposits, or -1 if none was.'
+    with db.sql_connection() as sql:
+        sql.execute('SELECT COALESCE(MAX(end_block), -1) AS end_block FROM deposit_scans')
+        return sql.fetchone()['end_block']
 
 
 def scan_for_deposits(start_block=None, end_block=None):
     'Scan transactions sending ether to the safe, and update deposits accordingly.'
     if start_block is None:
-        with db.sql_connection() as sql:
-            sql.execute('SELECT COALESCE(MAX(end_block) + 1, 0) AS start_block FROM deposit_scans')
-            start_block = sql.fetchone()['start_block']
+        start_block = get_last_scanned_block() + 1
     if end_block is None:
         end_block = etherscan.get_latest_block_number() - REQUIRED_BLOCK_DEPTH
     if end_block < start_block:
         return
 
-    deposits = etherscan.get_deposits(SAFE, start_block, end_block)
-    with db.sql_connection() as sql:
-        if deposits:
-            # Check for duplicate transactions.
-            sql.execute(f"""SELECT 1 FROM ether_transactions WHERE remote_transaction IN (
-                {', '.join(['%s' for i in range(len(deposits))])}
-            ) LIMIT 1""", [deposit['transaction'] for deposit in deposits])
-            if sql.fetchone():
-                LOGGER.error(f"duplicate deposits reported: {[deposit['transaction'] for deposit in deposits]}")
-                raise ScanError('invalid deposits detected')
-
-            for deposit in deposits:
-                if deposit['amount'] % WEI_DEPOSIT_FOR_ONE_ROLLER != 0:
-                    LOGGER.error(f"non integer deposit - {deposit}")
-                roller_amount = deposit['amount'] // WEI_DEPOSIT_FOR_ONE_ROLLER
-                deposit_in_session(deposit['source'], roller_amount, deposit['transaction'], sql)
-
-        sql.execute("""INSERT INTO deposit_scans(start_block, end_block, transactions) VALUES(
-            %(start_block)s, %(end_block)s, %(transactions)s
-        )""", dict(start_block=start_block, end_block=end_block, transactions=json.dumps(deposits)))
+    # Windows are fetched concurrently, but recorded in block order and each in its own transaction,
+    # so an interrupted scan resumes after the last recorded window.
+    window_size = SCAN_WINDOW
+    next_block = start_block
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        try:
+            while pending or next_block <= end_block:
+                while next_block <= end_block and len(pending) < SCAN_WORKERS:
+                    window_end_block = min(next_block + window_size - 1, end_block)
+                    pending.append(executor.submit(fetch_deposit_windows, next_block, window_end_block))
+                    next_block = window_end_block + 1
+                windows = pending.popleft().result()
+                # Shrink the next windows to the size that was small enough, or grow them back if it was not split.
+                if len(windows) > 1:
+                    window_size = min(window_end - window_start + 1 for window_start, window_end, _ in windows)
+                else:
+                    window_size = min(window_size * 2, SCAN_WINDOW)
+                for window in windows:
+                    record_deposits(*window)
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 def withdraw(address, amount):
@@ -111,31 +759,57 @@ def withdraw(address, amount):
     transfer(address, SAFE, amount)
 
 
-def get_unsettled_withdrawals():
-    'Get an aggregated list of all unsettled_withdrawals done at least five days before the end of the month.'
+def get_unsettled_withdrawals(addresses=None):
+    'Get an aggregated list of unsettled withdrawals made five days before the end of the month, optionally by address.'
     withdrawals = collections.defaultdict(list)
+    address_filter, parameters = '', []
+    if addresses is not None:
+        addresses = set(addresses)
+        if not addresses:
+            return withdrawals
+        address_filter = f"AND address IN ({', '.join(['%s' for address in addresses])})"
+        parameters.extend(addresses)
     with db.sql_connection() as sql:
-        sql.execute("""
-            SELECT idx, source AS address, amount FROM transactions
-            LEFT JOIN ether_transactions ON transactions.idx = ether_transactions.local_transaction
-            WHERE target = %(safe)s AND remote_transaction IS NULL AND timestamp <= LAST_DAY(NOW()) - INTERVAL 5 DAY
+        sql.execute(f"""
+            SELECT idx, address, amount FROM pending_withdrawals
+            WHERE {SETTLABLE_WITHDRAWALS_CONDITION} {address_filter}
             ORDER BY idx
-        """, dict(safe=SAFE))
+        """, parameters)
         for withdrawal in sql.fetchall():
             withdrawals[withdrawal.pop('address')].append(withdrawal)
     return withdrawals
 
 
+def get_unsettled_withdrawal_totals():
+    'Iterate over the total unsettled withdrawal of each address, aggregated and streamed by the database.'
+    with db.sql_connection(unbuffered=True) as sql:
+        sql.execute(f"""
+            SELECT address, SUM(amount) AS amount FROM pending_withdrawals
+            WHERE {SETTLABLE_WITHDRAWALS_CONDITION}
+            GROUP BY address ORDER BY address
+        """)
+        yield from sql
+
+
+def count_unsettled_withdrawals():
+    'Count the unsettled withdrawals made five days before the end of the month.'
+    with db.sql_connection() as sql:
+        sql.execute(f"SELECT COUNT(*) AS count FROM pending_withdrawals WHERE {SETTLABLE_WITHDRAWALS_CONDITION}")
+        return sql.fetchone()['count']
+
+
 def roller_to_eth(roller_amount):
     'Convert an amount of rollers to a sell price of eth.'
+    # Imported on first use, it takes longer to import than the rest of this module.
+    import eth_utils  # pylint: disable=import-outside-toplevel
     return eth_utils.from_wei(roller_amount * WEI_WITHDRAW_FOR_ONE_ROLLER, 'ether')
 
 
-def match_settlable_withdrawals(remote_transaction):
+def match_settlable_withdrawals(payments):
     'Match unsettled withdrawals with ether payments made in a multisender call.'
-    candidates = get_unsettled_withdrawals()
+    candidates = get_unsettled_withdrawals({payment['address'] for payment in payments})
     matches = set()
-    for payment in etherscan.get_payments(SAFE, remote_transaction):
+    for payment in payments:
         if payment['amount'] % WEI_WITHDRAW_FOR_ONE_ROLLER != 0:
             LOGGER.error(f"non integer payment - {payment}")
         for withdrawal in candidates[payment['address']]:
@@ -150,17 +824,30 @@ def match_settlable_withdrawals(remote_transaction):
     return matches
 
 
-def settle(remote_transaction):
-    'Mark withdrawals that were settled by remote_transaction as - currently just marks all withdrawals.'
-    settlable = match_settlable_withdrawals(remote_transaction)
+def settle_in_session(remote_transaction, local_transactions, sql):
+    'Mark withdrawals as settled by a remote transaction within a running session.'
+    settled_transactions_count = sql.executemany("""
+        INSERT INTO ether_transactions(remote_transaction, local_transaction, kind)
+        VALUES(%(remote_transaction)s, %(local_transaction)s, 'settlement')""", [
+            dict(remote_transaction=remote_transaction, local_transaction=local_transaction)
+            for local_transaction in local_transactions])
+    pending_count = sql.execute(
+        f"DELETE FROM pending_withdrawals WHERE idx IN ({', '.join(['%s' for idx in local_transactions])})",
+        list(local_transactions))
+    if pending_count != settled_transactions_count:
+        raise SettleError(f"only {pending_count} of {settled_transactions_count} withdrawals are still pending")
+    return settled_transactions_count
+
+
+def settle(remote_transaction, payments=None):
+    'Mark withdrawals that were settled by remote_transaction, fetching its payments if not given.'
+    if payments is None:
+        payments = etherscan.get_payments(SAFE, remote_transaction)
+    settlable = match_settlable_withdrawals(payments)
     settled_transactions_count = 0
     if settlable:
         with db.sql_connection() as sql:
-            settled_transactions_count = sql.executemany("""
-                INSERT INTO ether_transactions(remote_transaction, local_transaction)
-                VALUES(%(remote_transaction)s, %(local_transaction)s)""", [
-                    dict(remote_transaction=remote_transaction, local_transaction=withdrawal_idx)
-                    for withdrawal_idx in settlable])
+            settled_transactions_count = settle_in_session(remote_transaction, sorted(settlable), sql)
     return dict(
         settled_transactions_count=settled_transactions_count,
-        unsettled_transaction_count=len(get_unsettled_withdrawals()))
+        unsettled_transaction_count=count_unsettled_withdrawals())
@@ -1,5 +1,14 @@
 'API definitions for flasgger.'
 
+
+def document(spec):
+    'A decorator attaching a spec to an endpoint, where flasgger looks for it, without importing flasgger.'
+    def decorator(handler):
+        handler.specs_dict = spec
+        return handler
+    return decorator
+
+
 CONFIG = {
     'title': 'roller-balance API',
     'uiversion': 2,
@@ -39,6 +48,52 @@ GET_BALANCE = {
     }
 }
 
+GET_BALANCES = {
+    'description': 'Get the roller balances of multiple ethereum addresses',
+    'parameters': [
+        {
+            'name': 'addresses', 'description': 'A JSON list of the addresses queried',
+            'in': 'formData', 'required': True, 'type': 'string'
+        }
+    ],
+    'responses': {
+        '200': {'description': 'A mapping of the addresses to their roller balances'}
+    }
+}
+
+GET_HISTORY = {
+    'description': 'Get a page of the transaction history of an ethereum address, newest first',
+    'parameters': [
+        {
+            'name': 'address', 'description': 'The address queried',
+            'in': 'formData', 'required': True, 'type': 'string'
+        },
+        {
+            'name': 'cursor', 'description': 'The next_cursor of the previous page, omitted for the first page',
+            'in': 'formData', 'required': False, 'type': 'integer'
+        },
+        {
+            'name': 'direction', 'description': 'Only incoming or outgoing transactions, or all (default)',
+            'in': 'formData', 'required': False, 'type': 'string', 'enum': ['incoming', 'outgoing', 'all']
+        },
+        {
+            'name': 'since', 'description': 'Only transactions made at or after this unix time',
+            'in': 'formData', 'required': False, 'type': 'integer'
+        },
+        {
+            'name': 'until', 'description': 'Only transactions made before this unix time',
+            'in': 'formData', 'required': False, 'type': 'integer'
+        },
+        {
+            'name': 'limit', 'description': 'The page size',
+            'in': 'formData', 'required': False, 'type': 'integer'
+        }
+    ],
+    'responses': {
+        '200': {'description': 'A list of transactions, marked by kind, and the cursor of the next page, if any'}
+    }
+}
+
 TRANSFER = {
     'description': 'Transfer amount from source to target',
     'parameters': [
@@ -60,6 +115,20 @@ TRANSFER = {
     }
 }
 
+TRANSFER_BATCH = {
+    'description': 'Transfer multiple amounts between sources and targets in a single transaction - all or nothing',
+    'parameters': [
+        {
+            'name': 'transfers',
+            'description': 'A JSON list of transfers, each an object with source, target and amount',
+            'in': 'formData', 'required': True, 'type': 'string'
+        }
+    ],
+    'responses': {
+        '201': {'description': 'The transfers were marked, listed with their transaction indices'}
+    }
+}
+
 WITHDRAW = {
     'description': 'Withdraw an amount from the system',
     'parameters': [
@@ -80,11 +149,26 @@ WITHDRAW = {
 GET_UNSETTLED_WITHDRAWALS = {
     'description': 'Get a list of all unsettled withdrawals',
     'tags': ['admin'],
+    'parameters': [
+        {
+            'name': 'format', 'description': 'json (default) for a CSV inside a JSON response, csv to stream the CSV',
+            'in': 'query', 'required': False, 'type': 'string', 'enum': ['json', 'csv']
+        }
+    ],
     'responses': {
         '200': {'description': 'A CSV list of unsettled withdrawals'}
     }
 }
 
+METRICS = {
+    'description': 'Get request, database and etherscan metrics of all server processes, in Prometheus text format',
+    'tags': ['admin'],
+    'produces': ['text/plain'],
+    'responses': {
+        '200': {'description': 'Counters and latency histograms by endpoint, status, query and etherscan action'}
+    }
+}
+
 SETTLE = {
     'description': 'Get a list of all unsettled withdrawals',
     'tags': ['admin'],
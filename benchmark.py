@@ -0,0 +1,435 @@
+'Benchmarks for roller-balance - run only against a test database, they nuke it.'
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import accounting
+import db
+import etherscan
+import fake_etherscan
+import logs
+
+ADDRESSES = [f"{idx:040x}" for idx in range(1, 1001)]
+SEED_CHUNK_SIZE = 10000
+# Time from starting a server process until it serves its first requests.
+STARTUP_BUDGET_MS = float(os.environ.get('ROLLER_STARTUP_BUDGET_MS', 1000))
+# Modules a server process should only import when it first needs them.
+LAZY_MODULES = ['flasgger', 'eth_utils']
+STARTUP_SCRIPT = '''
+import json
+import sys
+import time
+start = time.perf_counter()
+import web
+imported = time.perf_counter()
+with web.APP.test_client() as client:
+    assert client.get('/get_prices').status_code == 200
+    assert client.get('/apispec.json').status_code == 200
+ready = time.perf_counter()
+print(json.dumps(dict(
+    import_ms=1000 * (imported - start), ready_ms=1000 * (ready - start), modules=len(sys.modules),
+    lazy_modules=[module for module in sys.argv[1:] if module in sys.modules])))
+'''
+
+
+def prepare_database():
+    'Recreate the benchmark database.'
+    assert db.DB_NAME[-5:] == '_test', f"will not run benchmarks on non test database {db.DB_NAME}"
+    db.nuke_database_and_create_new_please_think_twice()
+    accounting.clear_balance_cache()
+
+
+def percentile(values, fraction):
+    'Get a percentile of a list of values, using the nearest rank.'
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(latencies, elapsed):
+    'Summarize a list of latencies, in seconds, measured over an elapsed time.'
+    return dict(
+        count=len(latencies), throughput=len(latencies) / elapsed if elapsed else None,
+        p50_ms=1000 * percentile(latencies, .5) if latencies else None,
+        p99_ms=1000 * percentile(latencies, .99) if latencies else None)
+
+
+def legacy_transfer(source, target, amount):
+    'The old check then insert transfer, on two connections, for comparison.'
+    if amount > accounting.get_balance(source):
+        raise accounting.InsufficientFunds(f"address {source} has less than {amount} rollers")
+    with db.sql_connection() as sql:
+        return accounting.transfer_in_session(source, target, amount, sql)
+
+
+# A benchmark driver with a flat argument list, it's fine.
+# pylint: disable=too-many-arguments,too-many-locals
+def contention(*, threads, hot_addresses, transfers, initial_balance, legacy=False, batch_size=0, batch_wait_ms=5):
+    'Hammer a few hot addresses with concurrent transfers and report throughput, conflicts and overspending.'
+    prepare_database()
+    accounting.TRANSFER_BATCH_SIZE, accounting.TRANSFER_BATCH_WAIT_MS = batch_size, batch_wait_ms
+    accounting.TRANSFER_BATCHER = None
+    addresses = ADDRESSES[:hot_addresses]
+    for address in addresses:
+        accounting.debug_deposit(address, initial_balance, f"benchmark-{address}")
+    transfer = legacy_transfer if legacy else accounting.transfer
+    latencies = []
+    outcomes = {'transferred': 0, 'insufficient_funds': 0, 'database_errors': 0}
+    lock = threading.Lock()
+
+    def hammer(seed):
+        randomizer = random.Random(seed)
+        for _ in range(transfers):
+            source, target = randomizer.sample(addresses, 2)
+            start = time.perf_counter()
+            try:
+                transfer(source, target, randomizer.randint(1, initial_balance // 2))
+                outcome = 'transferred'
+            except accounting.InsufficientFunds:
+                outcome = 'insufficient_funds'
+            except db.pymysql.MySQLError:
+                outcome = 'database_errors'
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                outcomes[outcome] += 1
+
+    workers = [threading.Thread(target=hammer, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    balances = accounting.get_balances(addresses)
+    return dict(
+        summarize(latencies, elapsed), **outcomes, elapsed=elapsed,
+        overdrawn_addresses=len([balance for balance in balances.values() if balance < 0]),
+        balance_mismatches=len(accounting.verify_balances()), pool=db.get_pool_stats().get(db.DB_NAME),
+        batcher=accounting.get_transfer_batcher().get_stats() if batch_size > 0 else None)
+# pylint: enable=too-many-arguments,too-many-locals
+
+
+def seed_ledger(rows, addresses, settled_fraction=.9):  # pylint: disable=too-many-locals
+    'Fill a fresh database with a synthetic ledger of deposits, transfers and withdrawals, a month old.'
+    prepare_database()
+    randomizer = random.Random(0)
+    for chunk_start in range(0, rows, SEED_CHUNK_SIZE):
+        transfers, kinds = [], []
+        for _ in range(min(SEED_CHUNK_SIZE, rows - chunk_start)):
+            kind = randomizer.choices(['deposit', 'transfer', 'withdrawal'], [3, 5, 2])[0]
+            user, other_user = randomizer.sample(addresses, 2)
+            source, target = dict(
+                deposit=(accounting.SAFE, user), transfer=(user, other_user), withdrawal=(user, accounting.SAFE))[kind]
+            transfers.append(dict(source=source, target=target, amount=randomizer.randint(1, 100)))
+            kinds.append(kind)
+        with db.sql_connection() as sql:
+            local_transactions = accounting.insert_transfers_in_session(transfers, sql)
+            deposits = [
+                (f"seed-deposit-{local_transaction}", local_transaction)
+                for kind, local_transaction in zip(kinds, local_transactions) if kind == 'deposit']
+            if deposits:
+                sql.executemany("""
+                    INSERT INTO ether_transactions(remote_transaction, local_transaction, kind)
+                    VALUES(%s, %s, 'deposit')
+                """, deposits)
+            settled = [
+                local_transaction for kind, local_transaction in zip(kinds, local_transactions)
+                if kind == 'withdrawal' and randomizer.random() < settled_fraction]
+            if settled:
+                accounting.settle_in_session(f"seed-payout-{chunk_start}", settled, sql)
+    with db.sql_connection() as sql:
+        sql.execute('UPDATE transactions SET timestamp = NOW() - INTERVAL 40 DAY')
+        sql.execute('UPDATE pending_withdrawals SET timestamp = NOW() - INTERVAL 40 DAY')
+
+
+def time_calls(function, arguments_list):
+    'Call a function with each of a list of argument tuples and summarize the latencies.'
+    latencies = []
+    start = time.perf_counter()
+    for arguments in arguments_list:
+        call_start = time.perf_counter()
+        function(*arguments)
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def find_regressions(results, baseline, threshold):
+    'Compare results with a baseline and list the latencies that grew by more than threshold.'
+    regressions = []
+    for name, result in results.items():
+        for key in ['p50_ms', 'p99_ms']:
+            old, new = baseline.get(name, {}).get(key), result.get(key)
+            if old and new and new > old * (1 + threshold):
+                regressions.append(dict(benchmark=name, metric=key, baseline=old, current=new))
+    return regressions
+
+
+# A benchmark driver with a flat argument list, it's fine.
+# pylint: disable=too-many-arguments,too-many-locals
+def hot_paths(*, rows, addresses, iterations, heavy_iterations, scan_blocks, output=None, baseline=None, threshold=.2):
+    'Time the accounting hot paths over a seeded ledger, and optionally compare with a previous run.'
+    users = [f"{idx:040x}" for idx in range(1, addresses + 1)]
+    seed_start = time.perf_counter()
+    seed_ledger(rows, users)
+    seed_seconds = time.perf_counter() - seed_start
+    randomizer = random.Random(1)
+    results = {}
+
+    results['get_balance'] = time_calls(
+        accounting.get_balance, [(randomizer.choice(users),) for _ in range(iterations)])
+
+    funded_users = users[:100]
+    for user in funded_users:
+        accounting.debug_deposit(user, 10**9, f"benchmark-{user}")
+    results['transfer'] = time_calls(
+        accounting.transfer, [(*randomizer.sample(funded_users, 2), 1) for _ in range(iterations)])
+
+    results['get_unsettled_withdrawals'] = time_calls(
+        accounting.get_unsettled_withdrawals, [() for _ in range(heavy_iterations)])
+
+    chain = fake_etherscan.Chain(accounting.SAFE, seed=1, head=10**7, deposits_per_block=5, payouts=0)
+    server = fake_etherscan.serve(chain)
+    original_api, original_cache_path = etherscan.ETHERSCAN_API, etherscan.CACHE_PATH
+    etherscan.ETHERSCAN_API, etherscan.CACHE_PATH = server.url, ''
+    try:
+        results['scan_for_deposits'] = time_calls(accounting.scan_for_deposits, [
+            (start_block, start_block + scan_blocks - 1)
+            for start_block in range(1, heavy_iterations * scan_blocks, scan_blocks)])
+
+        payouts = []
+        for address, withdrawals in list(accounting.get_unsettled_withdrawals().items())[:heavy_iterations]:
+            payouts.append((chain.add_payout([dict(address=address, amount=accounting.WEI_WITHDRAW_FOR_ONE_ROLLER * sum(
+                withdrawal['amount'] for withdrawal in withdrawals))], chain.head - accounting.REQUIRED_BLOCK_DEPTH),))
+        results['settle'] = time_calls(accounting.settle, payouts)
+    finally:
+        etherscan.ETHERSCAN_API, etherscan.CACHE_PATH = original_api, original_cache_path
+        server.shutdown()
+
+    report = dict(
+        meta=dict(
+            rows=rows, addresses=addresses, iterations=iterations, heavy_iterations=heavy_iterations,
+            scan_blocks=scan_blocks, seed_seconds=seed_seconds, time=datetime.datetime.now().isoformat()),
+        results=results, balance_cache=accounting.get_balance_cache_stats())
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as baseline_file:
+            report['regressions'] = find_regressions(results, json.load(baseline_file)['results'], threshold)
+    if output:
+        with open(output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=4)
+    return report
+# pylint: enable=too-many-arguments,too-many-locals
+
+
+def log_transfers(transfers, lazy):
+    'Log transfers like accounting.log_transfers does, or eagerly formatted like it used to, for comparison.'
+    for item in transfers:
+        if lazy:
+            accounting.LOGGER.info('transfer %s from %s to %s', item['amount'], item['source'], item['target'])
+        else:
+            accounting.LOGGER.info(f"transfer {item['amount']} from {item['source']} to {item['target']}")
+
+
+def logging_overhead(calls):
+    'Time logging a transfer, eagerly and lazily formatted, logged directly or through a queue, or filtered out.'
+    transfers = [dict(source=ADDRESSES[0], target=ADDRESSES[1], amount=1)]
+    results = {}
+    original_log_dir = logs.LOG_DIR_NAME
+    try:
+        with tempfile.TemporaryDirectory() as log_dir, open(os.devnull, 'w', encoding='utf-8') as stream:
+            logs.LOG_DIR_NAME = log_dir
+            for mode, use_queue, use_json in [('sync', False, False), ('queue', True, False), ('json', True, True)]:
+                logs.setup(use_queue=use_queue, use_json=use_json, stream=stream)
+                results[f"{mode}_eager"] = time_calls(log_transfers, [(transfers, False)] * calls)
+                results[f"{mode}_lazy"] = time_calls(log_transfers, [(transfers, True)] * calls)
+                if mode == 'sync':
+                    logging.getLogger().setLevel(logging.WARNING)
+                    results['filtered_eager'] = time_calls(log_transfers, [(transfers, False)] * calls)
+                    results['filtered_lazy'] = time_calls(log_transfers, [(transfers, True)] * calls)
+                # Time the logging threads only, the queue is drained after.
+                logs.stop_listener()
+    finally:
+        logs.LOG_DIR_NAME = original_log_dir
+        logs.setup()
+    return dict(results=results, saved_p50_ms=dict(
+        logged=results['sync_eager']['p50_ms'] - results['queue_lazy']['p50_ms'],
+        filtered=results['filtered_eager']['p50_ms'] - results['filtered_lazy']['p50_ms']))
+
+
+def measure_startup(env=None):
+    'Start a fresh server process, serve its first requests, and get how long it took.'
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT, *LAZY_MODULES], env=env, capture_output=True, check=True).stdout
+    return dict(json.loads(output.decode().splitlines()[-1]), process_ms=1000 * (time.perf_counter() - start))
+
+
+def startup(runs, budget_ms=STARTUP_BUDGET_MS):
+    'Time importing the web server and serving its first requests in fresh processes, with a prebuilt API spec.'
+    with tempfile.TemporaryDirectory() as spec_dir:
+        env = dict(os.environ, ROLLER_API_SPEC_PATH=os.path.join(spec_dir, 'apispec.json'))
+        subprocess.run([sys.executable, '-c', 'import web; web.write_api_spec()'], env=env, check=True)
+        measurements = [measure_startup(env) for _ in range(runs)]
+    results = {key: dict(
+        p50_ms=percentile([measurement[key] for measurement in measurements], .5),
+        max_ms=max(measurement[key] for measurement in measurements)
+    ) for key in ['import_ms', 'ready_ms', 'process_ms']}
+    lazy_modules = sorted({module for measurement in measurements for module in measurement['lazy_modules']})
+    regressions = [f"ready in {results['ready_ms']['p50_ms']:.0f}ms, over the {budget_ms:.0f}ms budget"] if (
+        results['ready_ms']['p50_ms'] > budget_ms) else []
+    regressions.extend(f"{module} imported on startup" for module in lazy_modules)
+    return dict(
+        runs=runs, budget_ms=budget_ms, results=results, modules=measurements[-1]['modules'],
+        lazy_modules=lazy_modules, regressions=regressions)
+
+
+def start_server(workers, threads, backlog, pidfile):
+    'Start the production server with uwsgi.ini on a free port, as deploy.sh run does, and get it once it answers.'
+    assert shutil.which('uwsgi'), 'uwsgi is not installed'
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    env = dict(
+        os.environ, ROLLER_PORT=str(port), ROLLER_WORKERS=str(workers), ROLLER_THREADS=str(threads),
+        ROLLER_LISTEN_BACKLOG=str(backlog), ROLLER_PIDFILE=pidfile, ROLLER_RELOAD_MERCY='5')
+    server = subprocess.Popen(  # pylint: disable=consider-using-with
+        ['uwsgi', '--ini', 'uwsgi.ini'], env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            requests.get(f"{url}/get_prices", timeout=1).raise_for_status()
+            return server, url
+        except requests.exceptions.RequestException:
+            time.sleep(.1)
+    stop_server(server)
+    raise RuntimeError(f"server with {workers} workers did not start")
+
+
+def stop_server(server):
+    'Stop a server started by start_server.'
+    server.terminate()
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+# A benchmark driver with a flat argument list, it's fine.
+# pylint: disable=too-many-arguments,too-many-locals
+def load(*, worker_counts, threads, clients, duration, addresses, transfer_fraction, backlog=1024):
+    'Load the production server with balance queries and transfers, and report how throughput scales with workers.'
+    prepare_database()
+    addresses = ADDRESSES[:addresses]
+    with db.sql_connection() as sql:
+        accounting.deposit_many_in_session([
+            dict(address=address, amount=10**9, remote_transaction=f"load-{address}") for address in addresses], sql)
+
+    def hammer(url, seed, deadline, latencies, errors):
+        randomizer = random.Random(seed)
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            source, target = randomizer.sample(addresses, 2)
+            start = time.perf_counter()
+            try:
+                if randomizer.random() < transfer_fraction:
+                    response = session.post(f"{url}/transfer", data=dict(source=source, target=target, amount=1))
+                else:
+                    response = session.post(f"{url}/get_balance", data=dict(address=source))
+                success = response.ok
+            except requests.exceptions.RequestException:
+                success = False
+            (latencies if success else errors).append(time.perf_counter() - start)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as pid_dir:
+        for workers in worker_counts:
+            server, url = start_server(workers, threads, backlog, os.path.join(pid_dir, 'uwsgi.pid'))
+            latencies, errors = [], []
+            try:
+                deadline = time.monotonic() + duration
+                hammers = [threading.Thread(target=hammer, args=(url, seed, deadline, latencies, errors))
+                           for seed in range(clients)]
+                start = time.perf_counter()
+                for hammer_thread in hammers:
+                    hammer_thread.start()
+                for hammer_thread in hammers:
+                    hammer_thread.join()
+                elapsed = time.perf_counter() - start
+            finally:
+                stop_server(server)
+            results[workers] = dict(summarize(latencies, elapsed), errors=len(errors))
+    base_throughput = results[worker_counts[0]]['throughput']
+    return dict(
+        threads=threads, clients=clients, duration=duration, results=results,
+        speedup={workers: result['throughput'] / base_throughput if base_throughput else None
+                 for workers, result in results.items()},
+        balance_mismatches=len(accounting.verify_balances()))
+# pylint: enable=too-many-arguments,too-many-locals
+
+
+def main():
+    'Run a benchmark from the command line and print its results as JSON.'
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(required=True)
+    contention_parser = subparsers.add_parser('contention', help=contention.__doc__)
+    contention_parser.set_defaults(benchmark=contention)
+    contention_parser.add_argument('--threads', type=int, default=32)
+    contention_parser.add_argument('--hot-addresses', type=int, default=4)
+    contention_parser.add_argument('--transfers', type=int, default=100, help='transfers per thread')
+    contention_parser.add_argument('--initial-balance', type=int, default=1000)
+    contention_parser.add_argument('--legacy', action='store_true', help='use the old check then insert transfer')
+    contention_parser.add_argument('--batch-size', type=int, default=0, help='commit transfers in batches this big')
+    contention_parser.add_argument('--batch-wait-ms', type=float, default=5, help='maximal wait for a batch to fill')
+    hot_paths_parser = subparsers.add_parser('hot-paths', help=hot_paths.__doc__)
+    hot_paths_parser.set_defaults(benchmark=hot_paths)
+    hot_paths_parser.add_argument('--rows', type=int, default=10**5, help='ledger size, 10^4 to 10^7 is sensible')
+    hot_paths_parser.add_argument('--addresses', type=int, default=10000)
+    hot_paths_parser.add_argument('--iterations', type=int, default=1000, help='calls to the cheap paths')
+    hot_paths_parser.add_argument('--heavy-iterations', type=int, default=10, help='calls to the expensive paths')
+    hot_paths_parser.add_argument('--scan-blocks', type=int, default=1000, help='blocks in each scan')
+    hot_paths_parser.add_argument('--output', help='save the results as JSON to this file')
+    hot_paths_parser.add_argument('--baseline', help='compare with the results saved in this file')
+    hot_paths_parser.add_argument('--threshold', type=float, default=.2, help='latency growth flagged as regression')
+    logging_parser = subparsers.add_parser('logging', help=logging_overhead.__doc__)
+    logging_parser.set_defaults(benchmark=logging_overhead)
+    logging_parser.add_argument('--calls', type=int, default=10000)
+    load_parser = subparsers.add_parser('load', help=load.__doc__)
+    load_parser.set_defaults(benchmark=load)
+    load_parser.add_argument('--worker-counts', type=int, nargs='+', default=[1, 2, 4, 8], help='workers per run')
+    load_parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    load_parser.add_argument('--clients', type=int, default=32, help='concurrent client connections')
+    load_parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    load_parser.add_argument('--addresses', type=int, default=100)
+    load_parser.add_argument('--transfer-fraction', type=float, default=.1, help='transfers out of all requests')
+    load_parser.add_argument('--backlog', type=int, default=1024, help='listen queue of the server')
+    startup_parser = subparsers.add_parser('startup', help=startup.__doc__)
+    startup_parser.set_defaults(benchmark=startup)
+    startup_parser.add_argument('--runs', type=int, default=10)
+    startup_parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS, help='time to first response')
+    arguments = vars(parser.parse_args())
+    benchmark = arguments.pop('benchmark')
+    results = benchmark(**arguments)
+    print(json.dumps(results, indent=4))
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,35 @@
 'roller-balance database access.'
+import collections
 import contextlib
 import importlib
+import inspect
 import logging
 import os
+import random
 import re
 import subprocess
+import threading
+import time
 
 import pymysql
 
+import metrics
+
 LOGGER = logging.getLogger('roller.db')
 DB_HOST = os.environ.get('ROLLER_DB_HOST', 'localhost')
 DB_USER = os.environ.get('ROLLER_DB_USER', 'root')
 DB_PASS = os.environ.get('ROLLER_DB_PASS', 'pass')
 DB_NAME = os.environ.get('ROLLER_DB_NAME', 'roller')
+POOL_MAX_SIZE = int(os.environ.get('ROLLER_DB_POOL_MAX_SIZE', 10))  # Zero disables pooling.
+POOL_IDLE_TIMEOUT = float(os.environ.get('ROLLER_DB_POOL_IDLE_TIMEOUT', 300))
+POOL_WAIT_TIMEOUT = float(os.environ.get('ROLLER_DB_POOL_WAIT_TIMEOUT', 10))
+POOL_PING_INTERVAL = float(os.environ.get('ROLLER_DB_POOL_PING_INTERVAL', 5))
+# Statements slower than this many milliseconds are logged, 0 to not time statements at all.
+SLOW_QUERY_MS = float(os.environ.get('ROLLER_DB_SLOW_QUERY_MS', 0))
+# Fraction of the sessions whose statements are timed.
+SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('ROLLER_DB_SLOW_QUERY_SAMPLE_RATE', 1))
+SLOW_QUERY_EXPLAIN = os.environ.get('ROLLER_DB_SLOW_QUERY_EXPLAIN', 'false').lower() in ['true', 'yes', 'y', '1']
+SLOW_QUERY_MAX_PARAMETERS_LENGTH = 1000
 MIGRATIONS_DIRECTORY = './migrations'
 
 
@@ -24,24 +41,250 @@ class FailedMigration(Exception):
     'A migration failed.'
 
 
+class PoolExhausted(pymysql.MySQLError):
+    'Timed out waiting for a free pooled connection.'
+
+
+def connect(db_name):
+    'Open a new database connection.'
+    return pymysql.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, database=db_name)
+
+
+class ConnectionPool:  # pylint: disable=too-many-instance-attributes
+    'A bounded, thread-safe pool of connections to a single database.'
+
+    def __init__(self, db_name, max_size, idle_timeout, wait_timeout, ping_interval):
+        self.db_name = db_name
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.ping_interval = ping_interval
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        # Idle connections with the time they were released, most recently released last.
+        self.idle = collections.deque()
+        self.in_use = 0
+        self.stats = collections.Counter(dict.fromkeys(
+            ['created', 'waits', 'timeouts', 'expired', 'discarded', 'failed'], 0))
+
+    def close_expired(self):
+        'Close connections that were idle for too long - must be called with the condition held.'
+        expiry = time.monotonic() - self.idle_timeout
+        while self.idle and self.idle[0][1] < expiry:
+            self.stats['expired'] += 1
+            self.close(self.idle.popleft()[0])
+
+    def acquire(self):
+        'Get a live connection, reusing an idle one if possible and waiting for one if the pool is full.'
+        with self.condition:
+            deadline = time.monotonic() + self.wait_timeout
+            waited = False
+            while True:
+                self.close_expired()
+                if self.idle or self.in_use < self.max_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if not waited:
+                    waited = True
+                    self.stats['waits'] += 1
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    self.stats['timeouts'] += 1
+                    raise PoolExhausted(f"no free connection to {self.db_name} after {self.wait_timeout} seconds")
+            connection, released = self.idle.pop() if self.idle else (None, None)
+            self.in_use += 1
+        try:
+            if connection is None:
+                connection = connect(self.db_name)
+                with self.condition:
+                    self.stats['created'] += 1
+            elif time.monotonic() - released > self.ping_interval:
+                # Reconnects transparently if the server closed the connection.
+                connection.ping(reconnect=True)
+            return connection
+        except pymysql.MySQLError:
+            with self.condition:
+                self.in_use -= 1
+                self.stats['failed'] += 1
+                self.condition.notify()
+            raise
+
+    def release(self, connection, reusable=True):
+        'Return a connection to the pool, or close it if it can not be reused.'
+        with self.condition:
+            self.in_use -= 1
+            if reusable and connection.open:
+                self.idle.append((connection, time.monotonic()))
+            else:
+                self.stats['discarded'] += 1
+                self.close(connection)
+            self.condition.notify()
+
+    def clear(self):
+        'Close all idle connections.'
+        with self.condition:
+            while self.idle:
+                self.close(self.idle.pop()[0])
+
+    @staticmethod
+    def close(connection):
+        'Close a connection, ignoring errors.'
+        try:
+            connection.close()
+        except pymysql.MySQLError:
+            pass
+
+    def get_stats(self):
+        'Get the pool statistics.'
+        with self.condition:
+            return dict(self.stats, max_size=self.max_size, in_use=self.in_use, idle=len(self.idle))
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(db_name):
+    'Get the connection pool for a database in this process, creating it if needed.'
+    with POOLS_LOCK:
+        pool = POOLS.get(db_name)
+        # Connections must never be shared with a forked process.
+        if pool is None or pool.pid != os.getpid():
+            pool = POOLS[db_name] = ConnectionPool(
+                db_name, POOL_MAX_SIZE, POOL_IDLE_TIMEOUT, POOL_WAIT_TIMEOUT, POOL_PING_INTERVAL)
+        return pool
+
+
+def get_pool_stats():
+    'Get the statistics of all connection pools in this process.'
+    with POOLS_LOCK:
+        pools = [pool for pool in POOLS.values() if pool.pid == os.getpid()]
+    return {pool.db_name: pool.get_stats() for pool in pools}
+
+
+def clear_pools():
+    'Close all idle pooled connections.'
+    with POOLS_LOCK:
+        pools = list(POOLS.values())
+        POOLS.clear()
+    for pool in pools:
+        if pool.pid == os.getpid():
+            pool.clear()
+
+
+def normalize_query(query):
+    'Collapse the whitespace and the repeated placeholders of a query, so similar queries look the same.'
+    query = re.sub(r'\s+', ' ', query).strip()
+    query = re.sub(r'%s(, %s)+', '%s, ...', query)
+    return re.sub(r'(\([^()]*\))(, \1)+', r'\1, ...', query)
+
+
+class TimedCursor:
+    'A cursor wrapper logging statements slower than SLOW_QUERY_MS, optionally with their EXPLAIN plan.'
+
+    def __init__(self, cursor, unbuffered):
+        self.cursor = cursor
+        self.unbuffered = unbuffered
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, query, args=None):
+        'Execute a statement and log it if it was slow.'
+        start = time.perf_counter()
+        result = self.cursor.execute(query, args)
+        self.check(query, args, time.perf_counter() - start)
+        return result
+
+    def executemany(self, query, args):
+        'Execute a statement with many parameter sets and log it if it was slow.'
+        start = time.perf_counter()
+        result = self.cursor.executemany(query, args)
+        self.check(query, args, time.perf_counter() - start)
+        return result
+
+    def check(self, query, args, seconds):
+        'Log a statement if it was slower than the threshold.'
+        if seconds * 1000 < SLOW_QUERY_MS:
+            return
+        caller = inspect.currentframe().f_back.f_back
+        parameters = repr(args)
+        if len(parameters) > SLOW_QUERY_MAX_PARAMETERS_LENGTH:
+            parameters = f"{parameters[:SLOW_QUERY_MAX_PARAMETERS_LENGTH]}..."
+        LOGGER.warning(
+            f"slow query took {seconds * 1000:.1f}ms in {caller.f_code.co_name} "
+            f"({os.path.basename(caller.f_code.co_filename)}:{caller.f_lineno}): {normalize_query(query)} "
+            f"with {parameters}{self.explain(query, args)}")
+
+    def explain(self, query, args):
+        'Get the EXPLAIN plan of a statement, formatted for logging, if enabled and possible.'
+        # The rows of an unbuffered cursor are still on the connection, so nothing else can run on it.
+        if not SLOW_QUERY_EXPLAIN or self.unbuffered or not re.match(
+                r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE)\b', query, re.IGNORECASE):
+            return ''
+        if args and not isinstance(args, (dict, tuple)) and isinstance(args[0], (dict, list, tuple)):
+            # Plan executemany statements by their first parameter set.
+            args = args[0]
+        try:
+            with self.cursor.connection.cursor(pymysql.cursors.DictCursor) as explain_cursor:
+                explain_cursor.execute(f"EXPLAIN {query}", args)
+                return f" - plan: {explain_cursor.fetchall()}"
+        except pymysql.MySQLError as exception:
+            return f" - no plan: {exception}"
+
+
+def get_call_site():
+    'Get the name of the function that opened the current database session.'
+    frame = inspect.currentframe().f_back
+    # Skip the session context managers, sync or async, and the contextlib machinery driving them.
+    while frame.f_code.co_name == 'sql_connection' or frame.f_code.co_filename == contextlib.__file__:
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+
 @contextlib.contextmanager
-def sql_connection(db_name=False):
-    'Context manager for querying the database.'
+def sql_connection(db_name=False, unbuffered=False):
+    'Context manager for querying the database, optionally with a server side cursor for streaming large results.'
     # Default to DB_NAME dynamically (not at def time).
     if db_name is False:
         db_name = DB_NAME
+    pool = get_pool(db_name) if POOL_MAX_SIZE > 0 and db_name is not None else None
+    connection = None
+    reusable = True
+    call_site, start, outcome = get_call_site(), time.perf_counter(), 'error'
     try:
-        connection = pymysql.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, database=db_name)
-        yield connection.cursor(pymysql.cursors.DictCursor)
+        connection = pool.acquire() if pool else connect(db_name)
+        cursor = connection.cursor(pymysql.cursors.SSDictCursor if unbuffered else pymysql.cursors.DictCursor)
+        if SLOW_QUERY_MS > 0 and random.random() < SLOW_QUERY_SAMPLE_RATE:
+            cursor = TimedCursor(cursor, unbuffered)
+        yield cursor
+        # An unbuffered cursor has to be drained before the connection can be used again.
+        cursor.close()
         connection.commit()
+        outcome = 'commit'
     except pymysql.MySQLError:
         LOGGER.exception('database error')
-        if 'connection' in locals():
+        if connection is not None:
+            reusable = False
             connection.rollback()
         raise
+    except BaseException:
+        # Never return a connection with uncommitted changes to the pool.
+        if connection is not None:
+            try:
+                connection.rollback()
+            except pymysql.MySQLError:
+                reusable = False
+        raise
     finally:
-        if 'connection' in locals():
-            connection.close()
+        if connection is not None:
+            if pool:
+                pool.release(connection, reusable)
+            else:
+                connection.close()
+        metrics.record_db_session(call_site, outcome, time.perf_counter() - start)
 
 
 def collect_migrations():
@@ -69,6 +312,7 @@ def collect_migrations():
 
 def nuke_database_and_create_new_please_think_twice():
     'Remove and recreate the database completely - only for debug environment.'
+    clear_pools()
     with sql_connection(db_name=None) as sql:
         LOGGER.warning(f"dropping database {DB_NAME}")
         sql.execute(f"DROP DATABASE IF EXISTS {DB_NAME}")
@@ -2,7 +2,7 @@
 # Deploy the roller-balance server.
 
 # Parse options
-usage() { echo "Usage: $0 [s|shell] [t|test] [c|cron] [k|kill-listener] [r|run]"; }
+usage() { echo "Usage: $0 [s|shell] [t|test] [c|cron] [f|follow] [v|verify-balances] [rebuild-balances] [checkpoint] [verify-archive] [k|kill-listener] [r|run] [reload]"; }
 if ! [ "$1" ]; then
     usage
     exit 1
@@ -15,10 +15,22 @@ while [ "$1" ]; do
             _test=1;;
         c|cron)
             cron=1;;
+        f|follow)
+            follow=1;;
+        v|verify-balances)
+            verify_balances=1;;
+        rebuild-balances)
+            rebuild_balances=1;;
+        checkpoint)
+            checkpoint=1;;
+        verify-archive)
+            verify_archive=1;;
         k|kill-listener)
             kill_listener=1;;
         r|run)
             run=1;;
+        reload)
+            reload=1;;
         *)
             usage
             exit 0;;
@@ -32,6 +44,14 @@ pushd "$(dirname "${BASH_SOURCE[0]}")"
 # Load environment.
 . mkenv
 
+# Production server settings, see uwsgi.ini.
+export ROLLER_PORT="${ROLLER_PORT:-8000}"
+export ROLLER_WORKERS="${ROLLER_WORKERS:-$(nproc)}"
+export ROLLER_THREADS="${ROLLER_THREADS:-4}"
+export ROLLER_LISTEN_BACKLOG="${ROLLER_LISTEN_BACKLOG:-1024}"
+export ROLLER_PIDFILE="${ROLLER_PIDFILE:-/tmp/roller-uwsgi.pid}"
+export ROLLER_RELOAD_MERCY="${ROLLER_RELOAD_MERCY:-30}"
+
 if [ "$shell" ]; then
     echo -e "\n===  OPENING A PYTHON SHELL ===\n"
     python -ic "
@@ -60,6 +80,50 @@ accounting.scan_for_deposits()
 EOF
 fi
 
+if [ "$follow" ]; then
+    echo -e "\n===  FOLLOWING THE CHAIN HEAD ===\n"
+    python follower.py >/dev/null &
+    echo "Follower running as $! - stop it with kill $!"
+    disown
+fi
+
+if [ "$verify_balances" ] || [ "$rebuild_balances" ]; then
+    python <<EOF || exit 1
+import sys
+import accounting
+import logs
+logs.setup()
+mismatches = accounting.rebuild_balances() if '$rebuild_balances' else accounting.verify_balances()
+for address, balances in sorted(mismatches.items()):
+    print(f"{address}: stored {balances['stored']}, computed {balances['computed']}")
+sys.exit(1 if mismatches and not '$rebuild_balances' else 0)
+EOF
+fi
+
+if [ "$checkpoint" ]; then
+    python <<EOF || exit 1
+import accounting
+import logs
+logs.setup()
+print(accounting.create_checkpoint())
+print(f"archived {accounting.archive_transactions()} transactions")
+EOF
+fi
+
+if [ "$verify_archive" ]; then
+    python <<EOF || exit 1
+import sys
+import accounting
+import logs
+logs.setup()
+mismatches = accounting.verify_archive()
+for checkpoint, balances in sorted(mismatches.items()):
+    for address, balance in sorted(balances.items()):
+        print(f"checkpoint {checkpoint} {address}: stored {balance['stored']}, computed {balance['computed']}")
+sys.exit(1 if mismatches else 0)
+EOF
+fi
+
 if [ "$kill_listener" ]; then
     port=${ROLLER_PORT:-8000}
     signal=15
@@ -84,15 +148,28 @@ if [ "$run" ]; then
     port=${ROLLER_PORT:-8000}
     [ -z "$kill_listener" ] && $0 kill-listener || exit 1
     echo -e "\n===  RUNNING WEB SERVER on 0.0.0.0:$port ===\n"
-    if [ "$ROLLER_DEBUG" ] && [ "$ROLLER_DEBUG" != 0 ] && [ "$ROLLER_DEBUG" != n ]; then
+    # Gauges of the processes of a previous run would add up with the new ones, those of a running follower are kept.
+    python -c 'import metrics; metrics.clear_dead_processes()' || exit 1
+    # Prebuilt, so server processes serve the API spec without importing flasgger.
+    python -c 'import web; web.write_api_spec()' || exit 1
+    if [ "$ROLLER_ASYNC" ] && [ "$ROLLER_ASYNC" != 0 ] && [ "$ROLLER_ASYNC" != n ]; then
+        uvicorn --host 0.0.0.0 --port $port web_async:APP >/dev/null &
+        disown
+    elif [ "$ROLLER_DEBUG" ] && [ "$ROLLER_DEBUG" != 0 ] && [ "$ROLLER_DEBUG" != n ]; then
         FLASK_APP=web FLASK_ENV=development flask run --host "0.0.0.0" --port $port &
         disown
     else
-        uwsgi --http :$port --mount /rollerwebserver=web:APP >/dev/null &
+        uwsgi --ini uwsgi.ini >/dev/null &
         disown
     fi
     sleep 1
     echo "Currently listening on port $port:"
     lsof -i4TCP:$port -sTCP:LISTEN -t | xargs ps -fp
 fi
+
+if [ "$reload" ]; then
+    echo -e "\n===  RELOADING WEB SERVER GRACEFULLY ===\n"
+    python -c 'import web; web.write_api_spec()' || exit 1
+    uwsgi --reload "$ROLLER_PIDFILE"
+fi
 popd
@@ -1,14 +1,33 @@
 'Etherscan blockchain services for roller-balance.'
+import collections
+import contextlib
 import json
 import logging
 import os
+import random
+import sqlite3
+import threading
+import time
 
 import requests
+import requests.adapters
+
+import metrics
 
 LOGGER = logging.getLogger('roller.etherscan')
-ETHERSCAN_API_KEY = os.environ['ROLLER_ETHERSCAN_API_KEY']
-ETHERSCAN_API = 'https://api-ropsten.etherscan.io/api'
+ETHERSCAN_API = os.environ.get('ROLLER_ETHERSCAN_API', 'https://api-ropsten.etherscan.io/api')
 ETHERSCAN_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+# Rate limits are per process, so divide Etherscan's limit by the number of processes calling it.
+RATE_LIMIT = float(os.environ.get('ROLLER_ETHERSCAN_RATE_LIMIT', 5))  # Calls per second.
+RATE_BURST = int(os.environ.get('ROLLER_ETHERSCAN_RATE_BURST', 5))
+MAX_RETRIES = int(os.environ.get('ROLLER_ETHERSCAN_MAX_RETRIES', 5))
+BACKOFF = float(os.environ.get('ROLLER_ETHERSCAN_BACKOFF', .5))  # Seconds before first retry, doubled on each retry.
+TIMEOUT = float(os.environ.get('ROLLER_ETHERSCAN_TIMEOUT', 30))
+POOL_SIZE = int(os.environ.get('ROLLER_ETHERSCAN_POOL_SIZE', 10))
+TXLIST_LIMIT = 10000  # Etherscan never returns more transactions than this in a single txlist call.
+REQUIRED_BLOCK_DEPTH = 10  # Transactions at least this deep are considered final and never change.
+CACHE_PATH = os.environ.get('ROLLER_ETHERSCAN_CACHE', 'etherscan_cache.sqlite')  # Empty to disable caching.
+CACHE_MAX_ENTRIES = int(os.environ.get('ROLLER_ETHERSCAN_CACHE_MAX_ENTRIES', 100000))
 
 
 class EtherscanError(Exception):
@@ -18,33 +37,271 @@ class EtherscanError(Exception):
         self.data = data
 
 
-def call(module, action, **kwargs):
-    'Call etherscan API and return a parsed response.'
-    response = None
+class TruncatedResult(EtherscanError):
+    'Etherscan returned as many results as it can, so some may be missing.'
+
+
+class TransientError(Exception):
+    'Etherscan is throttling us or failing temporarily, so the call is worth retrying.'
+
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    'A thread-safe token bucket rate limiter.'
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        'Take a token, possibly one that is not there yet, and return the seconds to wait before using it.'
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self):
+        'Take a token, waiting for one if needed, and return the time waited in seconds.'
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class ResponseCache:
+    'A persistent, size bounded, least recently used cache of immutable etherscan results.'
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = collections.Counter(hits=0, misses=0, stores=0, evictions=0)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses(key TEXT PRIMARY KEY, result TEXT NOT NULL, accessed REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)')
+
+    @staticmethod
+    def make_key(module, action, kwargs):
+        'Make a cache key for an etherscan call to the current endpoint.'
+        # Results of other endpoints, like a local stand-in, must never be mistaken for those of the real one.
+        return json.dumps([ETHERSCAN_API, module, action, sorted(kwargs.items())])
+
+    def get(self, module, action, kwargs):
+        'Get a cached result, or None if it is not cached.'
+        key = self.make_key(module, action, kwargs)
+        with self.lock:
+            row = self.connection.execute('SELECT result FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, module, action, kwargs, result):
+        'Cache a result, evicting the least recently used results if the cache is full.'
+        key = self.make_key(module, action, kwargs)
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses(key, result, accessed) VALUES(?, ?, ?)',
+                (key, json.dumps(result), time.time()))
+            self.stats['stores'] += 1
+            excess = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)',
+                    (excess,))
+                self.stats['evictions'] += excess
+
+    def get_stats(self):
+        'Get the cache statistics.'
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return dict(self.stats, entries=entries, max_entries=self.max_entries)
+
+
+RATE_LIMITER = TokenBucket(RATE_LIMIT, RATE_BURST)
+LATEST_BLOCK_NUMBER = 0  # The highest block number seen so far, which can only grow.
+SESSIONS = {}
+CACHES = {}
+STATS = collections.defaultdict(lambda: collections.Counter(
+    calls=0, retries=0, failures=0, latency_seconds=0, max_latency_seconds=0))
+STATS_LOCK = threading.Lock()
+
+
+def get_api_key():
+    'Get the etherscan API key - read on use, so that importing this module does not require it.'
+    return os.environ['ROLLER_ETHERSCAN_API_KEY']
+
+
+def get_session():
+    'Get a keep-alive session with a connection pool for this process.'
+    # Sockets must never be shared with a forked process.
+    session = SESSIONS.get(os.getpid())
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+        SESSIONS.clear()
+        SESSIONS[os.getpid()] = session
+    return session
+
+
+def get_cache():
+    'Get the response cache of this process, or None if caching is disabled.'
+    if not CACHE_PATH:
+        return None
+    cache = CACHES.get(os.getpid())
+    # Connections must never be shared with a forked process.
+    if cache is None or cache.path != CACHE_PATH:
+        cache = ResponseCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+        CACHES.clear()
+        CACHES[os.getpid()] = cache
+    return cache
+
+
+def get_cache_stats():
+    'Get the response cache hits, misses, stores and evictions.'
+    cache = get_cache()
+    return cache.get_stats() if cache else None
+
+
+def get_stats():
+    'Get per action counters of calls, retries, failures and latency.'
+    with STATS_LOCK:
+        return {action: dict(stats) for action, stats in STATS.items()}
+
+
+def record_call(action, **counters):
+    'Add to the counters of an action.'
+    with STATS_LOCK:
+        stats = STATS[action]
+        stats.update(counters)
+        stats['max_latency_seconds'] = max(stats['max_latency_seconds'], counters.get('latency_seconds', 0))
+
+
+def post(module, action, **kwargs):
+    'Make a single rate limited request to etherscan and return its result.'
+    RATE_LIMITER.acquire()
+    try:
+        response = get_session().post(ETHERSCAN_API, headers=ETHERSCAN_HEADERS, timeout=TIMEOUT, data=dict(
+            apikey=get_api_key(), module=module, action=action, **kwargs))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exception:
+        raise TransientError(type(exception).__name__) from None
+    except requests.exceptions.RequestException:
+        LOGGER.exception('etherscan error')
+        raise EtherscanError(f"failed getting {module}.{action}", data=dict(response=None)) from None
+    return parse_response(module, action, response)
+
+
+def parse_response(module, action, response):
+    'Get the result out of an etherscan response, of requests or of any HTTP client with the same interface.'
+    if response.status_code == 429 or response.status_code >= 500:
+        raise TransientError(f"http status {response.status_code}")
     try:
-        response = requests.post(ETHERSCAN_API, headers=ETHERSCAN_HEADERS, data=dict(
-            apikey=ETHERSCAN_API_KEY, module=module, action=action, **kwargs))
-        return response.json()['result']
-    except (KeyError, ValueError, json.decoder.JSONDecodeError, requests.exceptions.RequestException):
+        result = response.json()['result']
+    except (KeyError, ValueError, json.decoder.JSONDecodeError):
         LOGGER.exception('etherscan error')
         raise EtherscanError(f"failed getting {module}.{action}", data=dict(response=response)) from None
+    if isinstance(result, str) and 'rate limit' in result.lower():
+        raise TransientError(result)
+    return result
+
+
+def call(module, action, cache_if=None, **kwargs):
+    'Call etherscan API and return a parsed response, cached if cache_if(response) says it can never change.'
+    cache = get_cache() if cache_if else None
+    if cache:
+        result = cache.get(module, action, kwargs)
+        if result is not None:
+            return result
+    result = call_remote(module, action, **kwargs)
+    if cache and result is not None and cache_if(result):
+        cache.put(module, action, kwargs, result)
+    return result
+
+
+def call_remote(module, action, **kwargs):
+    'Call etherscan API and return a parsed response, retrying with exponential backoff if throttled.'
+    with recorded_call(action):
+        attempt = 0
+        while True:
+            try:
+                return post(module, action, **kwargs)
+            except TransientError as exception:
+                time.sleep(get_retry_delay(module, action, attempt, exception))
+                attempt += 1
+
+
+@contextlib.contextmanager
+def recorded_call(action):
+    'Context manager recording a call to etherscan, its latency and whether it failed.'
+    record_call(action, calls=1)
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    except EtherscanError:
+        record_call(action, failures=1)
+        raise
+    finally:
+        latency = time.perf_counter() - start
+        record_call(action, latency_seconds=latency)
+        metrics.record_etherscan_call(action, outcome, latency)
+
+
+def get_retry_delay(module, action, attempt, exception):
+    'Get the exponential backoff before retrying a throttled call, or raise EtherscanError if retries ran out.'
+    if attempt >= MAX_RETRIES:
+        LOGGER.error(f"giving up on {module}.{action} after {attempt + 1} attempts - {exception}")
+        raise EtherscanError(f"failed getting {module}.{action}", data=dict(error=str(exception))) from None
+    delay = BACKOFF * 2 ** attempt * random.uniform(.5, 1.5)
+    LOGGER.warning(f"retrying {module}.{action} in {delay:.2f} seconds - {exception}")
+    record_call(action, retries=1)
+    return delay
 
 
 def get_latest_block_number():
     'Get the number of the latest block.'
-    block_number_hex = call('proxy', 'eth_blockNumber')
+    return record_block_number(call('proxy', 'eth_blockNumber'))
+
+
+def record_block_number(block_number_hex):
+    'Parse the number of the latest block, and keep it if it is the highest seen so far.'
+    global LATEST_BLOCK_NUMBER  # pylint: disable=global-statement
     try:
-        return int(block_number_hex, 16)
+        block_number = int(block_number_hex, 16)
     except ValueError:
         LOGGER.exception(f"got bad block number - {block_number_hex}")
         raise EtherscanError('bad last block', data=dict(block_number_hex=block_number_hex)) from None
+    LATEST_BLOCK_NUMBER = max(LATEST_BLOCK_NUMBER, block_number)
+    return block_number
+
+
+def is_final(block_number):
+    'Check if a block is deep enough in the chain to never change, asking etherscan only if needed.'
+    if LATEST_BLOCK_NUMBER - block_number < REQUIRED_BLOCK_DEPTH:
+        get_latest_block_number()
+    return LATEST_BLOCK_NUMBER - block_number >= REQUIRED_BLOCK_DEPTH
 
 
 def get_deposits(address, start_block, end_block):
     'Get all ether payments made to address.'
-    LOGGER.info(f"scanning from {start_block} to {end_block}")
+    LOGGER.info('scanning from %s to %s', start_block, end_block)
     tx_list = call(
-        'account', 'txlist', address=f"0x{address}", startblock=start_block, endblock=end_block, sort='asc')
+        'account', 'txlist', cache_if=lambda _: is_final(end_block),
+        address=f"0x{address}", startblock=start_block, endblock=end_block, sort='asc')
+    if len(tx_list) >= TXLIST_LIMIT:
+        raise TruncatedResult(
+            f"more than {TXLIST_LIMIT} transactions between {start_block} and {end_block}",
+            data=dict(start_block=start_block, end_block=end_block))
     return [dict(
         source=transaction['from'][2:], amount=int(transaction['value']),
         block_number=int(transaction['blockNumber']), transaction=transaction['hash'][2:]
@@ -54,12 +311,30 @@ def get_deposits(address, start_block, end_block):
         int(transaction['value'], 10) > 0)]
 
 
-def get_payments(target_address, transaction_hash):
-    'Get a list of all payments made in a multisender call.'
-    transaction = call('proxy', 'eth_getTransactionByHash', txhash=f"0x{transaction_hash}")
+def is_confirmed(transaction):
+    'Check if a transaction is deep enough in the chain to never change.'
+    return isinstance(transaction, dict) and bool(transaction.get('blockNumber')) and is_final(
+        int(transaction['blockNumber'], 16))
+
+
+def is_sent_by(transaction, target_address):
+    'Check that a transaction was sent by an address, logging an error if not.'
     if transaction['from'].lower() != f"0x{target_address.lower()}":
         LOGGER.error(f"transaction sender is {transaction['from']} and not {target_address} as specified")
-        return []
+        return False
+    return True
+
+
+def parse_payments(internal_calls):
+    'Get the payments made by the internal calls of a multisender call.'
     return [
-        dict(address=internal_call['to'][2:], amount=int(internal_call['value']))
-        for internal_call in call('account', 'txlistinternal', txhash=f"0x{transaction_hash}")]
+        dict(address=internal_call['to'][2:], amount=int(internal_call['value'])) for internal_call in internal_calls]
+
+
+def get_payments(target_address, transaction_hash):
+    'Get a list of all payments made in a multisender call.'
+    transaction = call('proxy', 'eth_getTransactionByHash', cache_if=is_confirmed, txhash=f"0x{transaction_hash}")
+    if not is_sent_by(transaction, target_address):
+        return []
+    return parse_payments(call(
+        'account', 'txlistinternal', cache_if=lambda _: is_confirmed(transaction), txhash=f"0x{transaction_hash}"))
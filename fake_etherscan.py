@@ -0,0 +1,258 @@
+'A local stand-in for the etherscan API, serving a synthetic chain, for testing and benchmarking.'
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+LOGGER = logging.getLogger('roller.fake_etherscan')
+WEI_DEPOSIT_UNIT = 1*10**14  # Generated deposits are whole rollers.
+WEI_PAYMENT_UNIT = 7*10**13  # Generated payments are whole rollers.
+TXLIST_LIMIT = 10000
+MULTISEND_CONTRACT = 'a5025faba6e70b84f74e9b1113e5f7f4e7f4859f'
+
+
+def make_hash(*parts):
+    'Make a deterministic 64 characters hex hash out of some values.'
+    return hashlib.sha256('-'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class Chain:  # pylint: disable=too-many-instance-attributes
+    'A deterministic synthetic chain of deposits into a safe and multisend payouts out of it.'
+
+    # It's a configuration holder, so it's okay.
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self, safe, *, seed=0, head=1000000, deposits_per_block=.1, addresses=1000,
+        payouts=100, payments_per_payout=100, block_time=None
+    ):
+        self.safe = safe.lower()
+        self.seed = seed
+        self.initial_head = head
+        self.deposits_per_block = deposits_per_block
+        self.addresses = addresses
+        self.payments_per_payout = payments_per_payout
+        self.block_time = block_time
+        self.started = time.monotonic()
+        self.payouts = {}
+        for idx in range(payouts):
+            block_number = (idx + 1) * head // (payouts + 1)
+            randomizer = random.Random(make_hash(seed, 'payout', idx))
+            self.add_payout([dict(
+                address=self.get_address(randomizer.randrange(addresses)),
+                amount=randomizer.randint(1, 100) * WEI_PAYMENT_UNIT
+            ) for _ in range(payments_per_payout)], block_number, make_hash(seed, 'payout', idx))
+    # pylint: enable=too-many-arguments
+
+    @property
+    def head(self):
+        'The current head block number, which advances with time if a block time is set.'
+        if self.block_time:
+            return self.initial_head + int((time.monotonic() - self.started) / self.block_time)
+        return self.initial_head
+
+    def get_address(self, idx):
+        'Get the address of a synthetic user.'
+        return make_hash(self.seed, 'address', idx)[:40]
+
+    def get_block_transactions(self, block_number):
+        'Get all the transactions of the safe in a block, in etherscan txlist format.'
+        randomizer = random.Random(make_hash(self.seed, 'block', block_number))
+        count = int(self.deposits_per_block) + (randomizer.random() < self.deposits_per_block % 1)
+        transactions = []
+        for idx in range(count):
+            source, target = self.get_address(randomizer.randrange(self.addresses)), self.safe
+            value, is_error = randomizer.randint(1, 100) * WEI_DEPOSIT_UNIT, '0'
+            # Sprinkle in transactions that are not valid deposits.
+            noise = randomizer.random()
+            if noise < .02:
+                is_error = '1'
+            elif noise < .04:
+                value = 0
+            elif noise < .06:
+                source, target = target, source
+            transactions.append({
+                'blockNumber': str(block_number), 'timeStamp': str(1600000000 + block_number * 13),
+                'hash': f"0x{make_hash(self.seed, 'deposit', block_number, idx)}", 'transactionIndex': str(idx),
+                'from': f"0x{source}", 'to': f"0x{target}", 'value': str(value),
+                'isError': is_error, 'txreceipt_status': '0' if is_error == '1' else '1'})
+        return transactions
+
+    def get_deposits(self, start_block, end_block):
+        'Get the valid deposits in a block range, in the format returned by etherscan.get_deposits.'
+        return [dict(
+            source=transaction['from'][2:], amount=int(transaction['value']),
+            block_number=int(transaction['blockNumber']), transaction=transaction['hash'][2:]
+        ) for transaction in self.txlist(start_block, end_block, limit=None) if (
+            transaction['to'] == f"0x{self.safe}" and transaction['isError'] == '0' and transaction['value'] != '0')]
+
+    def txlist(self, start_block, end_block, limit=TXLIST_LIMIT):
+        'Get the transactions of the safe in a block range, up to a limit.'
+        transactions = []
+        for block_number in range(max(start_block, 0), min(end_block, self.head) + 1):
+            transactions.extend(self.get_block_transactions(block_number))
+            if limit is not None and len(transactions) >= limit:
+                return transactions[:limit]
+        return transactions
+
+    def add_payout(self, payments, block_number, transaction_hash=None):
+        'Add a multisend payout of a list of payments from the safe and return its transaction hash.'
+        transaction_hash = transaction_hash or make_hash(self.seed, 'custom payout', len(self.payouts))
+        self.payouts[transaction_hash] = dict(block_number=block_number, payments=payments)
+        return transaction_hash
+
+    def get_transaction(self, transaction_hash):
+        'Get a payout transaction, in eth_getTransactionByHash format, or None.'
+        payout = self.payouts.get(transaction_hash)
+        if payout is None or payout['block_number'] > self.head:
+            return None
+        return {
+            'blockNumber': hex(payout['block_number']), 'hash': f"0x{transaction_hash}",
+            'from': f"0x{self.safe}", 'to': f"0x{MULTISEND_CONTRACT}",
+            'value': hex(sum(payment['amount'] for payment in payout['payments']))}
+
+    def get_internal_transactions(self, transaction_hash):
+        'Get the internal transactions of a payout, in txlistinternal format.'
+        payout = self.payouts.get(transaction_hash)
+        if payout is None or payout['block_number'] > self.head:
+            return []
+        return [{
+            'blockNumber': str(payout['block_number']), 'hash': f"0x{transaction_hash}",
+            'from': f"0x{MULTISEND_CONTRACT}", 'to': f"0x{payment['address']}", 'value': str(payment['amount']),
+            'isError': '0'
+        } for payment in payout['payments']]
+
+
+class Faults:  # pylint: disable=too-few-public-methods
+    'Latency, error and rate limit injection.'
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.window = (0, 0)
+
+    def is_throttled(self):
+        'Count a call and check if it exceeds the rate limit for the current second.'
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            second, count = self.window
+            now = int(time.monotonic())
+            self.window = (now, count + 1 if second == now else 1)
+            return self.window[1] > self.rate_limit
+
+
+def make_result(module, action, arguments, chain):
+    'Make the response payload of an etherscan call.'
+    if module == 'proxy' and action == 'eth_blockNumber':
+        return dict(jsonrpc='2.0', id=83, result=hex(chain.head))
+    if module == 'proxy' and action == 'eth_getTransactionByHash':
+        return dict(jsonrpc='2.0', id=1, result=chain.get_transaction(arguments['txhash'][2:].lower()))
+    if module == 'account' and action in ['txlist', 'txlistinternal']:
+        if action == 'txlist':
+            if arguments['address'][2:].lower() != chain.safe:
+                transactions = []
+            else:
+                transactions = chain.txlist(int(arguments['startblock']), int(arguments['endblock']))
+        else:
+            transactions = chain.get_internal_transactions(arguments['txhash'][2:].lower())
+        if transactions:
+            return dict(status='1', message='OK', result=transactions)
+        return dict(status='0', message='No transactions found', result=[])
+    return dict(status='0', message='NOTOK', result='Error! Missing Or invalid Action name')
+
+
+def make_handler(chain, faults):
+    'Make a request handler class serving a chain with injected faults.'
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        'Etherscan API request handler.'
+
+        def respond(self, arguments):
+            'Respond to an API call.'
+            if faults.latency:
+                time.sleep(faults.latency)
+            if faults.error_rate and random.random() < faults.error_rate:
+                self.send_error(502, 'injected error')
+                return
+            if faults.is_throttled():
+                payload = dict(status='0', message='NOTOK', result='Max rate limit reached')
+            else:
+                try:
+                    payload = make_result(arguments.get('module'), arguments.get('action'), arguments, chain)
+                except (KeyError, ValueError):
+                    payload = dict(status='0', message='NOTOK', result='Error! Invalid parameters')
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Names are dictated by BaseHTTPRequestHandler.
+        # pylint: disable=invalid-name
+        def do_GET(self):
+            'Handle a GET API call.'
+            self.respond(dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query)))
+
+        def do_POST(self):
+            'Handle a POST API call.'
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+            self.respond(dict(urllib.parse.parse_qsl(body)))
+        # pylint: enable=invalid-name
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            'Log requests to our logger instead of stderr.'
+            LOGGER.debug(format, *args)
+
+    return Handler
+
+
+def serve(chain, host='127.0.0.1', port=0, faults=None):
+    'Start serving a chain in a background thread and return the server - its URL is in server.url.'
+    server = http.server.ThreadingHTTPServer((host, port), make_handler(chain, faults or Faults()))
+    server.daemon_threads = True
+    server.url = f"http://{server.server_address[0]}:{server.server_address[1]}/api"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    LOGGER.info(f"serving a fake etherscan on {server.url}")
+    return server
+
+
+def main():
+    'Serve a synthetic chain from the command line.'
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('safe', help='the address of the safe')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--head', type=int, default=1000000, help='the initial head block number')
+    parser.add_argument('--block-time', type=float, help='seconds between new blocks, the head is fixed if not set')
+    parser.add_argument('--deposits-per-block', type=float, default=.1)
+    parser.add_argument('--addresses', type=int, default=1000, help='number of depositing addresses')
+    parser.add_argument('--payouts', type=int, default=100)
+    parser.add_argument('--payments-per-payout', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of calls failing with HTTP 502')
+    parser.add_argument('--rate-limit', type=int, help='calls per second allowed before throttling')
+    arguments = parser.parse_args()
+    chain = Chain(
+        arguments.safe, seed=arguments.seed, head=arguments.head, deposits_per_block=arguments.deposits_per_block,
+        addresses=arguments.addresses, payouts=arguments.payouts,
+        payments_per_payout=arguments.payments_per_payout, block_time=arguments.block_time)
+    server = serve(chain, arguments.host, arguments.port, Faults(
+        arguments.latency, arguments.error_rate, arguments.rate_limit))
+    print(f"serving on {server.url} - set ROLLER_ETHERSCAN_API to it")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
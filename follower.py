@@ -0,0 +1,101 @@
+'A resident deposit scanner, following the chain head instead of scanning from cron.'
+import argparse
+import os
+import signal
+import threading
+import time
+
+import accounting
+import etherscan
+import logs
+import metrics
+
+LOGGER = logs.logging.getLogger('roller.follower')
+MIN_INTERVAL = float(os.environ.get('ROLLER_FOLLOWER_MIN_INTERVAL', 2))  # Seconds between polls while blocks arrive.
+MAX_INTERVAL = float(os.environ.get('ROLLER_FOLLOWER_MAX_INTERVAL', 60))  # Seconds between polls when idle.
+# Blocks scanned in a single poll, so a follower far behind the head still checks for shutdown between polls.
+MAX_BLOCKS_PER_POLL = int(os.environ.get('ROLLER_FOLLOWER_MAX_BLOCKS_PER_POLL', accounting.SCAN_WINDOW * 10))
+
+
+class Follower:
+    'Scan new final blocks for deposits, polling faster while blocks arrive and slower when idle.'
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, max_blocks=MAX_BLOCKS_PER_POLL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_blocks = max_blocks
+        self.interval = min_interval
+        self.failures = 0
+        self.stopping = threading.Event()
+
+    def poll(self):
+        'Scan the next final blocks, and return the number of blocks scanned and the number left to scan.'
+        head = etherscan.get_latest_block_number()
+        start_block = accounting.get_last_scanned_block() + 1
+        final_block = head - accounting.REQUIRED_BLOCK_DEPTH
+        end_block = min(final_block, start_block + self.max_blocks - 1)
+        if end_block >= start_block:
+            accounting.scan_for_deposits(start_block, end_block)
+        scanned_block = max(end_block, start_block - 1)
+        metrics.FOLLOWER_HEAD_BLOCK.set(head)
+        metrics.FOLLOWER_SCANNED_BLOCK.set(scanned_block)
+        metrics.FOLLOWER_LAG_BLOCKS.set(head - scanned_block)
+        return scanned_block - start_block + 1, final_block - scanned_block
+
+    def step(self):
+        'Poll once and pick the wait before the next poll - none while behind, short after new blocks, longer if idle.'
+        try:
+            scanned, remaining = self.poll()
+        # A resident process must outlive any single failure, it retries with a backoff.
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception(f"deposit scan failed, retrying in up to {self.max_interval} seconds")
+            self.failures += 1
+            scanned = remaining = 0
+        else:
+            self.failures = 0
+            metrics.FOLLOWER_LAST_SUCCESS.set(time.time())
+        if remaining > 0:
+            self.interval = 0
+        elif scanned > 0:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(max(self.interval * 2, self.min_interval), self.max_interval)
+        metrics.FOLLOWER_POLL_INTERVAL.set(self.interval)
+        metrics.FOLLOWER_FAILURES.set(self.failures)
+        metrics.FOLLOWER_HEALTHY.set(0 if self.failures else 1)
+        return self.interval
+
+    def run(self):
+        'Poll until stopped.'
+        LOGGER.info(f"following the chain head every {self.min_interval} to {self.max_interval} seconds")
+        while not self.stopping.is_set():
+            self.stopping.wait(self.step())
+        LOGGER.info('stopped following the chain head')
+
+    def stop(self, *_):
+        'Stop after the current poll - can be used as a signal handler.'
+        self.stopping.set()
+
+
+def main():
+    'Follow the chain head from the command line until terminated.'
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL, help='seconds between polls when busy')
+    parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL, help='seconds between polls when idle')
+    parser.add_argument('--max-blocks', type=int, default=MAX_BLOCKS_PER_POLL, help='blocks scanned in one poll')
+    parser.add_argument('--metrics-port', type=int, help='serve the metrics of the follower on this port')
+    arguments = parser.parse_args()
+    logs.setup()
+    if arguments.metrics_port:
+        metrics.serve(arguments.metrics_port)
+    follower = Follower(arguments.min_interval, arguments.max_interval, arguments.max_blocks)
+    signal.signal(signal.SIGTERM, follower.stop)
+    signal.signal(signal.SIGINT, follower.stop)
+    try:
+        follower.run()
+    finally:
+        metrics.mark_process_dead(os.getpid())
+
+
+if __name__ == '__main__':
+    main()
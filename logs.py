@@ -1,30 +1,77 @@
 'Logging defaults.'
+import atexit
+import json
 import logging
+import logging.handlers
 import os
-
-import coloredlogs
+import queue
 
 LOG_DIR_NAME = os.environ.get('ROLLER_LOG_DIR', './')
 LOG_FILE_NAME = os.environ.get('ROLLER_LOG_FILE', 'roller.log')
 FORMAT = os.environ.get('ROLLER_LOG_FMT', '%(asctime)s %(levelname).3s: %(message)s - %(name)s +%(lineno)03d')
 DATE_FORMAT = os.environ.get('ROLLER_LOG_DATE_FMT', '%Y-%m-%d %H:%M:%S')
 LEVEL = os.environ.get('ROLLER_LOG_LEVEL', logging.DEBUG)
+# Hand records to a background thread, so logging threads never wait for disk or terminal I/O.
+QUEUE = os.environ.get('ROLLER_LOG_QUEUE', 'false').lower() in ['true', 'yes', 'y', '1']
+# Log one JSON object per line instead of FORMAT, for log collectors.
+JSON = os.environ.get('ROLLER_LOG_JSON', 'false').lower() in ['true', 'yes', 'y', '1']
+# Writes the records of the queue to the real handlers, if logging through a queue, and the process that started it.
+LISTENER = None
+LISTENER_PID = None
+
+
+class JsonFormatter(logging.Formatter):
+    'Format records as single line JSON objects.'
+
+    def format(self, record):
+        entry = dict(
+            time=self.formatTime(record, self.datefmt), level=record.levelname, logger=record.name,
+            message=record.getMessage(), module=record.module, line=record.lineno, process=record.process,
+            thread=record.threadName)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    'A queue handler for a listener in the same process, which leaves all the formatting to the listener thread.'
+
+    def prepare(self, record):
+        # The record is never pickled, so its message does not have to be formatted here.
+        return record
 
 
-def setup(suppress_loggers=None):
-    """Setup the root logger."""
+def stop_listener():
+    'Stop the queue listener, if running, after it handles all queued records.'
+    global LISTENER  # pylint: disable=global-statement
+    # The thread of the listener is not copied to forked processes, only the parent can stop it.
+    if LISTENER is not None and LISTENER_PID == os.getpid():
+        LISTENER.stop()
+    LISTENER = None
+
+
+def setup(suppress_loggers=None, use_queue=None, use_json=None, stream=None):
+    """Setup the root logger, through a queue and in JSON if set by the arguments or by the environment."""
+    global LISTENER, LISTENER_PID  # pylint: disable=global-statement
+    use_queue = QUEUE if use_queue is None else use_queue
+    use_json = JSON if use_json is None else use_json
+
     # Colored logs for terminal. Do this first, because it messes with the logger's level.
-    stream_formatter = coloredlogs.ColoredFormatter(
-        fmt=FORMAT, datefmt=DATE_FORMAT, level_styles={
-            'info': {'color': 'green'}, 'warning': {'color': 'yellow', 'bold': True},
-            'error': {'color': 'red', 'bold': True}, 'critical': {'color': 'red', 'bold': True},
-            'mail': {'color': 'cyan', 'bold': True}, 'watch': {'color': 'magenta', 'bold': True}
-        }, field_styles={'name': {'color': 'cyan'}, 'lineno': {'color': 'cyan'}})
-    stream_handler = logging.StreamHandler()
+    if use_json:
+        stream_formatter = JsonFormatter(datefmt=DATE_FORMAT)
+    else:
+        import coloredlogs  # pylint: disable=import-outside-toplevel
+        stream_formatter = coloredlogs.ColoredFormatter(
+            fmt=FORMAT, datefmt=DATE_FORMAT, level_styles={
+                'info': {'color': 'green'}, 'warning': {'color': 'yellow', 'bold': True},
+                'error': {'color': 'red', 'bold': True}, 'critical': {'color': 'red', 'bold': True},
+                'mail': {'color': 'cyan', 'bold': True}, 'watch': {'color': 'magenta', 'bold': True}
+            }, field_styles={'name': {'color': 'cyan'}, 'lineno': {'color': 'cyan'}})
+    stream_handler = logging.StreamHandler(stream)
     stream_handler.setFormatter(stream_formatter)
 
     # Logging to file.
-    file_formatter = logging.Formatter(FORMAT, DATE_FORMAT)
+    file_formatter = JsonFormatter(datefmt=DATE_FORMAT) if use_json else logging.Formatter(FORMAT, DATE_FORMAT)
     file_handler = logging.FileHandler(os.path.join(LOG_DIR_NAME, LOG_FILE_NAME))
     file_handler.setFormatter(file_formatter)
 
@@ -33,8 +80,21 @@ def setup(suppress_loggers=None):
         for logger_name in suppress_loggers:
             logging.getLogger(logger_name).setLevel(logging.WARNING)
 
+    stop_listener()
+    handlers = [stream_handler, file_handler]
+    if use_queue:
+        log_queue = queue.SimpleQueue()
+        LISTENER = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        LISTENER.start()
+        LISTENER_PID = os.getpid()
+        handlers = [LocalQueueHandler(log_queue)]
+
     logger = logging.getLogger()
     logger.handlers = []
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    for handler in handlers:
+        logger.addHandler(handler)
     logger.setLevel(LEVEL)
+
+
+# Flush the queue on exit.
+atexit.register(stop_listener)
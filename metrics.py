@@ -0,0 +1,126 @@
+'Prometheus metrics, aggregated across all the processes of a server if ROLLER_METRICS_DIR is set.'
+import glob
+import os
+
+# The client picks how it stores values when it is imported, so the shared directory has to be set first.
+METRICS_DIR = os.environ.get('ROLLER_METRICS_DIR')
+if METRICS_DIR:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = METRICS_DIR
+    # Values are stored in it as they are created, some of them on import.
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+import prometheus_client  # noqa: E402 pylint: disable=wrong-import-position
+import prometheus_client.multiprocess  # noqa: E402 pylint: disable=wrong-import-position
+
+# Database sessions are mostly sub millisecond lookups, so their buckets start lower than the default.
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REQUESTS = prometheus_client.Counter('roller_requests', 'API requests.', ['endpoint', 'status'])
+REQUEST_SECONDS = prometheus_client.Histogram('roller_request_seconds', 'API request latency.', ['endpoint'])
+DB_SESSIONS = prometheus_client.Counter('roller_db_sessions', 'Database sessions.', ['query', 'outcome'])
+DB_SESSION_SECONDS = prometheus_client.Histogram(
+    'roller_db_session_seconds', 'Database session latency, including waiting for a connection.', ['query'],
+    buckets=DB_BUCKETS)
+ETHERSCAN_CALLS = prometheus_client.Counter('roller_etherscan_calls', 'Etherscan calls.', ['action', 'outcome'])
+ETHERSCAN_CALL_SECONDS = prometheus_client.Histogram(
+    'roller_etherscan_call_seconds', 'Etherscan call latency, including retries.', ['action'])
+BALANCE_CACHE_LOOKUPS = prometheus_client.Counter(
+    'roller_balance_cache_lookups', 'Balances looked up in the balance cache.', ['result'])
+BALANCE_CACHE_DROPS = prometheus_client.Counter(
+    'roller_balance_cache_drops', 'Balances dropped from the balance cache.', ['reason'])
+
+# The follower is a single process, so its gauges are summed over live processes, and dropped when it exits.
+FOLLOWER_HEAD_BLOCK = prometheus_client.Gauge(
+    'roller_follower_head_block', 'Latest block seen by the deposit follower.', multiprocess_mode='livesum')
+FOLLOWER_SCANNED_BLOCK = prometheus_client.Gauge(
+    'roller_follower_scanned_block', 'Last block scanned for deposits.', multiprocess_mode='livesum')
+FOLLOWER_LAG_BLOCKS = prometheus_client.Gauge(
+    'roller_follower_lag_blocks', 'Blocks between the head and the last scanned block.', multiprocess_mode='livesum')
+FOLLOWER_POLL_INTERVAL = prometheus_client.Gauge(
+    'roller_follower_poll_interval_seconds', 'Current wait between polls.', multiprocess_mode='livesum')
+FOLLOWER_FAILURES = prometheus_client.Gauge(
+    'roller_follower_consecutive_failures', 'Polls that failed since the last successful one.',
+    multiprocess_mode='livesum')
+FOLLOWER_LAST_SUCCESS = prometheus_client.Gauge(
+    'roller_follower_last_success_timestamp_seconds', 'Time of the last successful poll.', multiprocess_mode='livesum')
+FOLLOWER_HEALTHY = prometheus_client.Gauge(
+    'roller_follower_healthy', '1 if the last poll of the follower succeeded, 0 if not.', multiprocess_mode='livesum')
+
+
+def record_request(endpoint, status, seconds):
+    'Record an API request.'
+    REQUESTS.labels(endpoint, status).inc()
+    REQUEST_SECONDS.labels(endpoint).observe(seconds)
+
+
+def record_db_session(query, outcome, seconds):
+    'Record a database session.'
+    DB_SESSIONS.labels(query, outcome).inc()
+    DB_SESSION_SECONDS.labels(query).observe(seconds)
+
+
+def record_etherscan_call(action, outcome, seconds):
+    'Record an etherscan call.'
+    ETHERSCAN_CALLS.labels(action, outcome).inc()
+    ETHERSCAN_CALL_SECONDS.labels(action).observe(seconds)
+
+
+def record_balance_cache_lookups(hits, misses):
+    'Record balances looked up in the balance cache.'
+    if hits:
+        BALANCE_CACHE_LOOKUPS.labels('hit').inc(hits)
+    if misses:
+        BALANCE_CACHE_LOOKUPS.labels('miss').inc(misses)
+
+
+def record_balance_cache_drop(reason, count=1):
+    'Record balances dropped from the balance cache.'
+    if count:
+        BALANCE_CACHE_DROPS.labels(reason).inc(count)
+
+
+def get_registry():
+    'Get a registry collecting the metrics of all processes, or just of this one if there is no shared directory.'
+    if not METRICS_DIR:
+        return prometheus_client.REGISTRY
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render():
+    'Render the metrics in the Prometheus text format, and get its content type.'
+    return prometheus_client.generate_latest(get_registry()), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def serve(port):
+    'Serve the metrics over HTTP from a background thread, for processes without a web server.'
+    prometheus_client.start_http_server(port, registry=get_registry())
+
+
+def mark_process_dead(pid):
+    'Drop the gauges of a process that exited from the shared directory, if there is one.'
+    if METRICS_DIR:
+        prometheus_client.multiprocess.mark_process_dead(pid)
+
+
+def is_alive(pid):
+    'Check if a process is running.'
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def clear_dead_processes():
+    'Drop the gauges of all processes that left files in the shared directory and are no longer running.'
+    if not METRICS_DIR:
+        return
+    # Files are named after the type of the values they store and the process that stored them.
+    pids = {int(os.path.splitext(path)[0].rsplit('_', 1)[-1]) for path in glob.glob(os.path.join(METRICS_DIR, '*.db'))}
+    for pid in pids:
+        if not is_alive(pid):
+            mark_process_dead(pid)
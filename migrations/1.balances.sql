@@ -0,0 +1,12 @@
+-- Materialized per-address balances, maintained by the ledger and backfilled from it.
+CREATE TABLE balances(
+    address CHAR(40) NOT NULL,
+    balance DECIMAL(65) NOT NULL,
+    PRIMARY KEY(address));
+
+INSERT INTO balances(address, balance)
+    SELECT address, SUM(credit) - SUM(debit) AS balance FROM (
+        SELECT target AS address, amount AS credit, 0 AS debit FROM transactions
+        UNION ALL
+        SELECT source AS address, 0 AS credit, amount AS debit FROM transactions
+    ) AS movements GROUP BY address;
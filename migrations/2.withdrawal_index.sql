@@ -0,0 +1,2 @@
+-- Finding the withdrawals of specific addresses without scanning all the withdrawals to the safe.
+CREATE INDEX transactions_source_target ON transactions(source, target);
@@ -0,0 +1,23 @@
+'Keeping unsettled withdrawals in their own table, so listing them does not walk the settled history.'
+import os
+
+import db
+
+
+def apply():
+    'Create the pending withdrawals table and backfill it with the unsettled withdrawals to the safe.'
+    with db.sql_connection() as sql:
+        sql.execute("""
+            CREATE TABLE pending_withdrawals(
+                idx BIGINT UNSIGNED NOT NULL,
+                timestamp TIMESTAMP NOT NULL,
+                address CHAR(40) NOT NULL,
+                amount DECIMAL(65) UNSIGNED NOT NULL,
+                PRIMARY KEY(idx),
+                INDEX(timestamp, address),
+                INDEX(address, timestamp))""")
+        sql.execute("""
+            INSERT INTO pending_withdrawals(idx, timestamp, address, amount)
+            SELECT idx, timestamp, source, amount FROM transactions
+            LEFT JOIN ether_transactions ON transactions.idx = ether_transactions.local_transaction
+            WHERE target = %s AND remote_transaction IS NULL""", (os.environ.get('ROLLER_SAFE_ADDRESS'),))
@@ -0,0 +1,2 @@
+-- Covering index for summing pending withdrawals by address without reading the table rows.
+ALTER TABLE pending_withdrawals DROP INDEX address, ADD INDEX address_timestamp_amount(address, timestamp, amount);
@@ -0,0 +1,18 @@
+-- Periodic per-address balance checkpoints, and an archive for old transactions that are covered by them.
+CREATE TABLE checkpoints(
+    idx SERIAL,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    last_transaction BIGINT UNSIGNED NOT NULL,
+    UNIQUE(last_transaction));
+
+CREATE TABLE checkpoint_balances(
+    checkpoint BIGINT UNSIGNED NOT NULL,
+    address CHAR(40) NOT NULL,
+    balance DECIMAL(65) NOT NULL,
+    PRIMARY KEY(checkpoint, address),
+    FOREIGN KEY(checkpoint) REFERENCES checkpoints(idx));
+
+CREATE TABLE transactions_archive LIKE transactions;
+
+-- Settlements and deposits of archived transactions stay in place, for duplicate checks.
+ALTER TABLE ether_transactions DROP FOREIGN KEY ether_transactions_ibfk_1;
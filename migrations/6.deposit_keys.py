@@ -0,0 +1,35 @@
+'Rejecting duplicate deposits with a unique key instead of a lookup, and recording scans without copying deposits.'
+import os
+
+import db
+
+
+def apply():
+    'Add the kind of ether transactions with a unique key for deposits, and replace the deposit copies of scans.'
+    with db.sql_connection() as sql:
+        # Debug deposits all used to have the same fake remote transaction.
+        sql.execute("""
+            UPDATE ether_transactions SET remote_transaction = CONCAT('debug-', local_transaction)
+            WHERE remote_transaction = 'debug deposit'""")
+        sql.execute("ALTER TABLE ether_transactions ADD COLUMN kind ENUM('deposit', 'settlement') NOT NULL")
+        sql.execute("""
+            UPDATE ether_transactions JOIN (
+                SELECT idx, source FROM transactions_archive
+                UNION ALL
+                SELECT idx, source FROM transactions
+            ) AS ledger ON ether_transactions.local_transaction = ledger.idx
+            SET kind = IF(ledger.source = %s, 'deposit', 'settlement')""", (os.environ.get('ROLLER_SAFE_ADDRESS'),))
+        # A settlement has a row for each withdrawal it pays, so only deposits are unique.
+        sql.execute("""
+            ALTER TABLE ether_transactions
+            ADD COLUMN deposit_key CHAR(64) AS (IF(kind = 'deposit', remote_transaction, NULL)) STORED,
+            ADD UNIQUE(deposit_key)""")
+
+        # Scans made before this migration keep their deposit count, but not their transaction range.
+        sql.execute("""
+            ALTER TABLE deposit_scans
+            ADD COLUMN deposits INT UNSIGNED NOT NULL DEFAULT 0,
+            ADD COLUMN first_transaction BIGINT UNSIGNED,
+            ADD COLUMN last_transaction BIGINT UNSIGNED""")
+        sql.execute('UPDATE deposit_scans SET deposits = COALESCE(JSON_LENGTH(transactions), 0)')
+        sql.execute('ALTER TABLE deposit_scans DROP COLUMN transactions')
@@ -0,0 +1,3 @@
+-- Pending withdrawals are looked up in their own table, so nothing reads the ledger by source and target anymore.
+DROP INDEX transactions_source_target ON transactions;
+DROP INDEX transactions_source_target ON transactions_archive;
@@ -1,18 +1,28 @@
-'Tests for roller-balance server.'
+'Tests for roller-balance server.'  # pylint: disable=too-many-lines
 import collections
+import concurrent.futures
 import decimal
+import multiprocessing
 import os.path
+import subprocess
+import sys
+import time
 import uuid
 
 # pylint: disable=unused-import
 import pytest
 # pylint: enable=unused-import
+import starlette.testclient
 
 import accounting
+import benchmark
 import db
 import etherscan
+import fake_etherscan
+import follower
 import logs
 import web
+import web_async
 
 LOGGER = logs.logging.getLogger('roller.test')
 ADDRESSES = [40*str(digit) for digit in range(10)]
@@ -40,10 +50,21 @@ PAYMENTS_ADDRESS_INVALID = 'd59af98e9b8885829aa5924e482549e2c24a50b9'
 PAYMENT_TRANSACTION_INVALID = '17e9cdbec1030c129d8bf8d64b9a5fc54fce60d2b84ddf6f14a4b68384d197f2'
 
 
+class FakeResponse:  # pylint: disable=too-few-public-methods
+    'A fake etherscan response.'
+    def __init__(self, status_code, payload):
+        self.status_code, self.payload = status_code, payload
+
+    def json(self):
+        'Get the payload.'
+        return self.payload
+
+
 def initialize_test_database():
     'Initialize the database for testing.'
     assert db.DB_NAME[-5:] == '_test', f"will not run accounting tests on non test database {db.DB_NAME}"
     db.nuke_database_and_create_new_please_think_twice()
+    accounting.clear_balance_cache()
 
 
 def get_last_transaction_idx():
@@ -99,6 +120,348 @@ def test_accounting_basic():
     assert accounting.get_unsettled_withdrawals() == withdrawals
 
 
+def test_balances():
+    'Test the materialized balances table.'
+    initialize_test_database()
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+    accounting.transfer(ADDRESSES[0], ADDRESSES[1], 3)
+    accounting.transfer(ADDRESSES[1], ADDRESSES[1], 1)
+    accounting.withdraw(ADDRESSES[1], 2)
+    assert accounting.get_balance(ADDRESSES[0]) == 7
+    assert accounting.get_balance(ADDRESSES[1]) == 1
+    assert accounting.get_balance(accounting.SAFE) == -8
+    assert accounting.verify_balances() == {}
+    assert accounting.rebuild_balances() == {}
+
+    with db.sql_connection() as sql:
+        sql.execute('UPDATE balances SET balance = 5 WHERE address = %s', (ADDRESSES[0],))
+        sql.execute('DELETE FROM balances WHERE address = %s', (ADDRESSES[1],))
+    mismatches = {
+        ADDRESSES[0]: dict(stored=5, computed=7),
+        ADDRESSES[1]: dict(stored=0, computed=1)}
+    assert accounting.verify_balances() == mismatches
+    assert accounting.rebuild_balances() == mismatches
+    assert accounting.verify_balances() == {}
+    assert accounting.get_balance(ADDRESSES[0]) == 7
+    assert accounting.get_balance(ADDRESSES[1]) == 1
+
+
+def get_balance_cache_samples():
+    'Get the balance cache hits, misses and evictions exported as metrics.'
+    registry = web.metrics.prometheus_client.REGISTRY
+    return (
+        registry.get_sample_value('roller_balance_cache_lookups_total', dict(result='hit')) or 0,
+        registry.get_sample_value('roller_balance_cache_lookups_total', dict(result='miss')) or 0,
+        registry.get_sample_value('roller_balance_cache_drops_total', dict(reason='eviction')) or 0)
+
+
+def test_balance_cache(monkeypatch):
+    'Test caching balances, invalidating them on local writes and expiring them to see writes of other processes.'
+    initialize_test_database()
+    monkeypatch.setattr(accounting, 'BALANCE_CACHE_SIZE', 2)
+    monkeypatch.setattr(accounting, 'BALANCE_CACHE', None)
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+    accounting.get_balance_cache().ttl = 3600
+    before = get_balance_cache_samples()
+    assert accounting.get_balance(ADDRESSES[0]) == 10
+    assert accounting.get_balances(ADDRESSES[:2]) == {ADDRESSES[0]: 10, ADDRESSES[1]: 0}
+    assert accounting.get_balance(ADDRESSES[2]) == 0
+    stats = accounting.get_balance_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (1, 3, 1, 2)
+    assert [count - before_count for count, before_count in zip(get_balance_cache_samples(), before)] == [1, 3, 1]
+
+    # Local writes invalidate immediately.
+    accounting.transfer(ADDRESSES[0], ADDRESSES[1], 3)
+    assert accounting.get_balances(ADDRESSES[:2]) == {ADDRESSES[0]: 7, ADDRESSES[1]: 3}
+
+    # Writes of other processes are seen once the cached balances expire.
+    with db.sql_connection() as sql:
+        transfers = [dict(source=ADDRESSES[0], target=ADDRESSES[1], amount=1)]
+        sql.execute(*accounting.get_transfers_insert(transfers))
+        accounting.update_balances_in_session(accounting.get_balance_changes(transfers), sql)
+    assert accounting.get_balance(ADDRESSES[0]) == 7
+    cache = accounting.get_balance_cache()
+    cache.entries = collections.OrderedDict((address, (balance, 0)) for address, (balance, _) in cache.entries.items())
+    assert accounting.get_balances(ADDRESSES[:2]) == {ADDRESSES[0]: 6, ADDRESSES[1]: 4}
+    stats = accounting.get_balance_cache_stats()
+    assert (stats['invalidations'], stats['expirations']) == (1, 2)
+
+    monkeypatch.setattr(accounting, 'BALANCE_CACHE_SIZE', 0)
+    assert accounting.get_balance_cache_stats() is None
+    assert accounting.get_balance(ADDRESSES[0]) == 6
+
+
+def test_transfer_log(caplog):
+    'Test logging only the transfers that were accepted.'
+    initialize_test_database()
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+    with caplog.at_level(logs.logging.INFO, logger='roller.accounting'):
+        with pytest.raises(accounting.InsufficientFunds):
+            accounting.transfer(ADDRESSES[1], ADDRESSES[0], 1)
+        accounting.transfer(ADDRESSES[0], ADDRESSES[1], 3)
+    assert [record.getMessage() for record in caplog.records] == [f"transfer 3 from {ADDRESSES[0]} to {ADDRESSES[1]}"]
+
+
+def test_slow_query_log(monkeypatch, caplog):
+    'Test logging slow statements with their call site and plan.'
+    assert db.normalize_query("""
+        INSERT INTO balances(address, balance) VALUES (%s, %s), (%s, %s)
+    """) == 'INSERT INTO balances(address, balance) VALUES (%s, ...), ...'
+    initialize_test_database()
+    monkeypatch.setattr(db, 'SLOW_QUERY_MS', 1e-6)
+    monkeypatch.setattr(db, 'SLOW_QUERY_EXPLAIN', True)
+    with caplog.at_level(logs.logging.WARNING, logger='roller.db'):
+        assert accounting.get_balances(ADDRESSES[:3]) == dict.fromkeys(ADDRESSES[:3], 0)
+        assert len(list(accounting.get_unsettled_withdrawal_totals())) == 0
+    messages = [record.getMessage() for record in caplog.records]
+    assert [message for message in messages if (
+        'in get_balances (accounting.py:' in message and 'WHERE address IN (%s, ...)' in message and
+        f"'{ADDRESSES[0]}'" in message and ' - plan: ' in message)]
+    # Unbuffered statements are timed but not explained.
+    assert [message for message in messages if (
+        'in get_unsettled_withdrawal_totals' in message and ' - plan: ' not in message)]
+
+    caplog.clear()
+    monkeypatch.setattr(db, 'SLOW_QUERY_SAMPLE_RATE', 0)
+    with caplog.at_level(logs.logging.WARNING, logger='roller.db'):
+        accounting.get_balances(ADDRESSES[3:5])
+    assert not caplog.records
+
+
+def test_transfer_batcher(monkeypatch):
+    'Test committing the transfers of concurrent requests in batches.'
+    initialize_test_database()
+    monkeypatch.setattr(accounting, 'TRANSFER_BATCH_SIZE', 10)
+    monkeypatch.setattr(accounting, 'TRANSFER_BATCH_WAIT_MS', 200)
+    monkeypatch.setattr(accounting, 'TRANSFER_BATCHER', None)
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+
+    # Only five of eight concurrent transfers can be funded, even when they are in the same batch.
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        futures = [executor.submit(accounting.transfer, ADDRESSES[0], ADDRESSES[1], 2) for _ in range(8)]
+    outcomes = collections.Counter([
+        type(future.exception()).__name__ if future.exception() else 'transferred' for future in futures])
+    assert outcomes == dict(transferred=5, InsufficientFunds=3)
+    assert len({future.result() for future in futures if not future.exception()}) == 5
+    stats = accounting.get_transfer_batcher().get_stats()
+    assert stats['requests'] == 8 and stats['insufficient_funds'] == 3 and stats['batches'] < 8
+
+    # Requests are still all or nothing.
+    with pytest.raises(accounting.InsufficientFunds):
+        accounting.transfer_many([
+            dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=5),
+            dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=6)])
+    assert accounting.transfer_many([dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=5)]) == [
+        dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=5, idx=get_last_transaction_idx())]
+    assert [accounting.get_balance(address) for address in ADDRESSES[:3]] == [0, 5, 5]
+    assert not accounting.verify_balances()
+
+
+def test_transfer_batcher_failures(monkeypatch):
+    'Test retrying deadlocked batches, isolating failing requests, and timing out only requests that never ran.'
+    deadlocks = [1]
+    applied = []
+
+    def apply_batch_once(batch):
+        amounts = [transfers[0]['amount'] for transfers, _ in batch]
+        if deadlocks:
+            deadlocks.pop()
+            raise db.pymysql.err.OperationalError(db.pymysql.constants.ER.LOCK_DEADLOCK, 'Deadlock found')
+        # A zero amount stands for a request the database rejects.
+        if 0 in amounts:
+            raise db.pymysql.err.OperationalError(db.pymysql.constants.ER.LOCK_WAIT_TIMEOUT, 'Lock wait timeout')
+        if 5 in amounts:
+            time.sleep(.5)
+        applied.extend(amounts)
+        return [(future, [amount], None) for amount, (_, future) in zip(amounts, batch)]
+
+    def make_request(amount):
+        return [dict(source=ADDRESSES[0], target=ADDRESSES[1], amount=amount)], concurrent.futures.Future()
+
+    monkeypatch.setattr(accounting.TransferBatcher, 'apply_batch_once', staticmethod(apply_batch_once))
+    batcher = accounting.TransferBatcher(1, 0)
+
+    # A deadlocked batch is retried, and a batch that fails otherwise is applied one request at a time.
+    good_request, bad_request = make_request(1), make_request(0)
+    batcher.apply_batch([good_request, bad_request], 2)
+    assert good_request[1].result() == [1]
+    with pytest.raises(db.pymysql.err.OperationalError):
+        bad_request[1].result()
+    stats = batcher.get_stats()
+    assert (stats['deadlocks'], stats['failed_batches'], stats['batches']) == (1, 2, 1)
+
+    # A request that times out in the queue is never applied, one that is being applied waits for its commit.
+    monkeypatch.setattr(accounting, 'TRANSFER_BATCH_TIMEOUT', .1)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        slow_request = executor.submit(batcher.apply, make_request(5)[0])
+        time.sleep(.05)
+        with pytest.raises(concurrent.futures.TimeoutError):
+            batcher.apply(make_request(2)[0])
+        assert slow_request.result() == [5]
+    assert batcher.apply(make_request(3)[0]) == [3]
+    assert applied == [1, 5, 3]
+
+
+def test_checkpoints_and_archive():
+    'Test balance checkpoints and archiving the transactions they cover.'
+    initialize_test_database()
+    assert accounting.create_checkpoint() is None
+    assert accounting.archive_transactions() == 0
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+    accounting.transfer(ADDRESSES[0], ADDRESSES[1], 3)
+    accounting.withdraw(ADDRESSES[1], 2)
+    checkpoint = accounting.create_checkpoint()
+    assert checkpoint['last_transaction'] == get_last_transaction_idx()
+    assert checkpoint['addresses'] == 3
+    assert accounting.create_checkpoint() is None
+
+    # The pending withdrawal stays.
+    with db.sql_connection() as sql:
+        sql.execute('UPDATE transactions SET timestamp = NOW() - INTERVAL 100 DAY')
+    assert accounting.archive_transactions() == 2
+    assert accounting.archive_transactions() == 0
+    assert get_last_transaction_idx() == checkpoint['last_transaction']
+    assert accounting.get_unsettled_withdrawals()[ADDRESSES[1]][0]['amount'] == 2
+
+    accounting.transfer(ADDRESSES[0], ADDRESSES[1], 4)
+    assert not accounting.verify_balances()
+    assert not accounting.verify_archive()
+    with db.sql_connection() as sql:
+        sql.execute('UPDATE balances SET balance = 0 WHERE address = %s', (ADDRESSES[1],))
+    assert accounting.rebuild_balances() == {ADDRESSES[1]: dict(stored=0, computed=5)}
+    assert [accounting.get_balance(address) for address in ADDRESSES[:2]] == [3, 5]
+
+    with db.sql_connection() as sql:
+        sql.execute('UPDATE transactions_archive SET amount = amount + 1 WHERE target = %s', (ADDRESSES[1],))
+    assert accounting.verify_archive() == {checkpoint['idx']: {
+        ADDRESSES[0]: dict(stored=7, computed=6), ADDRESSES[1]: dict(stored=1, computed=2)}}
+
+
+def test_checkpoint_waits_for_transactions_in_flight():
+    'Test that a checkpoint never skips a transaction committed after a later one.'
+    initialize_test_database()
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+    accounting.debug_deposit(ADDRESSES[1], 10, fake_transaction_hash())
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        with db.sql_connection() as sql:
+            in_flight = accounting.transfer_in_session(ADDRESSES[0], ADDRESSES[2], 1, sql)
+            committed = accounting.transfer(ADDRESSES[1], ADDRESSES[3], 1)
+            assert committed > in_flight
+            checkpoint = executor.submit(accounting.create_checkpoint)
+            time.sleep(0.5)
+            assert not checkpoint.done()
+        assert checkpoint.result()['last_transaction'] == committed
+    assert not accounting.verify_archive()
+
+
+def test_history():
+    'Test paginating through the transaction history of an address.'
+    initialize_test_database()
+    deposit_hash = fake_transaction_hash()
+    accounting.debug_deposit(ADDRESSES[0], 10, deposit_hash)
+    accounting.transfer(ADDRESSES[0], ADDRESSES[1], 3)
+    accounting.debug_deposit(ADDRESSES[2], 10, fake_transaction_hash())
+    accounting.transfer(ADDRESSES[1], ADDRESSES[0], 1)
+    accounting.withdraw(ADDRESSES[0], 2)
+
+    history, cursor = accounting.get_history(ADDRESSES[0], limit=2)
+    assert [transaction['kind'] for transaction in history] == ['withdrawal', 'transfer']
+    assert history[0]['remote_transaction'] is None
+    assert cursor == history[-1]['idx']
+    history, cursor = accounting.get_history(ADDRESSES[0], cursor=cursor, limit=2)
+    assert [(transaction['kind'], transaction['amount']) for transaction in history] == [
+        ('transfer', 3), ('deposit', 10)]
+    assert history[-1]['remote_transaction'] == deposit_hash
+    assert cursor is None
+    full_history = accounting.get_history(ADDRESSES[0])[0]
+    assert [transaction['amount'] for transaction in full_history] == [2, 1, 3, 10]
+    assert [transaction['amount'] for transaction in accounting.get_history(
+        ADDRESSES[0], direction='incoming')[0]] == [1, 10]
+    assert [transaction['amount'] for transaction in accounting.get_history(
+        ADDRESSES[0], direction='outgoing')[0]] == [2, 3]
+    assert accounting.get_history(ADDRESSES[0], since=full_history[0]['timestamp'] + 1) == ([], None)
+    assert accounting.get_history(ADDRESSES[0], until=full_history[0]['timestamp'] + 1)[0] == full_history
+
+    # Archived transactions are still in the history.
+    with db.sql_connection() as sql:
+        sql.execute('UPDATE transactions SET timestamp = timestamp - INTERVAL 100 DAY')
+    accounting.create_checkpoint()
+    assert accounting.archive_transactions() == 4
+    assert [transaction['idx'] for transaction in accounting.get_history(ADDRESSES[0])[0]] == [
+        transaction['idx'] for transaction in full_history]
+
+    with web.APP.test_client() as client:
+        history_response = client.post('/get_history', data=dict(address=ADDRESSES[0], direction='incoming', limit=1))
+        assert history_response.status == '200 OK'
+        assert [transaction['amount'] for transaction in history_response.json['transactions']] == [1]
+        history_response = client.post('/get_history', data=dict(
+            address=ADDRESSES[0], cursor=history_response.json['next_cursor'], direction='incoming'))
+        assert [transaction['amount'] for transaction in history_response.json['transactions']] == [10]
+        assert history_response.json['next_cursor'] is None
+        assert client.post('/get_history', data=dict(address=ADDRESSES[0], direction='up')).json == dict(
+            status=400, error_name='ArgumentMismatch',
+            error_message='argument direction must be one of: incoming, outgoing, all')
+        assert client.post('/get_history', data=dict(address=ADDRESSES[0], limit=10**6)).json == dict(
+            status=400, error_name='ArgumentMismatch',
+            error_message=f"argument limit can not be larger than {web.MAX_HISTORY_PAGE_SIZE}")
+
+
+def test_transfer_many():
+    'Test batch transfers.'
+    initialize_test_database()
+    accounting.debug_deposit(ADDRESSES[0], 10, fake_transaction_hash())
+    accounting.debug_deposit(ADDRESSES[1], 5, fake_transaction_hash())
+    assert accounting.transfer_many([]) == []
+
+    transaction_idx = get_last_transaction_idx()
+    transfers = [
+        dict(source=ADDRESSES[0], target=ADDRESSES[2], amount=4),
+        dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=5),
+        dict(source=ADDRESSES[0], target=ADDRESSES[1], amount=6)]
+    assert accounting.transfer_many(transfers) == [
+        dict(transfer, idx=transaction_idx + offset) for offset, transfer in enumerate(transfers, 1)]
+    assert [accounting.get_balance(address) for address in ADDRESSES[:3]] == [0, 6, 9]
+
+    # Incoming transfers in a batch can not pay for outgoing ones, and a failing batch changes nothing.
+    transaction_idx = get_last_transaction_idx()
+    with pytest.raises(accounting.InsufficientFunds):
+        accounting.transfer_many([
+            dict(source=ADDRESSES[2], target=ADDRESSES[3], amount=9),
+            dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=1),
+            dict(source=ADDRESSES[2], target=ADDRESSES[3], amount=1)])
+    with pytest.raises(accounting.InsufficientFunds):
+        accounting.transfer_many([dict(source=ADDRESSES[2], target=ADDRESSES[2], amount=10)])
+    assert get_last_transaction_idx() == transaction_idx
+    assert accounting.get_balances(ADDRESSES[:4]) == dict(zip(ADDRESSES[:4], [0, 6, 9, 0]))
+    assert not accounting.get_balances([])
+    assert accounting.verify_balances() == {}
+
+
+def test_concurrent_transfers():
+    'Test that concurrent transfers from the same addresses never overspend.'
+    results = benchmark.contention(threads=8, hot_addresses=3, transfers=20, initial_balance=10)
+    assert results['transferred'] + results['insufficient_funds'] == 8 * 20
+    assert results['transferred'] > 0
+    assert results['database_errors'] == 0
+    assert results['overdrawn_addresses'] == 0
+    assert results['balance_mismatches'] == 0
+
+
+def test_hot_paths_benchmark(tmp_path):
+    'Smoke test the hot paths benchmark and its regression detection.'
+    baseline_path, output_path = os.path.join(tmp_path, 'baseline.json'), os.path.join(tmp_path, 'output.json')
+    arguments = dict(rows=2000, addresses=50, iterations=5, heavy_iterations=2, scan_blocks=10)
+    report = benchmark.hot_paths(**arguments, output=baseline_path)
+    assert set(report['results']) == {
+        'get_balance', 'transfer', 'get_unsettled_withdrawals', 'scan_for_deposits', 'settle'}
+    assert all(result['count'] > 0 for result in report['results'].values())
+    report = benchmark.hot_paths(**arguments, output=output_path, baseline=baseline_path, threshold=10**6)
+    assert report['regressions'] == []
+    assert benchmark.find_regressions(
+        dict(settle=dict(p50_ms=3, p99_ms=4)), dict(settle=dict(p50_ms=1, p99_ms=4)), .2
+    ) == [dict(benchmark='settle', metric='p50_ms', baseline=1, current=3)]
+
+
 def test_accounting_with_etherscan():
     'Test integration of accounting with etherscan module.'
     initialize_test_database()
@@ -117,8 +480,15 @@ def test_accounting_with_etherscan():
         transaction_idx += 1
         withdrawals[deposit['source']].append(dict(idx=transaction_idx, amount=decimal.Decimal(balance)))
     assert accounting.get_unsettled_withdrawals() == withdrawals
+    assert accounting.get_unsettled_withdrawals([DEPOSITS[0]['source'], ADDRESSES[-1]]) == {
+        DEPOSITS[0]['source']: withdrawals[DEPOSITS[0]['source']]}
+    assert not accounting.get_unsettled_withdrawals([])
+    assert accounting.count_unsettled_withdrawals() == len(DEPOSITS)
     assert accounting.settle(PAYMENT_TRANSACTION) == dict(settled_transactions_count=2, unsettled_transaction_count=0)
     assert not accounting.get_unsettled_withdrawals()
+    with pytest.raises(accounting.SettleError):
+        with db.sql_connection() as sql:
+            accounting.settle_in_session(PAYMENT_TRANSACTION, [transaction_idx], sql)
 
     # Test full scan and make sure we hit the same block twice.
     accounting.scan_for_deposits()
@@ -131,6 +501,80 @@ def test_accounting_with_etherscan():
         accounting.scan_for_deposits()
 
 
+def test_accounting_with_fake_etherscan(monkeypatch):
+    'Test a full deposit, withdraw and settle flow against a local synthetic chain.'
+    initialize_test_database()
+    chain = fake_etherscan.Chain(accounting.SAFE, seed=2, head=1000, deposits_per_block=1, addresses=20, payouts=0)
+    server = fake_etherscan.serve(chain)
+    monkeypatch.setattr(etherscan, 'ETHERSCAN_API', server.url)
+    monkeypatch.setattr(etherscan, 'CACHE_PATH', '')
+    try:
+        accounting.scan_for_deposits(0)
+        deposits = chain.get_deposits(0, chain.head - accounting.REQUIRED_BLOCK_DEPTH)
+        balances = collections.Counter()
+        for deposit in deposits:
+            balances[deposit['source']] += deposit['amount'] // accounting.WEI_DEPOSIT_FOR_ONE_ROLLER
+        assert accounting.get_balances(balances) == balances
+
+        for address, balance in balances.items():
+            accounting.withdraw(address, balance)
+        payout = chain.add_payout([
+            dict(address=address, amount=balance * accounting.WEI_WITHDRAW_FOR_ONE_ROLLER)
+            for address, balance in balances.items()], chain.head - accounting.REQUIRED_BLOCK_DEPTH)
+        assert accounting.settle(payout) == dict(
+            settled_transactions_count=len(balances), unsettled_transaction_count=0)
+    finally:
+        server.shutdown()
+
+
+def test_windowed_scan(monkeypatch):
+    'Test scanning for deposits in adaptive windows that are recorded separately.'
+    initialize_test_database()
+    deposits = [dict(
+        source=ADDRESSES[block % 3], amount=accounting.WEI_DEPOSIT_FOR_ONE_ROLLER, block_number=block,
+        transaction=fake_transaction_hash()
+    ) for block in range(100, 130)]
+    failing_block = 120
+
+    def fake_get_deposits(_, start_block, end_block):
+        if end_block - start_block >= 4:
+            raise etherscan.TruncatedResult('too many transactions', data={})
+        if failing_block is not None and start_block <= failing_block <= end_block:
+            raise etherscan.EtherscanError('etherscan is down', data={})
+        return [deposit for deposit in deposits if start_block <= deposit['block_number'] <= end_block]
+
+    monkeypatch.setattr(etherscan, 'get_deposits', fake_get_deposits)
+    monkeypatch.setattr(accounting, 'SCAN_WINDOW', 16)
+    with pytest.raises(etherscan.EtherscanError):
+        accounting.scan_for_deposits(100, 129)
+    with db.sql_connection() as sql:
+        sql.execute('SELECT MAX(end_block) AS end_block FROM deposit_scans')
+        assert sql.fetchone()['end_block'] < failing_block
+
+    # Resume the interrupted scan.
+    failing_block = None
+    accounting.scan_for_deposits(end_block=129)
+    with db.sql_connection() as sql:
+        sql.execute("""
+            SELECT start_block, end_block, deposits, first_transaction, last_transaction FROM deposit_scans
+            ORDER BY start_block""")
+        scans = sql.fetchall()
+    assert (scans[0]['start_block'], scans[-1]['end_block']) == (100, 129)
+    assert all(scan['end_block'] + 1 == next_scan['start_block'] for scan, next_scan in zip(scans, scans[1:]))
+    assert accounting.get_balances(ADDRESSES[:3]) == {address: 10 for address in ADDRESSES[:3]}
+
+    # Scans record the range of their deposits, which are inserted together.
+    assert sum(scan['deposits'] for scan in scans) == len(deposits)
+    assert all(
+        scan['last_transaction'] - scan['first_transaction'] + 1 == scan['deposits']
+        for scan in scans if scan['deposits'])
+
+    # A remote transaction can only be deposited once.
+    with pytest.raises(db.pymysql.IntegrityError):
+        accounting.debug_deposit(ADDRESSES[0], 1, deposits[0]['transaction'])
+    assert accounting.get_balance(ADDRESSES[0]) == 10
+
+
 def test_accounting_errors(monkeypatch):
     'Test accounting errors.'
     initialize_test_database()
@@ -218,6 +662,35 @@ def test_webserver_errors():
                 status=400, error_name='ArgumentMismatch',
                 error_message=error_message)
 
+        for bad_transfers, error_message in [
+            ('not json', 'argument transfers is not valid JSON'),
+            ('[]', 'argument transfers must be a non empty list'),
+            ('{}', 'argument transfers must be a non empty list'),
+            ('[1]', 'argument transfers must only contain objects'),
+            (f"[{{\"source\": \"{ADDRESSES[0]}\", \"amount\": 1}}]",
+             'request does not contain arguments(s): target'),
+            (f"[{{\"source\": \"{ADDRESSES[0]}\", \"target\": 1, \"amount\": 1}}]",
+             'argument target must be 40 characters long'),
+            (f"[{(web.MAX_BATCH_SIZE + 1) * '{}, '}{{}}]",
+             f"argument transfers can not contain more than {web.MAX_BATCH_SIZE} items")
+        ]:
+            error_response = client.post('/transfer_batch', data=dict(transfers=bad_transfers))
+            assert error_response.status == '400 BAD REQUEST'
+            assert error_response.json == dict(
+                status=400, error_name='ArgumentMismatch',
+                error_message=error_message)
+
+        for bad_addresses, error_message in [
+            (f"[\"{ADDRESSES[0][:-1]}\"]", 'argument address must be 40 characters long'),
+            (web.json.dumps(ADDRESSES[:1] * (web.MAX_BALANCE_ADDRESSES + 1)),
+             f"argument addresses can not contain more than {web.MAX_BALANCE_ADDRESSES} items")
+        ]:
+            error_response = client.post('/get_balances', data=dict(addresses=bad_addresses))
+            assert error_response.status == '400 BAD REQUEST'
+            assert error_response.json == dict(
+                status=400, error_name='ArgumentMismatch',
+                error_message=error_message)
+
         for reason in ['response', 'exception']:
             error_response = client.post('/five_hundred', data=dict(reason=reason))
             assert error_response.status == '500 INTERNAL SERVER ERROR'
@@ -244,6 +717,10 @@ def test_webserver_debug():
         deposit_response = client.post('/deposit', data=dict(address=ADDRESSES[0], amount=100))
         assert deposit_response.status == '201 CREATED'
         assert client.post('/get_balance', data=dict(address=ADDRESSES[0])).json['balance'] == 100
+        balances_response = client.post('/get_balances', data=dict(
+            addresses=web.json.dumps([ADDRESSES[0], ADDRESSES[1].upper(), ADDRESSES[0]])))
+        assert balances_response.status == '200 OK'
+        assert balances_response.json == dict(status=200, balances={ADDRESSES[0]: 100, ADDRESSES[1]: 0})
 
         transfer_response = client.post('/transfer', data=dict(
             source=ADDRESSES[0], target=ADDRESSES[1],  amount=101))
@@ -257,6 +734,27 @@ def test_webserver_debug():
         assert client.post('/get_balance', data=dict(address=ADDRESSES[0])).json['balance'] == 90
         assert client.post('/get_balance', data=dict(address=ADDRESSES[1])).json['balance'] == 10
 
+        transfers = [
+            dict(source=ADDRESSES[0], target=ADDRESSES[2], amount=5),
+            dict(source=ADDRESSES[1].upper(), target=ADDRESSES[3], amount=10)]
+        batch_response = client.post('/transfer_batch', data=dict(transfers=web.json.dumps(transfers)))
+        assert batch_response.status == '201 CREATED'
+        transaction_idx = get_last_transaction_idx()
+        assert batch_response.json == dict(status=201, transfers=[
+            dict(source=ADDRESSES[0], target=ADDRESSES[2], amount=5, idx=transaction_idx - 1),
+            dict(source=ADDRESSES[1], target=ADDRESSES[3], amount=10, idx=transaction_idx)])
+        batch_response = client.post('/transfer_batch', data=dict(transfers=web.json.dumps(transfers)))
+        assert batch_response.status == '400 BAD REQUEST'
+        assert batch_response.json == dict(
+                status=400, error_name='InsufficientFunds',
+                error_message=f"address {ADDRESSES[1]} has less than 10 rollers")
+        batch_response = client.post('/transfer_batch', data=dict(transfers=web.json.dumps([
+            dict(source=ADDRESSES[2], target=ADDRESSES[0], amount=5),
+            dict(source=ADDRESSES[3], target=ADDRESSES[1], amount=10)])))
+        assert batch_response.status == '201 CREATED'
+        assert client.post('/get_balance', data=dict(address=ADDRESSES[0])).json['balance'] == 90
+        assert client.post('/get_balance', data=dict(address=ADDRESSES[1])).json['balance'] == 10
+
         assert client.get('/get_unsettled_withdrawals').status == '200 OK'
         assert client.get('/get_unsettled_withdrawals').json['unsettled_withdrawals'] == ''
         withdraw_response = client.post('/withdraw', data=dict(address=ADDRESSES[0], amount=91))
@@ -274,6 +772,26 @@ def test_webserver_debug():
         assert client.get('/get_unsettled_withdrawals').json['unsettled_withdrawals'] != ''
 
 
+def test_webserver_unsettled_withdrawals_csv():
+    'Test streaming the unsettled withdrawals as CSV.'
+    initialize_test_database()
+    for idx, address in enumerate(ADDRESSES[:3]):
+        accounting.debug_deposit(address, 10, fake_transaction_hash())
+        for _ in range(idx + 1):
+            accounting.withdraw(address, 2)
+    with web.APP.test_client() as client:
+        csv_response = client.get('/get_unsettled_withdrawals', query_string=dict(format='csv'))
+        assert csv_response.status == '200 OK'
+        assert csv_response.mimetype == 'text/csv'
+        assert csv_response.get_data(as_text=True) == "".join([
+            f"0x{address}, {accounting.roller_to_eth(2 * (idx + 1))}\n"
+            for idx, address in sorted(enumerate(ADDRESSES[:3]), key=lambda item: item[1])])
+        assert client.get('/get_unsettled_withdrawals').json['unsettled_withdrawals'] == (
+            csv_response.get_data(as_text=True)[:-1])
+        assert client.get('/get_unsettled_withdrawals', query_string=dict(format='xml')).json == dict(
+            status=400, error_name='ArgumentMismatch', error_message='argument format must be one of: json, csv')
+
+
 def test_webserver_payment_flow():
     'To test the full flow we run a production webserver.'
     initialize_test_database()
@@ -290,8 +808,108 @@ def test_webserver_payment_flow():
         assert client.get('/get_unsettled_withdrawals').json['unsettled_withdrawals'] == ''
 
 
+def test_async_webserver(monkeypatch):
+    'Test the async webserver against the sync one, and settle through its async etherscan client.'
+    initialize_test_database()
+    web.DEBUG = True
+    chain = fake_etherscan.Chain(accounting.SAFE, head=1000, payouts=0)
+    server = fake_etherscan.serve(chain)
+    monkeypatch.setattr(etherscan, 'ETHERSCAN_API', server.url)
+    monkeypatch.setattr(etherscan, 'CACHE_PATH', '')
+    try:
+        with web.APP.test_client() as client, starlette.testclient.TestClient(web_async.APP) as async_client:
+            assert async_client.get('/get_prices').json() == client.get('/get_prices').json
+            assert async_client.post('/deposit', data=dict(address=ADDRESSES[0], amount=100)).status_code == 201
+            assert async_client.post('/transfer', data=dict(
+                source=ADDRESSES[0], target=ADDRESSES[1], amount=30)).status_code == 201
+            transfers = web.json.dumps([
+                dict(source=ADDRESSES[0], target=ADDRESSES[2], amount=20),
+                dict(source=ADDRESSES[1], target=ADDRESSES[2], amount=10)])
+            transaction_idx = get_last_transaction_idx()
+            batch_response = async_client.post('/transfer_batch', data=dict(transfers=transfers))
+            assert batch_response.status_code == 201
+            assert [transfer['idx'] for transfer in batch_response.json()['transfers']] == [
+                transaction_idx + 1, transaction_idx + 2]
+            balances = dict(addresses=web.json.dumps(ADDRESSES[:3]))
+            assert async_client.post('/get_balances', data=balances).json() == client.post(
+                '/get_balances', data=balances).json == dict(status=200, balances={
+                    ADDRESSES[0]: 50, ADDRESSES[1]: 20, ADDRESSES[2]: 30})
+            assert async_client.post('/get_balance', data=dict(address=ADDRESSES[0])).json()['balance'] == 50
+            overdraft = dict(address=ADDRESSES[1], amount=21)
+            assert async_client.post('/withdraw', data=overdraft).json() == client.post(
+                '/withdraw', data=overdraft).json
+            assert async_client.post('/withdraw', data=dict(address=ADDRESSES[1], amount=20)).status_code == 201
+            assert not accounting.verify_balances()
+            assert async_client.get('/get_unsettled_withdrawals').json() == client.get(
+                '/get_unsettled_withdrawals').json
+            history = dict(address=ADDRESSES[1])
+            assert async_client.post('/get_history', data=history).json() == client.post(
+                '/get_history', data=history).json
+
+            payout = chain.add_payout([dict(
+                address=ADDRESSES[1], amount=20 * accounting.WEI_WITHDRAW_FOR_ONE_ROLLER
+            )], chain.head - accounting.REQUIRED_BLOCK_DEPTH)
+            assert async_client.post('/settle', data=dict(transaction_hash=payout)).json() == dict(
+                status=201, settled_transactions_count=1, unsettled_transaction_count=0)
+
+            # Transfers drop cached balances, and go through the batcher when batching is on.
+            monkeypatch.setattr(accounting, 'BALANCE_CACHE_SIZE', 10)
+            monkeypatch.setattr(accounting, 'BALANCE_CACHE', None)
+            assert accounting.get_balance(ADDRESSES[0]) == 50
+            assert async_client.post('/transfer', data=dict(
+                source=ADDRESSES[0], target=ADDRESSES[1], amount=5)).status_code == 201
+            assert accounting.get_balance(ADDRESSES[0]) == 45
+            monkeypatch.setattr(accounting, 'TRANSFER_BATCH_SIZE', 10)
+            monkeypatch.setattr(accounting, 'TRANSFER_BATCHER', None)
+            assert async_client.post('/transfer', data=dict(
+                source=ADDRESSES[0], target=ADDRESSES[1], amount=5)).status_code == 201
+            assert accounting.get_balance(ADDRESSES[0]) == 40
+            assert accounting.get_transfer_batcher().get_stats()['requests'] == 1
+            assert not accounting.verify_balances()
+    finally:
+        server.shutdown()
+
+
+def test_follower(monkeypatch):
+    'Test following the chain head, with adaptive polling.'
+    initialize_test_database()
+    chain = fake_etherscan.Chain(accounting.SAFE, head=1000, deposits_per_block=1, payouts=0)
+    server = fake_etherscan.serve(chain)
+    monkeypatch.setattr(etherscan, 'ETHERSCAN_API', server.url)
+    monkeypatch.setattr(etherscan, 'CACHE_PATH', '')
+    try:
+        follower_instance = follower.Follower(min_interval=1, max_interval=4, max_blocks=600)
+        # Behind the head, it polls again right away, then slows down as it catches up and idles.
+        assert [follower_instance.step() for _ in range(5)] == [0, 1, 2, 4, 4]
+        final_block = chain.head - accounting.REQUIRED_BLOCK_DEPTH
+        assert accounting.get_last_scanned_block() == final_block
+        assert accounting.get_balance(chain.get_address(0)) == sum(
+            deposit['amount'] // accounting.WEI_DEPOSIT_FOR_ONE_ROLLER
+            for deposit in chain.get_deposits(0, final_block) if deposit['source'] == chain.get_address(0))
+        assert follower.metrics.prometheus_client.REGISTRY.get_sample_value(
+            'roller_follower_lag_blocks') == accounting.REQUIRED_BLOCK_DEPTH
+
+        chain.initial_head += 5
+        assert follower_instance.step() == 1
+        assert accounting.get_last_scanned_block() == final_block + 5
+
+        def fail():
+            raise etherscan.EtherscanError('down', data={})
+        monkeypatch.setattr(etherscan, 'get_latest_block_number', fail)
+        assert follower_instance.step() == 2
+        assert follower_instance.failures == 1
+        assert follower.metrics.prometheus_client.REGISTRY.get_sample_value('roller_follower_healthy') == 0
+
+        follower_instance.stop()
+        follower_instance.run()
+    finally:
+        server.shutdown()
+
+
 def test_etherscan(monkeypatch):
     'Test etherscan module.'
+    # Test the network, not the cache.
+    monkeypatch.setattr(etherscan, 'CACHE_PATH', '')
     assert etherscan.get_latest_block_number() > 0
     assert etherscan.get_deposits(SAFE, *DEPOSIT_BLOCK_RANGE) == DEPOSITS
     assert etherscan.get_payments(PAYMENTS_ADDRESS, PAYMENT_TRANSACTION) == PAYMENTS
@@ -315,6 +933,137 @@ def test_etherscan(monkeypatch):
         etherscan.get_latest_block_number()
 
 
+def test_etherscan_retries(monkeypatch):
+    'Test etherscan throttling handling.'
+
+    throttled = dict(status='0', message='NOTOK', result='Max rate limit reached')
+    responses = [FakeResponse(429, None), FakeResponse(503, None), FakeResponse(200, throttled)]
+    responses.append(FakeResponse(200, dict(jsonrpc='2.0', id=83, result='0x10')))
+    monkeypatch.setattr(etherscan, 'BACKOFF', 0)
+    monkeypatch.setattr(etherscan.get_session(), 'post', lambda *args, **kwargs: responses.pop(0))
+    stats = etherscan.get_stats().get('eth_blockNumber', dict(calls=0, retries=0, failures=0))
+    assert etherscan.get_latest_block_number() == 16
+    assert etherscan.get_stats()['eth_blockNumber']['calls'] == stats['calls'] + 1
+    assert etherscan.get_stats()['eth_blockNumber']['retries'] == stats['retries'] + 3
+
+    monkeypatch.setattr(etherscan, 'MAX_RETRIES', 1)
+    responses.extend([FakeResponse(200, throttled)] * 3)
+    with pytest.raises(etherscan.EtherscanError):
+        etherscan.get_latest_block_number()
+    assert etherscan.get_stats()['eth_blockNumber']['failures'] == stats['failures'] + 1
+    assert len(responses) == 1
+
+    # Errors that are not transient are not retried.
+    responses[:] = [FakeResponse(200, dict(message='no result'))]
+    with pytest.raises(etherscan.EtherscanError):
+        etherscan.get_latest_block_number()
+    assert not responses
+
+    rate_limiter = etherscan.TokenBucket(rate=100, capacity=2)
+    start = etherscan.time.monotonic()
+    for _ in range(6):
+        rate_limiter.acquire()
+    assert etherscan.time.monotonic() - start >= .035
+
+
+def test_etherscan_cache(monkeypatch, tmp_path):
+    'Test caching of immutable etherscan responses.'
+    monkeypatch.setattr(etherscan, 'CACHE_PATH', os.path.join(tmp_path, 'cache.sqlite'))
+    monkeypatch.setattr(etherscan, 'CACHE_MAX_ENTRIES', 3)
+    monkeypatch.setattr(etherscan, 'LATEST_BLOCK_NUMBER', 0)
+    head = 1000
+    transactions = {
+        f"0x{PAYMENT_TRANSACTION}": dict(from_=f"0x{PAYMENTS_ADDRESS}", blockNumber=hex(head - 20)),
+        f"0x{PAYMENT_TRANSACTION_INVALID}": dict(from_=f"0x{PAYMENTS_ADDRESS}", blockNumber=hex(head - 5))}
+    requested = []
+
+    def fake_post(*_, data, **__):
+        requested.append(data['action'])
+        if data['action'] == 'eth_blockNumber':
+            result = hex(head)
+        elif data['action'] == 'eth_getTransactionByHash':
+            result = {key.rstrip('_'): value for key, value in transactions[data['txhash']].items()}
+        elif data['action'] == 'txlistinternal':
+            result = [dict(to=f"0x{payment['address']}", value=str(payment['amount'])) for payment in PAYMENTS]
+        else:
+            result = []
+        return FakeResponse(200, dict(result=result))
+
+    monkeypatch.setattr(etherscan.get_session(), 'post', fake_post)
+    assert etherscan.get_payments(PAYMENTS_ADDRESS, PAYMENT_TRANSACTION) == PAYMENTS
+    assert requested == ['eth_getTransactionByHash', 'eth_blockNumber', 'txlistinternal']
+    assert etherscan.get_payments(PAYMENTS_ADDRESS, PAYMENT_TRANSACTION) == PAYMENTS
+    assert len(requested) == 3
+    assert etherscan.get_cache_stats() == dict(hits=2, misses=2, stores=2, evictions=0, entries=2, max_entries=3)
+
+    # Shallow transactions are not cached.
+    etherscan.get_payments(PAYMENTS_ADDRESS, PAYMENT_TRANSACTION_INVALID)
+    etherscan.get_payments(PAYMENTS_ADDRESS, PAYMENT_TRANSACTION_INVALID)
+    assert requested[3:] == 2 * ['eth_getTransactionByHash', 'eth_blockNumber', 'txlistinternal', 'eth_blockNumber']
+
+    # Deep enough block ranges are cached, and the least recently used results are evicted.
+    del requested[:]
+    etherscan.get_deposits(SAFE, head - 30, head - 20)
+    etherscan.get_deposits(SAFE, head - 30, head - 20)
+    etherscan.get_deposits(SAFE, head - 30, head - 5)
+    assert requested == ['txlist', 'txlist', 'eth_blockNumber']
+    etherscan.get_deposits(SAFE, head - 40, head - 30)
+    assert etherscan.get_cache_stats()['evictions'] == 1
+    assert etherscan.get_cache_stats()['entries'] == 3
+    etherscan.get_payments(PAYMENTS_ADDRESS, PAYMENT_TRANSACTION)
+    assert requested[-1] == 'txlistinternal'
+
+    # Results are cached per endpoint.
+    del requested[:]
+    etherscan.get_deposits(SAFE, head - 40, head - 30)
+    assert not requested
+    monkeypatch.setattr(etherscan, 'ETHERSCAN_API', 'http://127.0.0.1:8545/api')
+    etherscan.get_deposits(SAFE, head - 40, head - 30)
+    assert requested == ['txlist']
+
+
+def test_fake_etherscan(monkeypatch):
+    'Test the etherscan module against a local synthetic chain.'
+    chain = fake_etherscan.Chain(SAFE, seed=1, head=5000, deposits_per_block=3, addresses=10, payouts=2)
+    server = fake_etherscan.serve(chain)
+    monkeypatch.setattr(etherscan, 'ETHERSCAN_API', server.url)
+    monkeypatch.setattr(etherscan, 'CACHE_PATH', '')
+    monkeypatch.setattr(etherscan, 'BACKOFF', 0)
+    try:
+        assert etherscan.get_latest_block_number() == 5000
+        deposits = etherscan.get_deposits(SAFE, 100, 199)
+        assert deposits == chain.get_deposits(100, 199)
+        assert 200 < len(deposits) < 300
+        assert all(deposit['amount'] % accounting.WEI_DEPOSIT_FOR_ONE_ROLLER == 0 for deposit in deposits)
+        assert etherscan.get_deposits(SAFE, 100, 199) == deposits
+        with pytest.raises(etherscan.TruncatedResult):
+            etherscan.get_deposits(SAFE, 0, 4000)
+
+        payments = [dict(address=ADDRESSES[0], amount=7 * accounting.WEI_WITHDRAW_FOR_ONE_ROLLER)]
+        payout = chain.add_payout(payments, 4000)
+        assert etherscan.get_payments(SAFE, payout) == payments
+        assert etherscan.get_payments(PAYMENTS_ADDRESS_INVALID, payout) == []
+        assert len(etherscan.get_payments(SAFE, list(chain.payouts)[0])) == chain.payments_per_payout
+
+        # Injected throttling is retried, injected errors are retried until giving up.
+        faults = fake_etherscan.Faults(rate_limit=1)
+        server.shutdown()
+        server = fake_etherscan.serve(chain, faults=faults)
+        monkeypatch.setattr(etherscan, 'ETHERSCAN_API', server.url)
+        monkeypatch.setattr(etherscan, 'BACKOFF', .3)
+        retries = etherscan.get_stats()['eth_blockNumber']['retries']
+        for _ in range(2):
+            assert etherscan.get_latest_block_number() == 5000
+        assert etherscan.get_stats()['eth_blockNumber']['retries'] > retries
+        faults.rate_limit, faults.error_rate = None, 1
+        monkeypatch.setattr(etherscan, 'BACKOFF', 0)
+        monkeypatch.setattr(etherscan, 'MAX_RETRIES', 2)
+        with pytest.raises(etherscan.EtherscanError):
+            etherscan.get_latest_block_number()
+    finally:
+        server.shutdown()
+
+
 def test_database(monkeypatch, tmp_path):
     'Test database access.'
     initialize_test_database()
@@ -351,6 +1100,162 @@ def test_database(monkeypatch, tmp_path):
     monkeypatch.undo()
 
 
+def test_connection_pool(monkeypatch):
+    'Test database connection pooling.'
+    initialize_test_database()
+    # Private pools, so the test neither changes nor counts on the pools and stats of other tests.
+    monkeypatch.setattr(db, 'POOLS', {})
+    monkeypatch.setattr(db, 'POOL_MAX_SIZE', 10)
+
+    def get_connection_id():
+        with db.sql_connection() as sql:
+            sql.execute('SELECT CONNECTION_ID() AS id')
+            return sql.fetchone()['id']
+
+    connection_id = get_connection_id()
+    assert get_connection_id() == connection_id
+    stats = db.get_pool_stats()[db.DB_NAME]
+    assert (stats['created'], stats['in_use'], stats['idle']) == (1, 0, 1)
+
+    # Uncommitted changes never leak into the next user of a connection.
+    with pytest.raises(ValueError):
+        with db.sql_connection() as sql:
+            sql.execute('INSERT INTO balances(address, balance) VALUES(%s, 1)', (ADDRESSES[0],))
+            raise ValueError('abort')
+    assert accounting.get_balance(ADDRESSES[0]) == 0
+    assert get_connection_id() == connection_id
+
+    # Connections killed by the server are reconnected.
+    pool = db.get_pool(db.DB_NAME)
+    pool.ping_interval = 0
+    connection = db.connect(db.DB_NAME)
+    connection.cursor().execute(f"KILL {connection_id}")
+    connection.close()
+    assert get_connection_id() != connection_id
+
+    # A full pool times out.
+    pool.max_size, pool.wait_timeout = 1, 0.1
+    with db.sql_connection():
+        with pytest.raises(db.PoolExhausted):
+            with db.sql_connection():
+                pass
+    stats = db.get_pool_stats()[db.DB_NAME]
+    assert (stats['waits'], stats['timeouts'], stats['in_use']) == (1, 1, 0)
+    db.clear_pools()
+
+
+def get_request_samples():
+    'Get the request counts and latency observations of the endpoints test_metrics calls.'
+    registry = web.metrics.prometheus_client.REGISTRY
+    return (
+        registry.get_sample_value('roller_requests_total', dict(endpoint='get_prices_handler', status='200')) or 0,
+        registry.get_sample_value('roller_requests_total', dict(endpoint='five_hundred_handler', status='500')) or 0,
+        registry.get_sample_value('roller_request_seconds_count', dict(endpoint='get_prices_handler')) or 0)
+
+
+def test_metrics():
+    'Test counting requests and serving the metrics.'
+    before = get_request_samples()
+    with web.APP.test_client() as client:
+        client.get('/get_prices')
+        client.post('/five_hundred', data=dict(reason='response'))
+        metrics_response = client.get('/metrics')
+    assert metrics_response.status == '200 OK'
+    after = get_request_samples()
+    assert [count - before_count for count, before_count in zip(after, before)] == [1, 1, 1]
+    lines = metrics_response.data.decode().split('\n')
+    assert f'roller_requests_total{{endpoint="get_prices_handler",status="200"}} {after[0]}' in lines
+    assert f'roller_request_seconds_count{{endpoint="get_prices_handler"}} {after[2]}' in lines
+
+
+def test_shared_metrics_dir(tmp_path):
+    'Test creating the shared metrics directory, and dropping only the gauges of dead processes from it.'
+    metrics_dir = os.path.join(tmp_path, 'metrics')
+    environment = dict(os.environ, ROLLER_METRICS_DIR=metrics_dir)
+    pid = subprocess.run(
+        [sys.executable, '-c', 'import os, metrics; metrics.record_request("test", 200, 1); print(os.getpid())'],
+        env=environment, check=True, capture_output=True).stdout.decode().strip()
+    assert f"gauge_livesum_{pid}.db" in os.listdir(metrics_dir)
+    subprocess.run([sys.executable, '-c', 'import metrics; metrics.clear_dead_processes()'], env=environment,
+                   check=True)
+    names = os.listdir(metrics_dir)
+    assert f"counter_{pid}.db" in names
+    assert f"gauge_livesum_{pid}.db" not in names
+
+
+def test_api_spec(monkeypatch, tmp_path):
+    'Test serving the API spec, built on demand and prebuilt, and the Swagger UI.'
+    monkeypatch.setattr(web, 'API_SPEC_PATH', os.path.join(tmp_path, 'apispec.json'))
+    with web.APP.test_client() as client:
+        built_spec = client.get('/apispec.json').get_json()
+        assert '/get_balance' in built_spec['paths']
+        assert '/metrics' in built_spec['paths']
+        web.write_api_spec()
+        prebuilt_response = client.get('/apispec.json')
+        assert prebuilt_response.content_type == 'application/json'
+        assert prebuilt_response.get_json() == built_spec
+        assert b'swagger' in client.get('/').data
+        assert client.get('/flasgger_static/swagger-ui.js').status == '200 OK'
+        assert client.get('/no_such_path').status == '403 FORBIDDEN'
+
+
+def test_startup():
+    'Test that a server process imports no lazy modules before it serves its first requests - timed by benchmark.'
+    assert not benchmark.startup(runs=1)['lazy_modules']
+    # Etherscan is only configured when it is called.
+    environment = {key: value for key, value in os.environ.items() if key != 'ROLLER_ETHERSCAN_API_KEY'}
+    assert benchmark.measure_startup(environment)['ready_ms'] > 0
+
+
 def test_logs():
     'Just for coverage.'
     web.logs.setup(suppress_loggers=['foo'])
+
+
+def test_queued_json_logs(monkeypatch, tmp_path):
+    'Test logging through a queue in JSON.'
+    monkeypatch.setattr(logs, 'LOG_DIR_NAME', str(tmp_path))
+    with open(os.devnull, 'w', encoding='utf-8') as stream:
+        logs.setup(use_queue=True, use_json=True, stream=stream)
+        try:
+            LOGGER.info('queued %s', 'line')
+            try:
+                raise ValueError('logged')
+            except ValueError:
+                LOGGER.exception('failed')
+        finally:
+            logs.stop_listener()
+    with open(os.path.join(tmp_path, logs.LOG_FILE_NAME), encoding='utf-8') as log_file:
+        entries = [web.json.loads(line) for line in log_file]
+    assert [(entry['logger'], entry['level'], entry['message']) for entry in entries] == [
+        ('roller.test', 'INFO', 'queued line'), ('roller.test', 'ERROR', 'failed')]
+    assert 'ValueError: logged' in entries[1]['exception']
+    logs.setup()
+
+
+def log_from_worker():
+    'Log a line from a forked worker, like uWSGI workers do.'
+    web.setup_worker()
+    LOGGER.info('worker line')
+    logs.stop_listener()
+
+
+def test_setup_worker(monkeypatch, tmp_path):
+    'Test logging through a queue from forked workers and from their parent.'
+    monkeypatch.setattr(logs, 'LOG_DIR_NAME', str(tmp_path))
+    monkeypatch.setattr(logs, 'QUEUE', True)
+    monkeypatch.setattr(logs, 'JSON', True)
+    logs.setup()
+    try:
+        worker = multiprocessing.get_context('fork').Process(target=log_from_worker)
+        worker.start()
+        worker.join()
+        assert worker.exitcode == 0
+        LOGGER.info('parent line')
+    finally:
+        logs.stop_listener()
+    with open(os.path.join(tmp_path, logs.LOG_FILE_NAME), encoding='utf-8') as log_file:
+        messages = [web.json.loads(line)['message'] for line in log_file]
+    assert sorted(messages) == ['parent line', 'worker line']
+    monkeypatch.undo()
+    logs.setup()
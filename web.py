@@ -1,19 +1,36 @@
 'Roller Balance Web server.'
 import functools
+import json
 import os
+import threading
+import time
 import traceback
 
-import flasgger
 import flask
 import flask_cors
 
 import accounting
 import api_spec
+import db
 import logs
+import metrics
+
+try:
+    import uwsgi
+except ImportError:  # Only importable inside uWSGI.
+    uwsgi = None  # pylint: disable=invalid-name
 
 logs.setup()
 LOGGER = logs.logging.getLogger('roller.web')
 DEBUG = accounting.DEBUG
+MAX_BATCH_SIZE = int(os.environ.get('ROLLER_MAX_BATCH_SIZE', 1000))
+MAX_BALANCE_ADDRESSES = int(os.environ.get('ROLLER_MAX_BALANCE_ADDRESSES', 1000))
+HISTORY_PAGE_SIZE = int(os.environ.get('ROLLER_HISTORY_PAGE_SIZE', 100))
+MAX_HISTORY_PAGE_SIZE = int(os.environ.get('ROLLER_MAX_HISTORY_PAGE_SIZE', 1000))
+ARGUMENT_CHOICES = dict(format=['json', 'csv'], direction=['incoming', 'outgoing', 'all'])
+# Prebuilt at deploy time, so that servers never have to import flasgger to serve it.
+API_SPEC_PATH = os.environ.get(
+    'ROLLER_API_SPEC_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apispec.json'))
 
 
 class ArgumentMismatch(Exception):
@@ -24,14 +41,47 @@ class Unauthorized(Exception):
     'An unauthorized request.'
 
 
+CLIENT_ERRORS = (ArgumentMismatch, accounting.InsufficientFunds, accounting.SettleError)
+
+
 APP = flask.Flask('roller')
 APP.config['SECRET_KEY'] = os.environ.get('ROLLER_SESSIONS_KEY', os.urandom(24))
 APP.config['SWAGGER'] = api_spec.CONFIG
-flasgger.Swagger(APP)
 flask_cors.CORS(APP, resources={'*': {'origins': '*'}})
 
 
-def make_response(status=None, error_name=None, error_message=None, **kwargs):
+class SwaggerUI:
+    'WSGI middleware serving the Swagger UI from its own app, which is only created on the first request for it.'
+    PATHS = (api_spec.CONFIG['specs_route'], '/apidocs/index.html')
+    STATIC_PATH = '/flasgger_static/'
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.ui_app = None
+        self.lock = threading.Lock()
+
+    def get_ui_app(self):
+        'Get the Swagger UI app, creating it if needed - its page loads the spec from the apispec.json route of APP.'
+        with self.lock:
+            if self.ui_app is None:
+                import flasgger  # pylint: disable=import-outside-toplevel
+                ui_app = flask.Flask('roller-docs', static_folder=None)
+                ui_app.config['SWAGGER'] = api_spec.CONFIG
+                flasgger.Swagger(ui_app)
+                self.ui_app = ui_app
+        return self.ui_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO') or '/'
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD') and (path in self.PATHS or path.startswith(self.STATIC_PATH)):
+            return self.get_ui_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+APP.wsgi_app = SwaggerUI(APP.wsgi_app)
+
+
+def build_response(status=None, error_name=None, error_message=None, **kwargs):
     'Make a dict for a basic server response.'
     if error_name is not None:
         if isinstance(error_name, Exception):
@@ -42,10 +92,16 @@ def make_response(status=None, error_name=None, error_message=None, **kwargs):
     if error_message is not None:
         kwargs['error_message'] = error_message
     kwargs['status'] = status or 200
-    return flask.jsonify(dict(kwargs)), kwargs['status']
+    return dict(kwargs)
+
+
+def make_response(*args, **kwargs):
+    'Make a basic server response.'
+    response = build_response(*args, **kwargs)
+    return flask.jsonify(response), response['status']
 
 
-def check_arguments(required_arguments, given_arguments):
+def check_arguments(required_arguments, given_arguments, optional_arguments=None):
     'Raise exception if request arguments do not match requirements.'
     if required_arguments is None:
         required_arguments = set()
@@ -56,40 +112,108 @@ def check_arguments(required_arguments, given_arguments):
     missing_arguments = required_arguments - given_arguments
     if missing_arguments:
         raise ArgumentMismatch(f"request does not contain arguments(s): {', '.join(missing_arguments)}")
-    extra_arguments = given_arguments - required_arguments
+    extra_arguments = given_arguments - required_arguments - set(optional_arguments or [])
     if extra_arguments:
         raise ArgumentMismatch(f"request contain unexpected arguments(s): {', '.join(extra_arguments)}")
 
 
 def parse_argument(key, value):
     'Parse a single argument in a request.'
-    if key == 'amount':
-        try:
-            # Convert to string first, so that floats fail.
-            value = int(str(value))
-        except ValueError:
-            raise ArgumentMismatch(f"argument {key} has to be an integer") from None
-        if value <= 0:
-            raise ArgumentMismatch(f"argument {key} must be larger than zero") from None
+    if key in ['amount', 'cursor', 'since', 'until']:
+        value = parse_positive_integer(key, value)
+    elif key == 'limit':
+        value = parse_positive_integer(key, value, MAX_HISTORY_PAGE_SIZE)
+    elif key in ARGUMENT_CHOICES:
+        if value not in ARGUMENT_CHOICES[key]:
+            raise ArgumentMismatch(f"argument {key} must be one of: {', '.join(ARGUMENT_CHOICES[key])}")
     elif key in ['address', 'source', 'target', 'transaction_hash']:
         required_length = 64 if key == 'transaction_hash' else 40
-        if len(value) != required_length:
+        if not isinstance(value, str) or len(value) != required_length:
             raise ArgumentMismatch(f"argument {key} must be {required_length} characters long") from None
         value = value.lower()
         try:
             int(value, 16)
         except ValueError:
             raise ArgumentMismatch(f"argument {key} is not a hex string") from None
+    elif key == 'addresses':
+        value = [parse_argument('address', address) for address in parse_json_list(key, value, MAX_BALANCE_ADDRESSES)]
+    elif key == 'transfers':
+        value = parse_json_list(key, value, MAX_BATCH_SIZE)
+        for transfer in value:
+            if not isinstance(transfer, dict):
+                raise ArgumentMismatch(f"argument {key} must only contain objects")
+            check_arguments(['source', 'target', 'amount'], transfer.keys())
+        value = [{item_key: parse_argument(item_key, item_value) for item_key, item_value in transfer.items()}
+                 for transfer in value]
     return value
 
 
-def parse_request(request, required_arguments):
-    'Validate and parse a request.'
-    given_arguments = request.values.to_dict()
-    check_arguments(required_arguments, given_arguments.keys())
+def parse_positive_integer(key, value, maximum=None):
+    'Parse an argument holding a positive integer, optionally limited.'
+    try:
+        # Convert to string first, so that floats fail.
+        value = int(str(value))
+    except ValueError:
+        raise ArgumentMismatch(f"argument {key} has to be an integer") from None
+    if value <= 0:
+        raise ArgumentMismatch(f"argument {key} must be larger than zero") from None
+    if maximum is not None and value > maximum:
+        raise ArgumentMismatch(f"argument {key} can not be larger than {maximum}")
+    return value
+
+
+def parse_json_list(key, value, max_length):
+    'Parse an argument holding a non empty JSON list of limited length.'
+    try:
+        value = json.loads(value)
+    except ValueError:
+        raise ArgumentMismatch(f"argument {key} is not valid JSON") from None
+    if not isinstance(value, list) or not value:
+        raise ArgumentMismatch(f"argument {key} must be a non empty list")
+    if len(value) > max_length:
+        raise ArgumentMismatch(f"argument {key} can not contain more than {max_length} items")
+    return value
+
+
+def parse_arguments(given_arguments, required_arguments, optional_arguments=None):
+    'Validate and parse the arguments of a request.'
+    check_arguments(required_arguments, given_arguments.keys(), optional_arguments)
     return {key: parse_argument(key, value) for key, value in given_arguments.items()}
 
 
+def parse_request(request, required_arguments, optional_arguments=None):
+    'Validate and parse a request.'
+    return parse_arguments(request.values.to_dict(), required_arguments, optional_arguments)
+
+
+def get_error_response(exception, url, arguments):
+    'Get the response to an exception raised while handling a request - must be called from its except block.'
+    if isinstance(exception, CLIENT_ERRORS):
+        return dict(status=400, error_name=exception)
+    if isinstance(exception, Unauthorized):
+        return dict(status=403, error_name=exception)
+    LOGGER.exception(f"unexpected server exception on {url}: {arguments}")
+    return dict(status=500, error_name=exception, stacktrace=traceback.format_exc().split('\n'))
+
+
+def handle(handler, required_arguments, optional_arguments):
+    'Parse the arguments of a request, call its handler and make its response, reporting any error.'
+    request = None
+    try:
+        request = parse_request(flask.request, required_arguments, optional_arguments)
+        response = handler(**request)
+        # Streaming handlers build their own response.
+        if isinstance(response, flask.Response):
+            return response
+    # If anything fails, we want to catch it here.
+    except Exception as exception:  # pylint: disable=broad-except
+        response = get_error_response(exception, flask.request.url, request)
+    try:
+        return make_response(**(response))
+    except TypeError:
+        return make_response(500, 'InternalError', f"handler {handler.__name__} returned an unparsable response")
+
+
 def optional_arg_decorator(decorator):
     'A decorator for decorators than can accept optional arguments.'
     @functools.wraps(decorator)
@@ -104,33 +228,27 @@ def optional_arg_decorator(decorator):
 @optional_arg_decorator
 # Since this is a decorator the handler argument will never be None, it is
 # defined as such only to comply with python's syntactic sugar.
-def call(handler=None, required_arguments=None):
+def call(handler=None, required_arguments=None, optional_arguments=None):
     'A decorator for API calls.'
     @functools.wraps(handler)
     def _call(*_, **__):
-        request = None
-        # If anything fails, we want to catch it here.
-        # pylint: disable=broad-except
-        try:
-            request = parse_request(flask.request, required_arguments)
-            response = handler(**request)
-        except (ArgumentMismatch, accounting.InsufficientFunds, accounting.SettleError) as exception:
-            response = dict(status=400, error_name=exception)
-        except Unauthorized as exception:
-            response = dict(status=403, error_name=exception)
-        except Exception as exception:
-            LOGGER.exception(f"unexpected server exception on {flask.request.url}: {request}")
-            response = dict(status=500, error_name=exception, stacktrace=traceback.format_exc().split('\n'))
-        # pylint: enable=broad-except
-        try:
-            return make_response(**(response))
-        except TypeError:
-            return make_response(500, 'InternalError', f"handler {handler.__name__} returned an unparsable response")
+        start = time.perf_counter()
+        response = handle(handler, required_arguments, optional_arguments)
+        status = response.status_code if isinstance(response, flask.Response) else response[1]
+        metrics.record_request(handler.__name__, status, time.perf_counter() - start)
+        return response
     return _call
 
 
+def get_unsettled_withdrawal_lines():
+    'Iterate over the CSV lines of the unsettled withdrawals - the address and the amount of ether owed to it.'
+    return (
+        f"0x{total['address']}, {accounting.roller_to_eth(total['amount'])}"
+        for total in accounting.get_unsettled_withdrawal_totals())
+
+
 @APP.route("/get_prices", methods=['GET'])
-@flasgger.swag_from(api_spec.GET_PRICES)
+@api_spec.document(api_spec.GET_PRICES)
 @call()
 def get_prices_handler():
     'Get current prices and safe address.'
@@ -141,15 +259,32 @@ def get_prices_handler():
 
 
 @APP.route("/get_balance", methods=['POST'])
-@flasgger.swag_from(api_spec.GET_BALANCE)
+@api_spec.document(api_spec.GET_BALANCE)
 @call(['address'])
 def get_balance_handler(address):
     'Get the balance of an address.'
     return dict(status=200, balance=accounting.get_balance(address))
 
 
+@APP.route("/get_balances", methods=['POST'])
+@api_spec.document(api_spec.GET_BALANCES)
+@call(['addresses'])
+def get_balances_handler(addresses):
+    'Get the balances of multiple addresses.'
+    return dict(status=200, balances=accounting.get_balances(addresses))
+
+
+@APP.route("/get_history", methods=['POST'])
+@api_spec.document(api_spec.GET_HISTORY)
+@call(['address'], ['cursor', 'direction', 'since', 'until', 'limit'])
+def get_history_handler(address, limit=None, **filters):
+    'Get a page of the transaction history of an address.'
+    transactions, next_cursor = accounting.get_history(address, limit=limit or HISTORY_PAGE_SIZE, **filters)
+    return dict(status=200, transactions=transactions, next_cursor=next_cursor)
+
+
 @APP.route("/transfer", methods=['POST'])
-@flasgger.swag_from(api_spec.TRANSFER)
+@api_spec.document(api_spec.TRANSFER)
 @call(['source', 'target', 'amount'])
 def transfer_handler(source, target, amount):
     'Transfer amount from source to target.'
@@ -157,8 +292,16 @@ def transfer_handler(source, target, amount):
     return dict(status=201)
 
 
+@APP.route("/transfer_batch", methods=['POST'])
+@api_spec.document(api_spec.TRANSFER_BATCH)
+@call(['transfers'])
+def transfer_batch_handler(transfers):
+    'Transfer multiple amounts between sources and targets, all or nothing.'
+    return dict(status=201, transfers=accounting.transfer_many(transfers))
+
+
 @APP.route("/withdraw", methods=['POST'])
-@flasgger.swag_from(api_spec.WITHDRAW)
+@api_spec.document(api_spec.WITHDRAW)
 @call(['address', 'amount'])
 def withdraw_handler(address, amount):
     'Withdraw amount from system.'
@@ -167,17 +310,18 @@ def withdraw_handler(address, amount):
 
 
 @APP.route("/get_unsettled_withdrawals", methods=['GET'])
-@flasgger.swag_from(api_spec.GET_UNSETTLED_WITHDRAWALS)
-@call
-def get_unsettled_withdrawals_handler():
-    'Get a CSV list of unsettled withdrawals.'
-    return dict(status=200, unsettled_withdrawals="\n".join([
-        f"0x{address}, {accounting.roller_to_eth(sum([withdrawal['amount'] for withdrawal in withdrawals]))}"
-        for address, withdrawals in accounting.get_unsettled_withdrawals().items()]))
+@api_spec.document(api_spec.GET_UNSETTLED_WITHDRAWALS)
+@call([], ['format'])
+def get_unsettled_withdrawals_handler(format='json'):  # pylint: disable=redefined-builtin
+    'Get a CSV list of unsettled withdrawals, inside a JSON response or streamed as is.'
+    lines = get_unsettled_withdrawal_lines()
+    if format == 'csv':
+        return flask.Response(flask.stream_with_context(f"{line}\n" for line in lines), mimetype='text/csv')
+    return dict(status=200, unsettled_withdrawals="\n".join(lines))
 
 
 @APP.route("/settle", methods=['POST'])
-@flasgger.swag_from(api_spec.SETTLE)
+@api_spec.document(api_spec.SETTLE)
 @call(['transaction_hash'])
 def settle_handler(transaction_hash):
     'Settle transactions that were paid by ethereum transaction_hash.'
@@ -185,16 +329,54 @@ def settle_handler(transaction_hash):
 
 
 @APP.route("/deposit", methods=['POST'])
-@flasgger.swag_from(api_spec.DEPOSIT)
+@api_spec.document(api_spec.DEPOSIT)
 @call(['address', 'amount'])
 def deposit_handler(address, amount):
     'Fake a deposit by an address.'
     if not DEBUG:
         raise Unauthorized('deposit endpoint is only available in debug mode')
-    accounting.debug_deposit(address, amount, 'debug deposit')
+    accounting.debug_deposit(address, amount)
     return dict(status=201)
 
 
+@APP.route("/metrics", methods=['GET'])
+@api_spec.document(api_spec.METRICS)
+def metrics_handler():
+    'Get the request, database and etherscan metrics of all server processes, in the Prometheus text format.'
+    body, content_type = metrics.render()
+    return flask.Response(body, content_type=content_type)
+
+
+def build_api_spec():
+    'Build the API spec from the documented endpoints of APP, with flasgger.'
+    import flasgger  # pylint: disable=import-outside-toplevel
+    swagger = flasgger.Swagger()
+    swagger.app = APP
+    swagger.load_config(APP)
+    with APP.app_context():
+        return swagger.get_apispecs(api_spec.CONFIG['specs'][0]['endpoint'])
+
+
+def write_api_spec(path=None):
+    'Prebuild the API spec into a file - done at deploy time.'
+    with open(path or API_SPEC_PATH, 'w', encoding='utf-8') as spec_file:
+        json.dump(build_api_spec(), spec_file, indent=4, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_api_spec():
+    'Get the API spec, building it once if it was not prebuilt.'
+    return build_api_spec()
+
+
+@APP.route(api_spec.CONFIG['specs'][0]['route'], methods=['GET'])
+def api_spec_handler():
+    'Serve the prebuilt API spec, or build it on the first request if there is none.'
+    if os.path.exists(API_SPEC_PATH):
+        return flask.send_file(API_SPEC_PATH, mimetype='application/json', max_age=0)
+    return flask.jsonify(get_api_spec())
+
+
 @APP.route("/five_hundred", methods=['POST'])
 @call(['reason'])
 def five_hundred_handler(reason):
@@ -209,3 +391,14 @@ def five_hundred_handler(reason):
 def catch_all_handler(path='index.html'):
     'All undefined endpoints try to serve from the static directories.'
     return make_response(403, Unauthorized(f"Forbidden path: {path}"))
+
+
+def setup_worker():
+    'Set up a worker forked by the uWSGI master, which must not use the connections and threads of the master.'
+    db.clear_pools()
+    logs.setup()
+
+
+# The uWSGI master imports this module once and forks all of its workers from it.
+if uwsgi is not None:
+    uwsgi.post_fork_hook = setup_worker
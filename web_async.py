@@ -0,0 +1,330 @@
+'Roller Balance asynchronous web server - an optional ASGI app serving the same API as web.APP.'
+import asyncio
+import contextlib
+import functools
+import itertools
+import os
+import time
+
+import aiomysql
+import httpx
+import starlette.applications
+import starlette.concurrency
+import starlette.middleware
+import starlette.middleware.cors
+import starlette.responses
+import starlette.routing
+
+import accounting
+import db
+import etherscan
+import metrics
+import web
+
+LOGGER = web.logs.logging.getLogger('roller.web_async')
+DB_POOL_MAX_SIZE = int(os.environ.get('ROLLER_ASYNC_DB_POOL_MAX_SIZE', 50))
+# Set on startup, and shared by all the requests of the process.
+POOL = None
+HTTP_CLIENT = None
+
+
+@contextlib.asynccontextmanager
+async def sql_connection():
+    'Async context manager for querying the database, like db.sql_connection.'
+    call_site, start, outcome = db.get_call_site(), time.perf_counter(), 'error'
+    try:
+        async with POOL.acquire() as connection:
+            try:
+                async with connection.cursor(aiomysql.DictCursor) as cursor:
+                    yield cursor
+                await connection.commit()
+                outcome = 'commit'
+            except db.pymysql.MySQLError:
+                LOGGER.exception('database error')
+                # The pool drops connections that are closed.
+                connection.close()
+                raise
+            except BaseException:
+                await connection.rollback()
+                raise
+    finally:
+        metrics.record_db_session(call_site, outcome, time.perf_counter() - start)
+
+
+async def get_balance(address):
+    'Get the roller balance of an address.'
+    async with sql_connection() as sql:
+        await sql.execute('SELECT balance FROM balances WHERE address = %(address)s', dict(address=address))
+        row = await sql.fetchone()
+        return int(row['balance']) if row else 0
+
+
+async def get_balances(addresses):
+    'Get the roller balances of multiple addresses.'
+    addresses = set(addresses)
+    async with sql_connection() as sql:
+        await sql.execute(
+            f"SELECT address, balance FROM balances WHERE address IN ({', '.join(['%s' for address in addresses])})",
+            list(addresses))
+        balances = {row['address']: int(row['balance']) for row in await sql.fetchall()}
+    return {address: balances.get(address, 0) for address in addresses}
+
+
+async def transfer_many(transfers):
+    'Transfer rollers between multiple sources and targets in a single transaction, like accounting.transfer_many.'
+    if accounting.TRANSFER_BATCH_SIZE > 0:
+        # Batches are committed by the batcher thread, so the request waits for its batch off the event loop.
+        return await starlette.concurrency.run_in_threadpool(accounting.transfer_many, transfers)
+    debits, received = accounting.get_debits_and_credits(transfers)
+    changes = accounting.get_balance_changes(transfers)
+    async with sql_connection() as sql:
+        await sql.execute(*accounting.get_transfers_insert(transfers))
+        # A single multi row insert is allocated consecutive auto increment values, starting with lastrowid.
+        first_local_transaction = sql.lastrowid
+        for statement in accounting.get_transfers_writes(transfers, first_local_transaction, changes):
+            await sql.execute(*statement)
+        accounting.invalidate_cached_balances(changes)
+        # Checked after writing, under the balance row locks, so concurrent transfers can not overspend.
+        await sql.execute(*accounting.get_funds_check(debits))
+        accounting.check_funds(await sql.fetchall(), debits, received)
+    accounting.invalidate_cached_balances(changes)
+    accounting.log_transfers(transfers)
+    return [
+        dict(source=item['source'], target=item['target'], amount=int(item['amount']), idx=idx)
+        for idx, item in enumerate(transfers, first_local_transaction)]
+
+
+async def post_etherscan(module, action, **kwargs):
+    'Make a single rate limited request to etherscan with the async client and return its result.'
+    delay = etherscan.RATE_LIMITER.reserve()
+    if delay:
+        await asyncio.sleep(delay)
+    try:
+        response = await HTTP_CLIENT.post(etherscan.ETHERSCAN_API, data=dict(
+            apikey=etherscan.get_api_key(), module=module, action=action, **kwargs))
+    except (httpx.TransportError, httpx.TimeoutException) as exception:
+        raise etherscan.TransientError(type(exception).__name__) from None
+    except httpx.HTTPError:
+        LOGGER.exception('etherscan error')
+        raise etherscan.EtherscanError(f"failed getting {module}.{action}", data=dict(response=None)) from None
+    return etherscan.parse_response(module, action, response)
+
+
+async def call_etherscan(module, action, cache_if=None, **kwargs):
+    'Call etherscan API with the async client, retrying and caching like etherscan.call - cache_if is awaited.'
+    cache = etherscan.get_cache() if cache_if else None
+    # The cache is a local SQLite database, read and written off the event loop.
+    if cache:
+        result = await starlette.concurrency.run_in_threadpool(cache.get, module, action, kwargs)
+        if result is not None:
+            return result
+    with etherscan.recorded_call(action):
+        for attempt in itertools.count():
+            try:
+                result = await post_etherscan(module, action, **kwargs)
+                break
+            except etherscan.TransientError as exception:
+                await asyncio.sleep(etherscan.get_retry_delay(module, action, attempt, exception))
+    if cache and result is not None and await cache_if(result):
+        await starlette.concurrency.run_in_threadpool(cache.put, module, action, kwargs, result)
+    return result
+
+
+async def is_confirmed(transaction):
+    'Check if a transaction is deep enough in the chain to never change, like etherscan.is_confirmed.'
+    if not isinstance(transaction, dict) or not transaction.get('blockNumber'):
+        return False
+    block_number = int(transaction['blockNumber'], 16)
+    if etherscan.LATEST_BLOCK_NUMBER - block_number < etherscan.REQUIRED_BLOCK_DEPTH:
+        etherscan.record_block_number(await call_etherscan('proxy', 'eth_blockNumber'))
+    return etherscan.LATEST_BLOCK_NUMBER - block_number >= etherscan.REQUIRED_BLOCK_DEPTH
+
+
+async def get_payments(target_address, transaction_hash):
+    'Get a list of all payments made in a multisender call, like etherscan.get_payments.'
+    transaction = await call_etherscan(
+        'proxy', 'eth_getTransactionByHash', cache_if=is_confirmed, txhash=f"0x{transaction_hash}")
+    if not etherscan.is_sent_by(transaction, target_address):
+        return []
+
+    async def is_transaction_confirmed(_):
+        return await is_confirmed(transaction)
+
+    return etherscan.parse_payments(await call_etherscan(
+        'account', 'txlistinternal', cache_if=is_transaction_confirmed, txhash=f"0x{transaction_hash}"))
+
+
+def make_response(*args, **kwargs):
+    'Make a basic server response, in the same format as web.make_response.'
+    response = web.build_response(*args, **kwargs)
+    return starlette.responses.JSONResponse(response, status_code=response['status'])
+
+
+async def handle(request, handler, required_arguments, optional_arguments):
+    'Parse the arguments of a request, await its handler and make its response, reporting errors like web.handle.'
+    arguments = None
+    try:
+        given_arguments = dict(request.query_params)
+        if request.method == 'POST':
+            given_arguments.update(await request.form())
+        arguments = web.parse_arguments(given_arguments, required_arguments, optional_arguments)
+        response = await handler(**arguments)
+        # Streaming handlers build their own response.
+        if isinstance(response, starlette.responses.Response):
+            return response
+    # If anything fails, we want to catch it here.
+    except Exception as exception:  # pylint: disable=broad-except
+        response = web.get_error_response(exception, request.url, arguments)
+    try:
+        return make_response(**(response))
+    except TypeError:
+        return make_response(500, 'InternalError', f"handler {handler.__name__} returned an unparsable response")
+
+
+def call(required_arguments=None, optional_arguments=None):
+    'A decorator for async API calls, parsing arguments, reporting errors and recording metrics like web.call.'
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def _call(request):
+            start = time.perf_counter()
+            response = await handle(request, handler, required_arguments, optional_arguments)
+            metrics.record_request(handler.__name__, response.status_code, time.perf_counter() - start)
+            return response
+        return _call
+    return decorator
+
+
+# Balance and transfer calls, which game clients make all the time, run on the event loop.
+# The rest are admin calls, which are rare, so they run the synchronous accounting code in a thread.
+
+@call()
+async def get_prices_handler():
+    'Get current prices and safe address.'
+    return dict(
+        status=200, safe=accounting.SAFE,
+        wei_deposit_for_one_roller=accounting.WEI_DEPOSIT_FOR_ONE_ROLLER,
+        wei_withdraw_for_one_roller=accounting.WEI_WITHDRAW_FOR_ONE_ROLLER)
+
+
+@call(['address'])
+async def get_balance_handler(address):
+    'Get the balance of an address.'
+    return dict(status=200, balance=await get_balance(address))
+
+
+@call(['addresses'])
+async def get_balances_handler(addresses):
+    'Get the balances of multiple addresses.'
+    return dict(status=200, balances=await get_balances(addresses))
+
+
+@call(['address'], ['cursor', 'direction', 'since', 'until', 'limit'])
+async def get_history_handler(address, limit=None, **filters):
+    'Get a page of the transaction history of an address.'
+    transactions, next_cursor = await starlette.concurrency.run_in_threadpool(
+        accounting.get_history, address, limit=limit or web.HISTORY_PAGE_SIZE, **filters)
+    return dict(status=200, transactions=transactions, next_cursor=next_cursor)
+
+
+@call(['source', 'target', 'amount'])
+async def transfer_handler(source, target, amount):
+    'Transfer amount from source to target.'
+    await transfer_many([dict(source=source, target=target, amount=amount)])
+    return dict(status=201)
+
+
+@call(['transfers'])
+async def transfer_batch_handler(transfers):
+    'Transfer multiple amounts between sources and targets, all or nothing.'
+    return dict(status=201, transfers=await transfer_many(transfers))
+
+
+@call(['address', 'amount'])
+async def withdraw_handler(address, amount):
+    'Withdraw amount from system.'
+    await transfer_many([dict(source=address, target=accounting.SAFE, amount=amount)])
+    return dict(status=201)
+
+
+@call([], ['format'])
+async def get_unsettled_withdrawals_handler(format='json'):  # pylint: disable=redefined-builtin
+    'Get a CSV list of unsettled withdrawals, inside a JSON response or streamed as is.'
+    lines = web.get_unsettled_withdrawal_lines()
+    if format == 'csv':
+        # Synchronous iterators are consumed in a thread.
+        return starlette.responses.StreamingResponse((f"{line}\n" for line in lines), media_type='text/csv')
+    return dict(status=200, unsettled_withdrawals="\n".join(
+        await starlette.concurrency.run_in_threadpool(list, lines)))
+
+
+@call(['transaction_hash'])
+async def settle_handler(transaction_hash):
+    'Settle transactions that were paid by ethereum transaction_hash.'
+    payments = await get_payments(accounting.SAFE, transaction_hash)
+    return dict(status=201, **await starlette.concurrency.run_in_threadpool(
+        accounting.settle, transaction_hash, payments))
+
+
+@call(['address', 'amount'])
+async def deposit_handler(address, amount):
+    'Fake a deposit by an address.'
+    if not web.DEBUG:
+        raise web.Unauthorized('deposit endpoint is only available in debug mode')
+    await starlette.concurrency.run_in_threadpool(accounting.debug_deposit, address, amount)
+    return dict(status=201)
+
+
+@call(['reason'])
+async def five_hundred_handler(reason):
+    'Test our 500 reporting - only for testing, but also available in production.'
+    if reason == 'response':
+        return None
+    raise Exception('five hundred response was requested')
+
+
+async def metrics_handler(_):
+    'Get the request, database and etherscan metrics of all server processes, in the Prometheus text format.'
+    body, content_type = metrics.render()
+    return starlette.responses.Response(body, headers={'Content-Type': content_type})
+
+
+async def catch_all_handler(request):
+    'All undefined endpoints are forbidden.'
+    return make_response(403, web.Unauthorized(f"Forbidden path: {request.path_params.get('path', 'index.html')}"))
+
+
+async def startup():
+    'Open the database pool and the etherscan client of the process.'
+    global POOL, HTTP_CLIENT  # pylint: disable=global-statement
+    POOL = await aiomysql.create_pool(
+        host=db.DB_HOST, user=db.DB_USER, password=db.DB_PASS, db=db.DB_NAME, maxsize=DB_POOL_MAX_SIZE)
+    HTTP_CLIENT = httpx.AsyncClient(
+        headers=etherscan.ETHERSCAN_HEADERS, timeout=etherscan.TIMEOUT,
+        limits=httpx.Limits(max_connections=etherscan.POOL_SIZE))
+
+
+async def shutdown():
+    'Close the database pool and the etherscan client of the process.'
+    POOL.close()
+    await POOL.wait_closed()
+    await HTTP_CLIENT.aclose()
+
+
+APP = starlette.applications.Starlette(routes=[
+    starlette.routing.Route('/get_prices', get_prices_handler, methods=['GET']),
+    starlette.routing.Route('/get_balance', get_balance_handler, methods=['POST']),
+    starlette.routing.Route('/get_balances', get_balances_handler, methods=['POST']),
+    starlette.routing.Route('/get_history', get_history_handler, methods=['POST']),
+    starlette.routing.Route('/transfer', transfer_handler, methods=['POST']),
+    starlette.routing.Route('/transfer_batch', transfer_batch_handler, methods=['POST']),
+    starlette.routing.Route('/withdraw', withdraw_handler, methods=['POST']),
+    starlette.routing.Route('/get_unsettled_withdrawals', get_unsettled_withdrawals_handler, methods=['GET']),
+    starlette.routing.Route('/settle', settle_handler, methods=['POST']),
+    starlette.routing.Route('/deposit', deposit_handler, methods=['POST']),
+    starlette.routing.Route('/metrics', metrics_handler, methods=['GET']),
+    starlette.routing.Route('/five_hundred', five_hundred_handler, methods=['POST']),
+    starlette.routing.Route('/', catch_all_handler),
+    starlette.routing.Route('/{path:path}', catch_all_handler, methods=['GET', 'POST'])
+], middleware=[
+    starlette.middleware.Middleware(starlette.middleware.cors.CORSMiddleware, allow_origins=['*'])
+], on_startup=[startup], on_shutdown=[shutdown])